@@ -0,0 +1,294 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import math
+import os
+import shutil
+import tempfile
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import git
+from git import GitCommandError
+
+from dist2src.git_stats import run_git
+
+logger = getLogger(__name__)
+
+
+def get_size(path: Path) -> int:
+    """ Number of bytes used by the files in a directory tree """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return size
+
+
+class BaseCache:
+    """
+    Base commits of the repos created by %prep, so that the files unpacked
+    from the same sources are not stored again, the results
+    of the patches applied to them, so that unchanged patches are not
+    applied again, and the whole repos, so that %prep is not run again
+    with the same inputs.
+
+    A bare repository, 'refs/bases/<key>' points to the base commit made
+    from the sources identified by the key, 'indexes/<key>' is its index
+    with the stat data of the unpacked files, 'refs/patches/<key>' to the commit
+    of a patch, identified by the tree it was applied to, the patch and
+    its arguments (see packitpatch), 'refs/preps/<key>' to the repo
+    created by %prep from the inputs identified by the key.
+    The repos created by %prep borrow its objects.
+
+    The least recently used entries are removed when the cache grows
+    over 'max_size' bytes.
+    """
+
+    def __init__(self, path: Path, max_size: Optional[int] = None):
+        """
+        @param path: path of the bare repository
+        @param max_size: bytes the cache can use, no limit if not set
+        """
+        self.path = path
+        self.max_size = max_size
+
+    @property
+    def objects_dir(self) -> str:
+        return str(self.path / "objects")
+
+    def _open(self) -> git.Repo:
+        if self.path.is_dir():
+            return git.Repo(self.path)
+        cache = git.Repo.init(self.path, bare=True)
+        # objects are only removed by evict()
+        cache.git.config("gc.auto", "0")
+        return cache
+
+    def _touch(self, ref: str):
+        """ mark the entry as used right now, 'ref' is relative to refs/ """
+        marker = self.path / "used" / ref
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+
+    def env(self, key: Optional[str]) -> Dict[str, str]:
+        """
+        Environment which makes packitpatch use the cache for the base commit.
+
+        @param key: identifies the sources, None if they can't be identified
+        """
+        cache = self._open()
+        env = {"PACKIT_BASE_OBJECTS": self.objects_dir}
+        if key:
+            tree = cache.git.rev_parse(
+                "--verify", "-q", f"refs/bases/{key}^{{tree}}", with_exceptions=False
+            )
+            index = self.path / "indexes" / key
+            if tree and index.is_file():
+                logger.info(f"Reusing the base tree {tree} of the sources.")
+                env["PACKIT_BASE_TREE"] = tree
+                env["PACKIT_BASE_INDEX"] = str(index)
+                self._touch(f"bases/{key}")
+        cache.close()
+        return env
+
+    def patch_env(self, results: Path) -> Dict[str, str]:
+        """
+        Environment which makes packitpatch reuse the results of patches.
+
+        Only valid when %prep changes the tree only by applying patches.
+
+        @param results: file where packitpatch lists the patches looked up
+        """
+        self._open().close()
+        return {
+            "PACKIT_PATCH_CACHE": str(self.path),
+            "PACKIT_PATCH_RESULTS": str(results),
+        }
+
+    def store(self, key: str, repo_path: Path):
+        """
+        Keep the base commit of a repo created by %prep.
+
+        @param key: identifies the sources the repo was created from
+        @param repo_path: path of the repo, its root commit is the base commit
+        """
+        try:
+            repo = git.Repo(repo_path)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+            logger.debug(f"No repo in {repo_path}, no base commit to store.")
+            return
+        try:
+            base = repo.git.rev_list("--max-parents=0", "HEAD").splitlines()[-1]
+            # the objects already in the cache are not sent
+            repo.git.push("-q", self.path, f"{base}:refs/bases/{key}", force=True)
+            # the stat data of the unpacked files, see packitpatch
+            (self.path / "indexes").mkdir(exist_ok=True)
+            shutil.copy2(
+                Path(repo.git_dir) / "packit-base-index", self.path / "indexes" / key
+            )
+        except (GitCommandError, FileNotFoundError) as ex:
+            # the conversion does not need it
+            logger.warning(f"Failed to store the base commit of {repo_path}: {ex}")
+            return
+        finally:
+            repo.close()
+        self._touch(f"bases/{key}")
+        logger.debug(f"Base commit {base} stored in {self.path}.")
+
+    def store_patches(self, results: Path, repo_path: Path) -> Tuple[int, int]:
+        """
+        Keep the commits of the patches which were not found in the cache.
+
+        @param results: the file given to packitpatch by patch_env()
+        @param repo_path: path of the repo the patches were applied in
+        @return: number of patches found in the cache and not found
+        """
+        hits, misses = [], {}
+        if results.is_file():
+            for line in results.read_text().splitlines():
+                result, key, *commit = line.split()
+                if result == "hit":
+                    hits.append(key)
+                else:
+                    misses[key] = commit[0]
+        for key in hits:
+            self._touch(f"patches/{key}")
+        if misses:
+            with git.Repo(repo_path) as repo:
+                try:
+                    repo.git.push(
+                        "-q",
+                        self.path,
+                        *(f"{c}:refs/patches/{key}" for key, c in misses.items()),
+                        force=True,
+                    )
+                except GitCommandError as ex:
+                    logger.warning(f"Failed to store the patches of {repo_path}: {ex}")
+                    return len(hits), len(misses)
+            for key in misses:
+                self._touch(f"patches/{key}")
+        logger.debug(
+            f"{len(hits)} patches reused, {len(misses)} stored in {self.path}."
+        )
+        return len(hits), len(misses)
+
+    def store_prep(self, key: str, repo_path: Path):
+        """
+        Keep the repo created by %prep, as it is after %prep.
+
+        'refs/preps/<key>' points to a commit of the working tree, including
+        the changes not committed and the ignored files, on top of HEAD.
+        The name of the repo and of its branch are in the message.
+
+        @param key: identifies the inputs of %prep
+        @param repo_path: path of the repo, BUILD/<name>
+        """
+        self._open().close()
+        with git.Repo(repo_path) as repo:
+            try:
+                with tempfile.TemporaryDirectory(dir=repo.git_dir) as tmp:
+                    # HEAD is committed, only the changed files are hashed
+                    index = Path(tmp) / "index"
+                    shutil.copy(Path(repo.git_dir) / "index", index)
+                    env = {"GIT_INDEX_FILE": str(index)}
+                    repo.git.add("--all", "--force", ":/", env=env)
+                    if "\n160000 " in "\n" + repo.git.ls_files("-s", env=env):
+                        # nested repos, their content is not in the tree
+                        logger.debug(f"Not storing the %prep repo {repo_path}.")
+                        return
+                    tree = repo.git.write_tree(env=env)
+                branch = repo.git.symbolic_ref("--short", "HEAD")
+                commit = repo.git.commit_tree(
+                    tree, "-p", "HEAD", "-m", f"{repo_path.name}\n\nbranch: {branch}"
+                )
+                repo.git.push("-q", self.path, f"{commit}:refs/preps/{key}", force=True)
+            except (GitCommandError, FileNotFoundError) as ex:
+                # the conversion does not need it
+                logger.warning(f"Failed to store the %prep repo {repo_path}: {ex}")
+                return
+        self._touch(f"preps/{key}")
+        logger.debug(f"%prep repo {repo_path} stored in {self.path}.")
+
+    def restore_prep(self, key: str, build_dir: Path) -> Optional[Path]:
+        """
+        Recreate the repo created by %prep with the same inputs before.
+
+        The repo borrows the objects of the cache.
+
+        @param key: identifies the inputs of %prep
+        @param build_dir: where to create the repo, the BUILD directory
+        @return: path of the repo, None if not in the cache
+        """
+        cache = self._open()
+        commit = cache.git.rev_parse(
+            "--verify", "-q", f"refs/preps/{key}^{{commit}}", with_exceptions=False
+        )
+        if not commit:
+            cache.close()
+            return None
+        name, _, branch = cache.git.show("-s", "--format=%s%n%b", commit).partition(
+            "\nbranch: "
+        )
+        cache.close()
+        repo_path = build_dir / name
+        repo_path.mkdir(parents=True)
+        try:
+            with git.Repo.init(repo_path) as repo:
+                alternates = Path(repo.git_dir) / "objects" / "info" / "alternates"
+                alternates.write_text(f"{self.objects_dir}\n")
+                repo.git.update_ref(f"refs/heads/{branch.strip()}", f"{commit}^")
+                repo.git.symbolic_ref("HEAD", f"refs/heads/{branch.strip()}")
+                # the working tree as %prep left it, the index as HEAD
+                repo.git.read_tree("--reset", "-u", commit)
+                repo.git.reset("-q")
+        except GitCommandError as ex:
+            # %prep is run then
+            logger.warning(f"Failed to restore the %prep repo {name}: {ex}")
+            shutil.rmtree(build_dir)
+            return None
+        self._touch(f"preps/{key}")
+        logger.info(f"Reusing the %prep repo {name} from {self.path}.")
+        return repo_path
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into 'max_size'.
+
+        Entries share objects, their share of the size is estimated as equal.
+        The most recently used entry is never removed.
+        """
+        if self.max_size is None or not self.path.is_dir():
+            return
+        size = get_size(self.path)
+        logger.debug(f"{self.path} uses {size} bytes, the limit is {self.max_size}.")
+        if size <= self.max_size:
+            return
+        used = sorted(
+            (p for p in (self.path / "used").glob("*/*")),
+            key=lambda p: p.stat().st_mtime,
+        )
+        count = min(len(used) - 1, math.ceil(len(used) * (size - self.max_size) / size))
+        if count <= 0:
+            return
+        logger.info(f"Evicting {count} entries from {self.path}.")
+        run_git(
+            ["git", "update-ref", "--stdin"],
+            input="".join(
+                f"delete refs/{p.parent.name}/{p.name}\n" for p in used[:count]
+            ).encode(),
+            cwd=self.path,
+            check=True,
+        )
+        for marker in used[:count]:
+            marker.unlink()
+            index = self.path / "indexes" / marker.name
+            if marker.parent.name == "bases" and index.exists():
+                index.unlink()
+        cache = git.Repo(self.path)
+        cache.git.gc("--prune=now", "--quiet")
+        cache.close()
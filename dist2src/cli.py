@@ -6,11 +6,14 @@
 import functools
 import logging
 from pathlib import Path
+from typing import Optional
 
 import click
 
 from dist2src.core import Dist2Src
+from dist2src.git_stats import GitStats
 from dist2src.constants import START_TAG_TEMPLATE
+from dist2src.base_cache import BaseCache
 from dist2src.worker.updater import Updater
 
 logger = logging.getLogger(__name__)
@@ -202,9 +205,60 @@ def add_packit_config(ctx, dest: str, branch: str):
 @cli.command("convert")
 @click.argument("origin", type=click.STRING)
 @click.argument("dest", type=click.STRING)
+@click.option(
+    "--share-objects",
+    is_flag=True,
+    default=False,
+    help="Borrow the objects of the %prep git repo instead of fetching them, "
+    "copy them to DEST only at the end.",
+)
+@click.option(
+    "--single-commit-in-index",
+    is_flag=True,
+    default=False,
+    help="Commit the single-commit repos straight from the %prep tree, "
+    "without moving the files to DEST.",
+)
+@click.option(
+    "--deterministic",
+    is_flag=True,
+    default=False,
+    help="Author and date the commits like the ORIGIN commit, "
+    "so that converting it again gives the same commits.",
+)
+@click.option(
+    "--patch-engine",
+    is_flag=True,
+    default=False,
+    help="Commit the patches applied in %prep without running git for each of them.",
+)
+@click.option(
+    "--base-cache",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Reuse the base commit of the %prep repo from this directory "
+    "when the sources did not change, the results of unchanged patches "
+    "and the whole %prep repo when nothing changed.",
+)
+@click.option(
+    "--git-profile",
+    is_flag=True,
+    default=False,
+    help="Set the git config for large trees in DEST and the %prep repos.",
+)
 @log_call
 @click.pass_context
-def convert(ctx, origin: str, dest: str):
+def convert(
+    ctx,
+    origin: str,
+    dest: str,
+    share_objects: bool,
+    single_commit_in_index: bool,
+    deterministic: bool,
+    patch_engine: bool,
+    base_cache: Optional[str],
+    git_profile: bool,
+):
     """Convert a dist-git repository into a source-git repository, using
     'rpmbuild' and executing the "%prep" stage from the spec file.
 
@@ -230,8 +284,23 @@ def convert(ctx, origin: str, dest: str):
         dist_git_path=Path(origin_dir),
         source_git_path=Path(dest_dir),
         log_level=ctx.obj[VERBOSE_KEY],
+        share_objects=share_objects,
+        single_commit_in_index=single_commit_in_index,
+        deterministic=deterministic,
+        patch_engine=patch_engine,
+        base_cache=BaseCache(Path(base_cache)) if base_cache else None,
+        git_profile=git_profile,
+    )
+    with GitStats() as stats:
+        d2s.convert(origin_branch, dest_branch)
+    logger.info(
+        f"{stats.total_seconds():.2f}s spent in git commands:\n{stats.summary()}"
     )
-    d2s.convert(origin_branch, dest_branch)
+    if d2s.patch_cache_hits or d2s.patch_cache_misses:
+        logger.info(
+            f"{d2s.patch_cache_hits} patches reused from the cache, "
+            f"{d2s.patch_cache_misses} applied."
+        )
 
 
 @cli.command()
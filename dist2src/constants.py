@@ -97,7 +97,21 @@ TARGETS = ["centos-stream-x86_64"]
 START_TAG_TEMPLATE = "{branch}-source-git"
 POST_CLONE_HOOK = "post-clone"
 AFTER_PREP_HOOK = "after-prep"
+# what %prep runs besides rpm, see Containerfile
+PREP_TOOLS: Tuple[str, ...] = (
+    "/usr/lib/rpm/macros.d/macros.packit",
+    "/usr/bin/packitpatch",
+)
 TEMP_SG_BRANCH = "updates"
+# git knows this object even when it's not in the repository
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+# git config set in the repos dist2src creates when asked to, for large
+# working trees; only what was measured to help on a tree of 50k files
+GIT_REPO_PROFILE: Dict[str, str] = {
+    # remember which directories have no untracked files (status, add, clean)
+    "core.untrackedcache": "true",
+}
 
 HOOKS: Dict[str, Dict[str, Any]] = {
     "kernel": {
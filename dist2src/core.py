@@ -2,24 +2,45 @@
 
 # Copyright Contributors to the Packit project.
 # SPDX-License-Identifier: MIT
+import hashlib
 import logging
 import os
 import re
 import shutil
 import subprocess
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional, Union, Set
+from collections import defaultdict
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import git
 import sh
 from git import GitCommandError
-from packit.patches import PatchMetadata
+from packit.git_utils import get_metadata_from_message
 from packit.specfile import Specfile
 from packit.config import get_local_package_config
 from yaml import dump
 
+from dist2src.git_stats import GitStats, run_git
+from dist2src.patch_engine import PatchEngine
+from dist2src.base_cache import BaseCache
 from dist2src.constants import (
     AFTER_PREP_HOOK,
+    EMPTY_TREE,
+    GIT_REPO_PROFILE,
+    PREP_TOOLS,
     TEMP_SG_BRANCH,
     START_TAG_TEMPLATE,
     TARGETS,
@@ -44,12 +65,217 @@ def get_build_dir(path: Path) -> Path:
     return build_dirs[0]
 
 
+def _str(value: Union[str, bytes]) -> str:
+    # GitPython returns bytes or str from cat-file, depending on its version
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def git_profile_env() -> Dict[str, str]:
+    """
+    Environment which makes every git command use GIT_REPO_PROFILE,
+    e.g. in the repos %prep creates.
+    """
+    # this is how 'git -c' passes the config to git commands it runs
+    parameters = " ".join(
+        f"'{key}'='{value}'" for key, value in GIT_REPO_PROFILE.items()
+    )
+    inherited = os.getenv("GIT_CONFIG_PARAMETERS")
+    if inherited:
+        parameters = f"{inherited} {parameters}"
+    return {"GIT_CONFIG_PARAMETERS": parameters}
+
+
+@contextmanager
+def environment(env: Dict[str, str]) -> Iterator[None]:
+    """
+    Set the environment variables while in the block, for all the processes
+    started meanwhile (GitPython, rpmbuild and the git commands it runs).
+    """
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+# %prep lines which apply patches, unpack the sources and which don't touch the tree
+PREP_PATCH_LINE = re.compile(r"^%(patch\d*|autopatch|autosetup)\b")
+PREP_SETUP_LINE = re.compile(r"^%setup\b")
+PREP_NEUTRAL_LINE = re.compile(
+    r"^(#|$|%(if\w*|elif\w*|else|endif|global|define|undefine)\b)"
+)
+
+
+def prep_applies_only_patches(prep_lines: List[str]) -> bool:
+    """
+    Whether %prep changes the tree only by applying patches, up to the last one,
+    so that packitpatch can stage just the files each patch touched.
+
+    The sources have to be unpacked before the first patch is applied.
+    """
+    lines = [line.strip() for line in prep_lines]
+    last_patch = max(
+        (i for i, line in enumerate(lines) if PREP_PATCH_LINE.match(line)), default=-1
+    )
+    patched = False
+    for line in lines[: last_patch + 1]:
+        if PREP_PATCH_LINE.match(line):
+            patched = True
+        elif PREP_SETUP_LINE.match(line):
+            if patched:
+                return False
+        elif not PREP_NEUTRAL_LINE.match(line):
+            return False
+    return True
+
+
+def _to_stream(text: str) -> BinaryIO:
+    # GitPython wants a file for the standard input of a command
+    stream = tempfile.TemporaryFile()
+    stream.write(text.encode())
+    stream.seek(0)
+    return stream
+
+
+class CommitMessage(NamedTuple):
+    """ the parts of a commit the conversion cares about """
+
+    hexsha: str
+    message: str
+
+
+class GitPlumbing:
+    """
+    Queries about refs, objects and history of a repository.
+
+    Objects and refs are looked up by 'git cat-file --batch-check'
+    and 'git cat-file --batch' processes, which GitPython keeps running
+    for the whole life of the repo object, so no new process is started
+    for a lookup.
+    """
+
+    def __init__(self, repo: git.Repo):
+        self.repo = repo
+
+    def resolve(self, rev: str) -> Optional[str]:
+        """
+        @param rev: anything 'git rev-parse' understands
+        @return: hexsha of the object, None if there is no such object
+        """
+        try:
+            hexsha, _, _ = self.repo.git.get_object_header(rev)
+        except ValueError:
+            return None
+        return _str(hexsha)
+
+    def read_commit(self, rev: str) -> Tuple[List[Tuple[str, str]], bytes]:
+        """
+        Read the raw commit 'rev' points to.
+
+        @return: header fields (in order, continuation lines of multi-line
+                 fields are left out) and the message
+        """
+        _, _, _, data = self.repo.git.get_object_data(f"{rev}^{{commit}}")
+        header, _, message = data.partition(b"\n\n")
+        fields: List[Tuple[str, str]] = []
+        for line in header.decode("utf-8", "replace").splitlines():
+            if line.startswith(" "):
+                continue
+            key, _, value = line.partition(" ")
+            fields.append((key, value))
+        return fields, message
+
+    def commit_message(self, rev: str) -> str:
+        """ message of the commit 'rev' points to """
+        _, message = self.read_commit(rev)
+        return message.decode("utf-8", "replace")
+
+    def log(self, rev: str = "HEAD") -> Iterator[CommitMessage]:
+        """
+        Stream hexshas and messages of the commits reachable from 'rev',
+        newest first, out of a single 'git log'.
+        """
+        process = self.repo.git.log("-z", "--format=%H%n%B", rev, as_process=True)
+        pending = b""
+        for chunk in iter(lambda: process.stdout.read(64 * 1024), b""):
+            # records are terminated by NUL, the last one may not be complete yet
+            *records, pending = (pending + chunk).split(b"\0")
+            for record in records:
+                hexsha, _, message = record.decode("utf-8", "replace").partition("\n")
+                yield CommitMessage(hexsha, message)
+        if pending:
+            hexsha, _, message = pending.decode("utf-8", "replace").partition("\n")
+            yield CommitMessage(hexsha, message)
+        process.wait()
+
+    def rev_list(self, rev: str = "HEAD", *args: str) -> List[str]:
+        """ hexshas of the commits reachable from 'rev', newest first """
+        return self.repo.git.rev_list(rev, *args).split()
+
+    def count_commits(self, rev: str = "HEAD") -> int:
+        """ number of commits reachable from 'rev' """
+        return int(self.repo.git.rev_list("--count", rev))
+
+    def close(self):
+        """ stop the long-running git processes """
+        self.repo.git.clear_cache()
+
+
+class RefIndex:
+    """
+    Names and targets of all the refs of a repository,
+    read by a single 'git for-each-ref'.
+
+    Annotated tags are peeled, so they map to the commit they tag.
+    """
+
+    def __init__(self, repo: git.Repo):
+        self._targets: Dict[str, str] = {}
+        self._pointing_at: Dict[str, List[str]] = defaultdict(list)
+        # ref names cannot contain spaces, the peeled object is empty
+        # for anything else than an annotated tag
+        output = repo.git.for_each_ref(format="%(objectname) %(*objectname) %(refname)")
+        for line in output.splitlines():
+            objectname, peeled, refname = line.split(" ", 2)
+            target = peeled or objectname
+            self._targets[refname] = target
+            self._pointing_at[target].append(refname)
+
+    def hexshas(self) -> Set[str]:
+        """ commits some ref points at """
+        return set(self._pointing_at)
+
+    def lookup(self, refname: str) -> Optional[str]:
+        """
+        @param refname: full name of the ref, e.g. refs/heads/c8s
+        @return: hexsha of the commit, None if there is no such ref
+        """
+        return self._targets.get(refname)
+
+    def refs_pointing_at(self, hexsha: str, prefix: str = "refs/") -> List[str]:
+        """ full names of refs pointing at the commit, sorted """
+        return [
+            ref for ref in self._pointing_at.get(hexsha, []) if ref.startswith(prefix)
+        ]
+
+
 class GitRepo:
     """
     a wrapper on top of git.Repo for our convenience
     """
 
-    def __init__(self, repo_path: Optional[Path], create: bool = False):
+    def __init__(
+        self, repo_path: Optional[Path], create: bool = False, profile: bool = False
+    ):
+        """
+        @param create: initialize the repo if it does not exist
+        @param profile: set GIT_REPO_PROFILE in the repo when creating it
+        """
         self.repo_path = repo_path
         # some CLI commands don't pass both paths,
         # let's just set it to None and move on
@@ -58,8 +284,14 @@ class GitRepo:
         elif create:
             repo_path.mkdir(parents=True, exist_ok=True)
             self.repo = git.Repo.init(repo_path)
+            if profile:
+                self.apply_profile()
         else:
             self.repo = git.Repo(repo_path)
+        self.plumbing = GitPlumbing(self.repo) if self.repo else None
+        self._refs: Optional[RefIndex] = None
+        # object directories added by add_alternate()
+        self._borrowed: List[str] = []
 
     def __str__(self):
         ref = None
@@ -67,6 +299,41 @@ class GitRepo:
             ref = self.repo.active_branch
         return f"GitRepo(path={self.repo_path}, ref={ref})"
 
+    def __enter__(self) -> "GitRepo":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop the git processes GitPython keeps running for the repo
+        and drop its caches. The repo can still be used afterwards,
+        the processes are started again when needed.
+        """
+        if self.repo:
+            self.plumbing.close()
+            self.repo.close()
+        self._refs = None
+
+    def apply_profile(self):
+        """ set GIT_REPO_PROFILE in the config of the repo """
+        with self.repo.config_writer() as config:
+            for key, value in GIT_REPO_PROFILE.items():
+                section, option = key.split(".")
+                config.set_value(section, option, value)
+
+    @property
+    def refs(self) -> RefIndex:
+        """ index of the refs, read again after the refs were changed """
+        if self._refs is None:
+            self._refs = RefIndex(self.repo)
+        return self._refs
+
+    def invalidate_refs(self):
+        """ call this after refs were changed outside of this class """
+        self._refs = None
+
     def has_ref(self, ref: str):
         """
         does this repo have a ref?
@@ -74,18 +341,11 @@ class GitRepo:
         @param ref: the ref to check via repo.branches and remote[].refs
         @return: bool
         """
-        if ref in self.repo.branches:
-            return True
-        # .branches does not contain all remote refs = branches
-        # (Pdb) self.source_git.repo.branches
-        # [<git.Head "refs/heads/master">]
-        # (Pdb) self.source_git.repo.remotes["origin"].refs
-        # [<git.RemoteReference "refs/remotes/origin/HEAD">,
-        #  <git.RemoteReference "refs/remotes/origin/c8">,
-        #  <git.RemoteReference "refs/remotes/origin/master">]
-        if "origin" in self.repo.remotes:
-            return ref in self.repo.remotes["origin"].refs
-        return False
+        # branches don't contain remote refs which have no local branch yet
+        return any(
+            self.refs.lookup(full_ref) is not None
+            for full_ref in (f"refs/heads/{ref}", f"refs/remotes/origin/{ref}")
+        )
 
     def checkout(self, branch: str, orphan: bool = False, create_branch: bool = False):
         """
@@ -95,14 +355,14 @@ class GitRepo:
         @param orphan: Create a branch with disconnected history.
         @param create_branch: Create branch if it doesn't exist (using -B)
         """
+        self.invalidate_refs()
         if orphan:
             self.repo.git.checkout("--orphan", branch)
             # when creating an orphan branch, git preserves files in the index
             # we don't want those, hush!
-            if self.repo.index.entries:
-                for entry in self.repo.index.entries:
-                    # entry = (path, stage number) -- see BaseIndexEntry.stage
-                    self.repo.index.remove(entry[0], working_tree=True, r=True, f=True)
+            # Reading the empty tree drops the whole index at once and removes
+            # the files it tracked from the working tree.
+            self.repo.git.read_tree("--reset", "-u", EMPTY_TREE)
         elif create_branch:
             self.repo.git.checkout("-B", branch)
         else:
@@ -110,6 +370,7 @@ class GitRepo:
 
     def commit(self, message: str, body: Optional[str] = None):
         """Commit staged changes in GITDIR."""
+        self.invalidate_refs()
         other_message_kwargs = {"message": body} if body else {}
         # some of the commits may be empty and it's not an error,
         # e.g. extra source files
@@ -129,8 +390,67 @@ class GitRepo:
         @param remote: str or path of the repo we fetch from
         @param refspec: see man git-fetch
         """
+        self.invalidate_refs()
         self.repo.git.fetch(remote, refspec)
 
+    def add_alternate(self, objects_dir: Path):
+        """
+        Make the objects in 'objects_dir' available in this repo without
+        copying them, see gitrepository-layout(5).
+        """
+        alternates = Path(self.repo.git_dir) / "objects" / "info" / "alternates"
+        alternates.parent.mkdir(parents=True, exist_ok=True)
+        with alternates.open("a") as f:
+            f.write(f"{objects_dir}\n")
+        self._borrowed.append(str(objects_dir))
+
+    def consolidate_objects(self, exclude: Iterable[str] = ()):
+        """
+        Copy the objects borrowed by add_alternate() into a pack of this repo
+        and stop using those alternates. Other alternates are kept.
+
+        Only the objects which are reachable from refs, reflogs or the index,
+        but not from the commits in 'exclude', are packed. Everything
+        reachable from those commits has to be in this repo already.
+
+        @param exclude: commits which were present before borrowing objects
+        """
+        if not self._borrowed:
+            return
+        revs = "".join(f"{hexsha}\n" for hexsha in ("--not", *exclude))
+        run_git(
+            [
+                "git",
+                "pack-objects",
+                "--revs",
+                "--all",
+                "--reflog",
+                "--indexed-objects",
+                "-q",
+                str(Path(self.repo.git_dir) / "objects" / "pack" / "pack"),
+            ],
+            input=revs.encode(),
+            cwd=self.repo.working_dir,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        alternates = Path(self.repo.git_dir) / "objects" / "info" / "alternates"
+        kept = [
+            line
+            for line in alternates.read_text().splitlines()
+            if line not in self._borrowed
+        ]
+        if kept:
+            alternates.write_text("".join(f"{line}\n" for line in kept))
+        else:
+            alternates.unlink()
+        self._borrowed = []
+        self.repo.git.prune_packed()
+        # make git (and GitPython's cat-file processes) forget the alternates
+        self.plumbing.close()
+        # every object needed has to be in the repo now
+        self.repo.git.rev_list("--objects", "--all", "--quiet", "--not", *exclude, "--")
+
     def stage(self, add=None, exclude=None):
         """ stage content in the repo (git add)"""
         if exclude:
@@ -138,22 +458,169 @@ class GitRepo:
             logger.debug(exclude)
         self.repo.git.add(add or ".", "-f", exclude)
 
+    def identity_env(self, rev: str) -> Dict[str, str]:
+        """
+        Environment which makes git create commits and tags as the author
+        and committer of a commit, at the same time.
+
+        @param rev: the commit
+        """
+        fields = self.repo.git.log(
+            "-1", "--date=raw", "--format=%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd", rev
+        ).split("\0")
+        return dict(
+            zip(
+                (
+                    "GIT_AUTHOR_NAME",
+                    "GIT_AUTHOR_EMAIL",
+                    "GIT_AUTHOR_DATE",
+                    "GIT_COMMITTER_NAME",
+                    "GIT_COMMITTER_EMAIL",
+                    "GIT_COMMITTER_DATE",
+                ),
+                fields,
+            )
+        )
+
     def create_tag(self, tag, branch):
         """Create a Git TAG at the tip of BRANCH"""
+        self.invalidate_refs()
         self.repo.create_tag(tag, ref=branch, force=True)
 
     def get_tags_for_head(self) -> List[str]:
-        return list(
-            tag.name for tag in self.repo.tags if tag.commit == self.repo.head.commit
+        head = self.plumbing.resolve("HEAD")
+        if head is None:
+            return []
+        return [
+            ref.split("/", 2)[2]
+            for ref in self.refs.refs_pointing_at(head, prefix="refs/tags/")
+        ]
+
+    def _merge_trees(
+        self, base: str, ours: str, theirs: str, theirs_if_added: bool
+    ) -> Optional[str]:
+        """
+        Merge 'ours' and 'theirs' in a temporary index.
+
+        @return: hexsha of the merged tree, None if there are conflicts
+        """
+        with tempfile.TemporaryDirectory(dir=self.repo.git_dir) as tmp:
+            env = {"GIT_INDEX_FILE": str(Path(tmp) / "index")}
+            self.repo.git.read_tree(
+                "-m", "-i", "--aggressive", base, ours, theirs, env=env
+            )
+            unmerged = self.repo.git.ls_files("-u", "-z", env=env)
+            if unmerged:
+                # <mode> <object> <stage>\t<path>
+                stages: Dict[str, Dict[str, Tuple[str, str]]] = defaultdict(dict)
+                for entry in unmerged.split("\0"):
+                    if entry:
+                        info, path = entry.split("\t", 1)
+                        mode, sha, stage = info.split()
+                        stages[path][stage] = (mode, sha)
+                # only regular files added on both sides with the same mode
+                # are resolved the way -Xtheirs does it
+                if not theirs_if_added or any(
+                    set(path_stages) != {"2", "3"}
+                    or path_stages["2"][0] != path_stages["3"][0]
+                    or path_stages["3"][0] not in ("100644", "100755")
+                    for path_stages in stages.values()
+                ):
+                    return None
+                self.repo.git.update_index(
+                    "--index-info",
+                    env=env,
+                    istream=_to_stream(
+                        "".join(
+                            f"{path_stages['3'][0]} {path_stages['3'][1]} 0\t{path}\n"
+                            for path, path_stages in stages.items()
+                        )
+                    ),
+                )
+            return self.repo.git.write_tree(env=env)
+
+    def pick_in_index(
+        self,
+        commit: str,
+        onto: Optional[str],
+        keep_redundant: bool = True,
+        theirs_if_added: bool = False,
+    ) -> Optional[str]:
+        """
+        Create the commit 'git cherry-pick' would create, without touching
+        the working tree, the index or any ref.
+
+        The changes are merged by a 3-way 'read-tree' in a temporary index,
+        which only resolves trivial cases. When the result is not certain
+        to be the same as the one of 'git cherry-pick -Xtheirs',
+        no commit is created.
+
+        @param commit: the commit to pick
+        @param onto: the commit to pick onto, None for an unborn branch
+        @param keep_redundant: create the commit even if it doesn't change anything
+        @param theirs_if_added: resolve paths added on both sides with
+                                the version of 'commit', that's what
+                                -Xtheirs does when picking a root commit
+        @return: hexsha of the new commit, None if it needs to be picked for real
+        """
+        fields, message = self.plumbing.read_commit(commit)
+        names = [name for name, _ in fields]
+        parents = [value for name, value in fields if name == "parent"]
+        # merges, signed or re-encoded commits are left to git
+        if len(parents) > 1 or set(names) - {"tree", "parent", "author", "committer"}:
+            return None
+        author = dict(fields)["author"]
+        match = re.match(r"^(.+) <(.*)> (\d+) ([+-]\d{4})$", author)
+        if not match:
+            return None
+        name, email, timestamp, timezone = match.groups()
+
+        base_tree = self.plumbing.resolve(
+            f"{parents[0]}^{{tree}}" if parents else EMPTY_TREE
         )
+        ours_tree = self.plumbing.resolve(f"{onto}^{{tree}}" if onto else EMPTY_TREE)
+        git_dir = Path(self.repo.git_dir)
+        if base_tree == ours_tree:
+            # the usual case when replaying a series: nothing to merge
+            tree = self.plumbing.resolve(f"{commit}^{{tree}}")
+        elif self.repo.git.diff_tree(
+            "-r", "--name-only", "--diff-filter=D", base_tree, ours_tree
+        ):
+            # git could detect renames, which read-tree doesn't
+            return None
+        else:
+            tree = self._merge_trees(base_tree, ours_tree, commit, theirs_if_added)
+            if not tree:
+                return None
+
+        if not keep_redundant and tree == ours_tree:
+            return None
+        with tempfile.NamedTemporaryFile(dir=git_dir, prefix="MSG.pick.") as msg:
+            msg.write(message)
+            msg.flush()
+            return self.repo.git.commit_tree(
+                tree,
+                *(["-p", onto] if onto else []),
+                "-F",
+                msg.name,
+                env={
+                    "GIT_AUTHOR_NAME": name,
+                    "GIT_AUTHOR_EMAIL": email,
+                    "GIT_AUTHOR_DATE": f"@{timestamp} {timezone}",
+                },
+            )
 
     def cherry_pick_base(self, from_branch, to_branch, theirs=False):
         """Cherry-pick the first commit of a branch
 
         Cherry-pick the first commit of FROM_BRANCH to TO_BRANCH in the
         repository stored in GITDIR.
+
+        The commit is created in the index only and checked out when done,
+        'git cherry-pick' is used only when the result is not trivial.
         """
-        num_commits = sum(1 for _ in self.repo.iter_commits(from_branch))
+        self.invalidate_refs()
+        num_commits = self.plumbing.count_commits(from_branch)
         self.checkout(to_branch, create_branch=True)
         git_options = (
             {
@@ -169,8 +636,18 @@ class GitRepo:
                 "We wanted to cherry-pick the base commit but the source-git repo "
                 "is dirty when it shouldn't be."
             )
+        base_commit = f"{from_branch}~{num_commits - 1}"
+        picked = self.pick_in_index(
+            self.plumbing.resolve(f"{base_commit}^{{commit}}"),
+            onto=self.plumbing.resolve("HEAD"),
+            keep_redundant=theirs,
+            theirs_if_added=theirs,
+        )
+        if picked:
+            self.repo.git.reset("--hard", picked)
+            return
         try:
-            self.repo.git.cherry_pick(f"{from_branch}~{num_commits - 1}", **git_options)
+            self.repo.git.cherry_pick(base_commit, **git_options)
         except GitCommandError as ex:
             if "nothing to commit" in str(ex):
                 self.commit(message="Base commit: empty - no source archive")
@@ -190,6 +667,80 @@ class GitRepo:
             else:
                 raise
 
+    def commit_tree(
+        self, tree: str, parent: Optional[str], message: str, body: Optional[str] = None
+    ) -> str:
+        """
+        Create the commit 'git commit' would create for the tree,
+        no ref is updated.
+
+        @return: hexsha of the commit
+        """
+        # 'git commit' cleans up the message, 'git commit-tree' doesn't
+        message = self.repo.git.stripspace(
+            istream=_to_stream("\n\n".join(filter(None, (message, body))))
+        )
+        return self.repo.git.commit_tree(
+            tree,
+            *(["-p", parent] if parent else []),
+            istream=_to_stream(f"{message}\n"),
+        )
+
+    def commit_directory(
+        self, directory: Path, message: str, overlay: Dict[str, Union[Path, str]]
+    ) -> str:
+        """
+        Commit the content of another directory as the new tree of HEAD,
+        the files are not moved or copied to this repo.
+
+        The directory is added using a temporary index, then the files
+        in 'overlay' are put on top of it. Only the changed files are
+        updated in the working tree of this repo afterwards.
+
+        @param directory: the content to commit, its .git is ignored
+        @param message: commit message
+        @param overlay: path in the repo -> file to take the content from,
+                        or the content itself
+        @return: hexsha of the commit
+        """
+        self.invalidate_refs()
+        head = self.plumbing.resolve("HEAD")
+        with tempfile.TemporaryDirectory(dir=self.repo.git_dir) as tmp:
+            env = {"GIT_INDEX_FILE": str(Path(tmp) / "index")}
+            # ':/' is the top of the work tree, wherever git runs
+            self.repo.git.add(
+                "--all",
+                "--force",
+                ":/",
+                env={**env, "GIT_WORK_TREE": str(directory)},
+            )
+            files = []
+            for i, content in enumerate(overlay.values()):
+                if isinstance(content, Path):
+                    files.append(content)
+                else:
+                    files.append(Path(tmp) / f"overlay{i}")
+                    files[-1].write_text(content)
+            if files:
+                hexshas = self.repo.git.hash_object("-w", "--", *files).split()
+                self.repo.git.update_index(
+                    "--index-info",
+                    env=env,
+                    istream=_to_stream(
+                        "".join(
+                            f"{'100755' if os.access(file, os.X_OK) else '100644'} "
+                            f"{hexsha}\t{path}\n"
+                            for path, file, hexsha in zip(overlay, files, hexshas)
+                        )
+                    ),
+                )
+            tree = self.repo.git.write_tree(env=env)
+        commit = self.commit_tree(tree, head, message)
+        self.repo.git.read_tree("--reset", "-u", commit)
+        self.repo.git.update_ref("-m", f"commit: {message}", "HEAD", commit)
+        self.clean()  # untracked files are left by read-tree
+        return commit
+
     def revert_to_ref(
         self,
         ref,
@@ -197,6 +748,20 @@ class GitRepo:
         commit_body: Optional[str] = None,
     ):
         commit_message = commit_message or f"Revert the state to {ref}"
+        self.invalidate_refs()
+        if not self.may_need_renormalization(ref):
+            # The revert commit is created straight from the tree of 'ref',
+            # only the files which differ are updated in the working tree.
+            head = self.plumbing.resolve("HEAD")
+            revert = self.commit_tree(
+                f"{ref}^{{tree}}", head, commit_message, body=commit_body
+            )
+            self.repo.git.read_tree("-m", "-u", head, revert)
+            self.repo.git.update_ref(
+                "-m", f"commit: {commit_message}", "HEAD", revert, head
+            )
+            self.clean()  # untracked files are left by read-tree
+            return
         # https://git-scm.com/book/en/v2/Git-Tools-Reset-Demystified
         # Reset index without changing HEAD
         self.repo.git.reset(ref, ".")
@@ -210,6 +775,19 @@ class GitRepo:
             self.repo.git.add("--renormalize", ".")
             self.repo.git.commit("--amend", "--no-edit")
 
+    def may_need_renormalization(self, ref) -> bool:
+        """
+        Could checking out 'ref' change the content of files,
+        because of attributes or EOL conversion?
+        """
+        if (Path(self.repo.git_dir) / "info" / "attributes").is_file():
+            return True
+        reader = self.repo.config_reader()
+        if reader.has_option("core", "autocrlf") or reader.has_option("core", "eol"):
+            return True
+        paths = self.repo.git.ls_tree("-r", "--name-only", "-z", ref).split("\0")
+        return any(path.rsplit("/", 1)[-1] == ".gitattributes" for path in paths)
+
     def clean(self):
         """
         Clean the repo.
@@ -219,6 +797,21 @@ class GitRepo:
         self.repo.git.clean("-xdff")
 
     def fast_forward(self, branch, to_ref):
+        self.invalidate_refs()
+        target = self.plumbing.resolve(f"{to_ref}^{{commit}}")
+        current = self.plumbing.resolve(f"refs/heads/{branch}")
+        if (
+            target == self.plumbing.resolve("HEAD")
+            and current
+            and self.repo.is_ancestor(current, target)
+        ):
+            # HEAD is there already, only the branch needs to move,
+            # the working tree stays as it is
+            self.repo.git.update_ref(
+                "-m", f"merge {to_ref}: Fast-forward", f"refs/heads/{branch}", target
+            )
+            self.repo.git.symbolic_ref("HEAD", f"refs/heads/{branch}")
+            return
         self.checkout(branch)
         self.repo.git.merge(to_ref, ff_only=True)
 
@@ -241,6 +834,12 @@ class Dist2Src:
         dist_git_path: Optional[Path],
         source_git_path: Optional[Path],
         log_level: int = 1,
+        share_objects: bool = False,
+        single_commit_in_index: bool = False,
+        deterministic: bool = False,
+        patch_engine: bool = False,
+        base_cache: Optional[BaseCache] = None,
+        git_profile: bool = False,
     ):
         """
         both dist_git_path and source_git_path are optional because not all operations require both
@@ -249,15 +848,55 @@ class Dist2Src:
         @param source_git_path: path to a source-git repo (doesn't need to exist)
                                 where the conversion output will land
         @param log_level: int, 0 minimal output, 1 verbose, 2 debug
+        @param share_objects: source-git borrows the objects of the BUILD repo
+                              instead of fetching them, they are copied only
+                              once, at the end of the conversion
+        @param single_commit_in_index: single-commit repos are committed from
+                                       the BUILD dir, without moving the files
+        @param deterministic: commits are created as the author and committer
+                              of the dist-git commit, at its time, so that
+                              converting it again gives the same commits
+        @param patch_engine: the patches applied in %prep are committed
+                             by dist2src, not by a git process for each of them
+        @param base_cache: the base commit of the %prep repo is reused from there
+                           when the sources did not change, and so are
+                           the results of the patches which did not change
+                           and the whole repo when no input of %prep changed
+        @param git_profile: the repos dist2src and %prep create use
+                            GIT_REPO_PROFILE
         """
         # we are using absolute paths since we do pushd below before running rpmbuild
         # and in that case relative paths no longer work
         self.dist_git_path = dist_git_path.absolute() if dist_git_path else None
         self.dist_git = GitRepo(self.dist_git_path)
         self.source_git_path = source_git_path.absolute() if source_git_path else None
-        self.source_git = GitRepo(self.source_git_path, create=True)
+        self.source_git = GitRepo(
+            self.source_git_path, create=True, profile=git_profile
+        )
         self.log_level = log_level
-        self._dist_git_spec = None
+        self.share_objects = share_objects
+        self.single_commit_in_index = single_commit_in_index
+        self.deterministic = deterministic
+        self.patch_engine = patch_engine
+        self.base_cache = base_cache
+        self.git_profile = git_profile
+        # patches of the last %prep reused from the base cache, and not
+        self.patch_cache_hits = 0
+        self.patch_cache_misses = 0
+        self._dist_git_spec: Optional[Specfile] = None
+        # commits of the BUILD repo, newest first
+        self._BUILD_commits: Optional[List[CommitMessage]] = None
+
+    def __enter__(self) -> "Dist2Src":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ release the git processes and caches of both repos """
+        self.dist_git.close()
+        self.source_git.close()
 
     @property
     def dist_git_spec(self):
@@ -281,6 +920,18 @@ class Dist2Src:
         # running from dest_dir
         return get_build_dir(self.dist_git_path).absolute()
 
+    @property
+    def BUILD_commits(self) -> List[CommitMessage]:
+        """
+        Commits of the repo generated by %prep, newest first.
+
+        They are listed once per %prep run.
+        """
+        if self._BUILD_commits is None:
+            with GitRepo(self.BUILD_repo_path) as BUILD_git:
+                self._BUILD_commits = list(BUILD_git.plumbing.log())
+        return self._BUILD_commits
+
     @property
     def package_name(self):
         if self.dist_git_path:
@@ -369,6 +1020,73 @@ class Dist2Src:
 
         self.dist_git_spec.save()
 
+    def base_key(self, prep_lines: List[str]) -> Optional[str]:
+        """
+        Identify the sources the base commit of the %prep repo is made from:
+        the checksums of the sources and %prep up to the first patch.
+
+        @return: key in the base cache, None when the sources are unknown
+                 or %prep unpacks them more than once
+        """
+        lines = [line.strip() for line in prep_lines]
+        first_patch = next(
+            (i for i, line in enumerate(lines) if PREP_PATCH_LINE.match(line)),
+            len(lines),
+        )
+        setup_lines = lines[: first_patch + 1]
+        setups = [
+            line for line in setup_lines if line.startswith(("%setup", "%autosetup"))
+        ]
+        if len(setups) != 1:
+            return None
+        checksum_files = [
+            path
+            for path in (
+                self.dist_git_path / f".{self.package_name}.metadata",
+                self.dist_git_path / "sources",
+            )
+            if path.is_file()
+        ]
+        if not checksum_files:
+            return None
+        key = hashlib.sha256()
+        for path in checksum_files:
+            key.update(path.read_bytes())
+        # sources stored in dist-git
+        key.update(self.dist_git.repo.git.ls_tree("-r", "HEAD", "SOURCES").encode())
+        key.update("\n".join(setup_lines).encode())
+        return key.hexdigest()
+
+    def prep_key(self, ensure_autosetup: bool) -> str:
+        """
+        Identify the inputs of %prep: the spec, as rpmbuild gets it,
+        the content of the sources, the packit macros and packitpatch,
+        the hook run after %prep and the identity of the commits.
+
+        @return: key in the base cache
+        """
+        key = hashlib.sha256()
+        key.update(f"ensure_autosetup: {ensure_autosetup}\n".encode())
+        key.update(f"{get_hook(self.package_name, AFTER_PREP_HOOK)}\n".encode())
+        for name in sorted(os.environ):
+            if name.startswith(("GIT_AUTHOR_", "GIT_COMMITTER_")):
+                key.update(f"{name}={os.environ[name]}\n".encode())
+        sources_dir = self.dist_git_path / "SOURCES"
+        sources = sorted(p for p in sources_dir.rglob("*") if not p.is_dir())
+        spec = self.dist_git_path / self.relative_specfile_path
+        inputs = {
+            self.relative_specfile_path: spec,
+            **{str(p.relative_to(self.dist_git_path)): p for p in sources},
+            **{tool: Path(tool) for tool in PREP_TOOLS},
+        }
+        for name, path in inputs.items():
+            key.update(f"{name}\n".encode())
+            if path.is_file():
+                with path.open("rb") as f:
+                    for chunk in iter(lambda: f.read(1024 ** 2), b""):
+                        key.update(chunk)
+        return key.hexdigest()
+
     def run_prep(self, ensure_autosetup: bool = True):
         """
         run `rpmbuild -bp` in the dist-git repo to get a git-repo
@@ -376,8 +1094,6 @@ class Dist2Src:
 
         @param ensure_autosetup: replace %setup with %autosetup if possible
         """
-        rpmbuild = sh.Command("rpmbuild")
-
         with sh.pushd(self.dist_git_path):
             BUILD_dir = Path("BUILD")
             if BUILD_dir.is_dir():
@@ -386,6 +1102,7 @@ class Dist2Src:
                 # there would be 2 directories which the get_build_dir() function
                 # would not handle
                 shutil.rmtree(BUILD_dir)
+            self._BUILD_commits = None
 
             cwd = Path.cwd()
             logger.debug(f"Running rpmbuild in {cwd}")
@@ -403,19 +1120,65 @@ class Dist2Src:
 
             if ensure_autosetup:
                 self._enforce_autosetup()
+            prep_lines = self.dist_git_spec.spec_content.section("%prep") or []
 
-            try:
-                running_cmd = rpmbuild(*rpmbuild_args)
-            except sh.ErrorReturnCode as e:
-                # This might create a tons of error logs.
-                # Create a child logger, so that it's possible to filter
-                # for them, for example in Sentry.
-                rpmbuild_logger = logger.getChild("rpmbuild")
-                for line in e.stderr.splitlines():
-                    rpmbuild_logger.error(str(line))
-                # Also log the failure using the main logger.
-                logger.error(f"{['rpmbuild', *rpmbuild_args]} failed")
-                raise
+            prep_key = self.prep_key(ensure_autosetup) if self.base_cache else None
+            if prep_key and self.base_cache.restore_prep(prep_key, cwd / BUILD_dir):
+                self.dist_git.repo.git.checkout(self.relative_specfile_path)
+                return
+
+            rpmbuild = sh.Command("rpmbuild")
+            with tempfile.TemporaryDirectory() as trace_dir:
+                env = dict(os.environ)
+                if self.git_profile:
+                    # the repos created by %prep use the profile as well
+                    env.update(git_profile_env())
+                if GitStats.active():
+                    # git commands run by packitpatch and the macros
+                    env["GIT_TRACE2_EVENT"] = str(Path(trace_dir) / "trace2.json")
+                if prep_applies_only_patches(prep_lines):
+                    # packitpatch stages the files the patch touched, not the whole tree
+                    env["PACKIT_PATCH_STAGING"] = "patched"
+                engine = None
+                try:
+                    base_key = self.base_key(prep_lines) if self.base_cache else None
+                    if self.base_cache:
+                        env.update(self.base_cache.env(base_key))
+                    patch_results = None
+                    if self.base_cache and "PACKIT_PATCH_STAGING" in env:
+                        # the patches applied before are replayed from the cache
+                        patch_results = Path(trace_dir) / "patches"
+                        env.update(self.base_cache.patch_env(patch_results))
+                    if self.patch_engine:
+                        engine = PatchEngine(env)
+                        env.update(engine.env())
+                        engine.start()
+                    running_cmd = rpmbuild(*rpmbuild_args, _env=env)
+                    if engine:
+                        engine.close()
+                    if base_key and "PACKIT_BASE_TREE" not in env:
+                        self.base_cache.store(base_key, self.BUILD_repo_path)
+                    if patch_results:
+                        (
+                            self.patch_cache_hits,
+                            self.patch_cache_misses,
+                        ) = self.base_cache.store_patches(
+                            patch_results, self.BUILD_repo_path
+                        )
+                except sh.ErrorReturnCode as e:
+                    # This might create a tons of error logs.
+                    # Create a child logger, so that it's possible to filter
+                    # for them, for example in Sentry.
+                    rpmbuild_logger = logger.getChild("rpmbuild")
+                    for line in e.stderr.splitlines():
+                        rpmbuild_logger.error(str(line))
+                    # Also log the failure using the main logger.
+                    logger.error(f"{['rpmbuild', *rpmbuild_args]} failed")
+                    raise
+                finally:
+                    if engine:
+                        engine.abort()
+                    GitStats.record_trace2(Path(trace_dir) / "trace2.json")
 
             self.dist_git.repo.git.checkout(self.relative_specfile_path)
 
@@ -427,6 +1190,15 @@ class Dist2Src:
                 bash = sh.Command("bash")
                 bash("-c", hook_cmd)
 
+            BUILD_entries = list(BUILD_dir.iterdir())
+            # the repo is all the output of %prep which is used
+            if (
+                prep_key
+                and len(BUILD_entries) == 1
+                and (BUILD_entries[0] / ".git").is_dir()
+            ):
+                self.base_cache.store_prep(prep_key, BUILD_entries[0].absolute())
+
     def fetch_branch(self, source_branch: str, dest_branch: str):
         """Fetch the branch produced by 'rpmbuild -bp' from the dist-git
         repo to the source-git repo.
@@ -437,6 +1209,9 @@ class Dist2Src:
         logger.info(
             f"Fetch the dist-git %prep branch to source-git branch {dest_branch}."
         )
+        if self.share_objects:
+            # the fetch only updates the ref when all the objects are present
+            self.source_git.add_alternate(self.BUILD_repo_path / ".git" / "objects")
         self.source_git.fetch(self.BUILD_repo_path, f"+{source_branch}:{dest_branch}")
 
     def perform_convert(
@@ -461,9 +1236,9 @@ class Dist2Src:
             raise RuntimeError(
                 ".git repo not present in the BUILD/ dir after running %prep"
             )
-        BUILD_repo = GitRepo(self.BUILD_repo_path)
         # since this is not a patch, we want packit to ignore it
-        BUILD_repo.commit_all(message="Changes after running %prep\n\nignore: true")
+        with GitRepo(self.BUILD_repo_path) as BUILD_repo:
+            BUILD_repo.commit_all(message="Changes after running %prep\n\nignore: true")
         self.fetch_branch(source_branch="master", dest_branch=TEMP_SG_BRANCH)
         self.source_git.cherry_pick_base(
             from_branch=TEMP_SG_BRANCH, to_branch=dest_branch, theirs=update
@@ -493,19 +1268,40 @@ class Dist2Src:
 
         This is the entrypoint method.
         """
-        if self.package_name in VERY_VERY_HARD_PACKAGES:
-            self.convert_single_commit(origin_branch, dest_branch)
-        elif self.source_git_path.exists() and self.source_git.has_ref(dest_branch):
-            logger.info(
-                "The source-git repository and branch exist. Updating existing source-git..."
-            )
-            self.update_source_git(origin_branch, dest_branch)
-        else:
-            self.perform_convert(
-                origin_branch,
-                dest_branch,
-                START_TAG_TEMPLATE.format(branch=dest_branch),
-            )
+        # objects reachable from these are in source-git already
+        present = self.source_git.refs.hexshas() if self.share_objects else set()
+        identity = (
+            self.dist_git.identity_env(origin_branch) if self.deterministic else {}
+        )
+        try:
+            with environment(identity):
+                if self.package_name in VERY_VERY_HARD_PACKAGES:
+                    self.convert_single_commit(origin_branch, dest_branch)
+                elif self.source_git_path.exists() and self.source_git.has_ref(
+                    dest_branch
+                ):
+                    logger.info(
+                        "The source-git repository and branch exist. "
+                        "Updating existing source-git..."
+                    )
+                    self.update_source_git(origin_branch, dest_branch)
+                else:
+                    self.perform_convert(
+                        origin_branch,
+                        dest_branch,
+                        START_TAG_TEMPLATE.format(branch=dest_branch),
+                    )
+        except Exception:
+            # also after a failure, the BUILD repo is going to be removed
+            if self.share_objects:
+                try:
+                    self.source_git.consolidate_objects(exclude=present)
+                except Exception as ex:
+                    # the failure of the conversion is the one to report
+                    logger.warning(f"Failed to copy the borrowed objects: {ex!r}")
+            raise
+        if self.share_objects:
+            self.source_git.consolidate_objects(exclude=present)
 
     def move_prep_content(self):
         """
@@ -537,7 +1333,7 @@ class Dist2Src:
 
         # if it's an update, we need to remove everything except for .git
         for path in self.source_git_path.iterdir():
-            if path.name == ".git":
+            if self.single_commit_in_index or path.name == ".git":
                 continue
             logger.debug(f"rm {path}")
             if path.is_dir():
@@ -548,27 +1344,44 @@ class Dist2Src:
         # expand dist-git and pull the history
         self.fetch_archive()
         self.run_prep(ensure_autosetup=False)
-        self.move_prep_content()
-
-        # configure packit
         source_git_tag = START_TAG_TEMPLATE.format(branch=dest_branch)
-        self.add_packit_config(upstream_ref=source_git_tag, commit=False)
-        self.copy_spec()
-        self.copy_all_sources(with_patches=True)
-        self.source_git.stage(add=".")
+        if not self.single_commit_in_index:
+            self.move_prep_content()
+
+            # configure packit
+            self.add_packit_config(upstream_ref=source_git_tag, commit=False)
+            self.copy_spec()
+            self.copy_all_sources(with_patches=True)
+            self.source_git.stage(add=".")
 
         try:
             commit_msg_suffix = (
-                subprocess.check_output(
-                    ["git", "describe", "--abbrev=0"], cwd=self.dist_git_path
+                run_git(
+                    ["git", "describe", "--abbrev=0"],
+                    cwd=self.dist_git_path,
+                    stdout=subprocess.PIPE,
+                    check=True,
                 )
-                .decode()
+                .stdout.decode()
                 .strip()
             )
         except subprocess.CalledProcessError:
             logger.error("couldn't obtain latest git-tag from the dist-git repo")
             commit_msg_suffix = self.package_name
-        self.source_git.commit(message=f"Source-git repo for {commit_msg_suffix}")
+        message = f"Source-git repo for {commit_msg_suffix}"
+        if self.single_commit_in_index:
+            # what the files moved and copied to the working tree above
+            # would be: the %prep tree, the spec, sources and packit config
+            overlay: Dict[str, Union[Path, str]] = {
+                ".packit.yaml": self.packit_config(upstream_ref=source_git_tag),
+                self.relative_specfile_path: self.dist_git_path
+                / self.relative_specfile_path,
+            }
+            for source in self.sources(with_patches=True):
+                overlay[f"SPECS/{Path(source).name}"] = Path(source)
+            self.source_git.commit_directory(self.BUILD_repo_path, message, overlay)
+        else:
+            self.source_git.commit(message=message)
 
         # mark the last upstream commit
         self.source_git.create_tag(tag=source_git_tag, branch=dest_branch)
@@ -578,6 +1391,15 @@ class Dist2Src:
         Add packit config to the source-git repo.
         """
         logger.info("Placing .packit.yaml to the source-git repo and committing it.")
+        self.source_git_path.joinpath(".packit.yaml").write_text(
+            self.packit_config(upstream_ref)
+        )
+        if commit:
+            self.source_git.stage(add=".packit.yaml")
+            self.source_git.commit(message=".packit.yaml")
+
+    def packit_config(self, upstream_ref: str) -> str:
+        """ content of .packit.yaml """
         config = {
             # e.g. qemu-kvm ships "some" spec file in their tarball
             # packit doesn't need to look for the spec when we know where it is
@@ -596,10 +1418,7 @@ class Dist2Src:
                 },
             ],
         }
-        self.source_git_path.joinpath(".packit.yaml").write_text(dump(config))
-        if commit:
-            self.source_git.stage(add=".packit.yaml")
-            self.source_git.commit(message=".packit.yaml")
+        return dump(config)
 
     def copy_all_sources(self, with_patches: bool = False):
         """
@@ -611,15 +1430,20 @@ class Dist2Src:
         sg_path = self.source_git_path / "SPECS"
         logger.info(f"Copy all sources from {dg_path} to {sg_path}.")
 
-        sources = self.dist_git_spec.get_sources()[:]
-        if with_patches:
-            sources += (x.path for x in self.dist_git_spec.get_patches())
-
-        for source in sources:
+        for source in self.sources(with_patches):
             source_dest = sg_path / Path(source).name
             logger.debug(f"copying {source} to {source_dest}")
             shutil.copy2(source, source_dest)
 
+    def sources(self, with_patches: bool = False) -> List[str]:
+        """
+        Paths of the sources (and patches) defined in the dist-git spec file.
+        """
+        sources = self.dist_git_spec.get_sources()[:]
+        if with_patches:
+            sources += (x.path for x in self.dist_git_spec.get_patches())
+        return sources
+
     def copy_conditional_patches(self):
         """
         for patches which are applied in conditions
@@ -631,11 +1455,13 @@ class Dist2Src:
         """
         patch_files_in_commits: Set[str] = set()
 
-        BUILD_git = git.Repo(self.BUILD_repo_path)
-        for commit in BUILD_git.iter_commits():
-            p = PatchMetadata.from_commit(commit, None)
-            if p.present_in_specfile:  # base commit doesn't have any metadata
-                patch_files_in_commits.add(p.name)
+        for commit in self.BUILD_commits:
+            # parsing the metadata is costly, skip messages which can't have it
+            if "present_in_specfile" not in commit.message:
+                continue
+            metadata = get_metadata_from_message(commit) or {}
+            if metadata.get("present_in_specfile"):
+                patch_files_in_commits.add(metadata.get("patch_name"))
 
         all_defined_patches = set(
             x.get_patch_name() for x in self.dist_git_spec.get_patches()
@@ -672,18 +1498,33 @@ class Dist2Src:
         logger.info(f"Rebase patches from {from_branch} onto {to_branch}.")
 
         self.source_git.checkout(to_branch)
-        commits_to_cherry_pick = [
-            c.hexsha[:8]  # shorter format for better readability in case of an error
-            for c in self.source_git.repo.iter_commits(from_branch)
-        ][-2::-1]
-        if commits_to_cherry_pick:
-            self.source_git.repo.git.cherry_pick(
-                *commits_to_cherry_pick,
-                keep_redundant_commits=True,
-                allow_empty=True,
-                strategy_option="theirs",
-            )
+        # the branch is usually what was fetched from the BUILD repo
+        if self._BUILD_commits and self._BUILD_commits[
+            0
+        ].hexsha == self.source_git.plumbing.resolve(from_branch):
+            hexshas = [commit.hexsha for commit in self._BUILD_commits]
+        else:
+            hexshas = self.source_git.plumbing.rev_list(from_branch)
+        # the commits are replayed in the object database only,
+        # the working tree is updated once at the end
+        tip = self.source_git.plumbing.resolve("HEAD")
+        for hexsha in hexshas[-2::-1]:
+            picked = self.source_git.pick_in_index(hexsha, onto=tip)
+            if not picked:
+                self.source_git.repo.git.reset("--hard", tip)
+                self.source_git.repo.git.cherry_pick(
+                    hexsha[
+                        :8
+                    ],  # shorter format for better readability in case of an error
+                    keep_redundant_commits=True,
+                    allow_empty=True,
+                    strategy_option="theirs",
+                )
+                picked = self.source_git.plumbing.resolve("HEAD")
+            tip = picked
+        self.source_git.repo.git.reset("--hard", tip)
         self.source_git.repo.git.branch("-D", from_branch)
+        self.source_git.invalidate_refs()
 
     def update_source_git(self, origin_branch: str, dest_branch: str):
         """
@@ -703,7 +1544,7 @@ class Dist2Src:
         new_dest_branch = (
             dg_tags_for_head[0]
             if dg_tags_for_head
-            else f"{dest_branch}-{self.dist_git.repo.head.commit.hexsha:.8}"
+            else f"{dest_branch}-{self.dist_git.plumbing.resolve('HEAD'):.8}"
         )
         self.source_git.checkout(dest_branch)
         self.source_git.checkout(branch=new_dest_branch, create_branch=True)
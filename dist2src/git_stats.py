@@ -0,0 +1,194 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+"""
+Where the time of a conversion goes: every git command run through
+GitPython, run_git() or by the processes started by rpmbuild
+(packitpatch, the %__scm macros) is recorded by the active GitStats.
+"""
+
+import json
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import git
+
+logger = getLogger(__name__)
+
+# options of git itself, which take a value
+_GIT_OPTIONS_WITH_VALUE = {"-c", "-C", "--git-dir", "--work-tree", "--namespace"}
+
+
+def command_name(args: Sequence) -> str:
+    """ the git subcommand, e.g. 'add' for 'git -c x=y add -f .' """
+    args = [str(arg) for arg in args]
+    i = 1
+    while i < len(args):
+        if args[i] in _GIT_OPTIONS_WITH_VALUE:
+            i += 2
+        elif args[i].startswith("-"):
+            i += 1
+        else:
+            return args[i]
+    return "git"
+
+
+class CommandStats(NamedTuple):
+    calls: int
+    failures: int
+    seconds: float
+    output_bytes: int
+
+
+class GitStats:
+    """
+    Collects the git commands run while it's active:
+
+        with GitStats() as stats:
+            ...
+        logger.info(stats.summary())
+
+    Collectors can be nested, a command is recorded by all the active ones
+    entered by the thread which ran it.
+    """
+
+    _active: List["GitStats"] = []
+
+    def __init__(self):
+        self.commands: Dict[str, CommandStats] = defaultdict(
+            lambda: CommandStats(0, 0, 0.0, 0)
+        )
+        self.thread: Optional[int] = None
+
+    def __enter__(self) -> "GitStats":
+        _install_hook()
+        self.thread = threading.get_ident()
+        GitStats._active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        GitStats._active.remove(self)
+
+    @classmethod
+    def active(cls) -> bool:
+        return bool(cls._active)
+
+    @classmethod
+    def record(cls, name: str, seconds: float, status: int, output_bytes: int = 0):
+        """ record a command in all the active collectors of the thread """
+        thread = threading.get_ident()
+        for stats in [stats for stats in cls._active if stats.thread == thread]:
+            calls, failures, total, size = stats.commands[name]
+            stats.commands[name] = CommandStats(
+                calls + 1,
+                failures + (status != 0),
+                total + seconds,
+                size + output_bytes,
+            )
+
+    @classmethod
+    def record_trace2(cls, path: Path):
+        """
+        Record the commands from a GIT_TRACE2_EVENT file,
+        written by the git processes which were given that variable.
+        """
+        if not path.is_file():
+            # git < 2.22 doesn't know trace2
+            return
+        names: Dict[str, str] = {}
+        for line in path.read_text().splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if "/" in event.get("sid", ""):
+                # started by another git command, which is recorded already
+                continue
+            if event.get("event") == "cmd_name":
+                names[event["sid"]] = event["name"]
+            elif event.get("event") == "exit":
+                cls.record(
+                    names.get(event["sid"], "git"),
+                    event.get("t_abs", 0.0),
+                    event.get("code", 0),
+                )
+
+    def total_seconds(self) -> float:
+        return sum(stats.seconds for stats in self.commands.values())
+
+    def summary(self) -> str:
+        """ a table of the commands, the most time consuming first """
+        lines = [
+            f"{'git command':<20} {'count':>6} {'failed':>6} {'seconds':>9} {'output':>12}"
+        ]
+        for name, stats in sorted(
+            self.commands.items(), key=lambda item: item[1].seconds, reverse=True
+        ):
+            lines.append(
+                f"{name:<20} {stats.calls:>6} {stats.failures:>6} "
+                f"{stats.seconds:>9.2f} {stats.output_bytes:>12}"
+            )
+        return "\n".join(lines)
+
+
+def run_git(args: Sequence, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run() for git commands, recorded by the active GitStats
+
+    @param args: the command, starting with 'git'
+    """
+    start = time.monotonic()
+    status = -1
+    output: Optional[bytes] = None
+    try:
+        process = subprocess.run(args, **kwargs)
+        status, output = process.returncode, process.stdout
+        return process
+    except subprocess.CalledProcessError as ex:
+        status, output = ex.returncode, ex.output
+        raise
+    finally:
+        GitStats.record(
+            command_name(args),
+            time.monotonic() - start,
+            status,
+            len(output) if output else 0,
+        )
+
+
+def _install_hook():
+    """ wrap the method all the GitPython commands go through, once """
+    execute = git.cmd.Git.execute
+    if getattr(execute, "records_git_stats", False):
+        return
+
+    def recorded_execute(self, command, *args, **kwargs):
+        if not GitStats.active() or kwargs.get("as_process"):
+            # long-running processes (e.g. cat-file --batch) are not timed
+            return execute(self, command, *args, **kwargs)
+        start = time.monotonic()
+        status = 0
+        output = None
+        try:
+            output = execute(self, command, *args, **kwargs)
+            return output
+        except git.GitCommandError as ex:
+            status = ex.status if isinstance(ex.status, int) else -1
+            raise
+        finally:
+            if isinstance(output, tuple):  # with_extended_output
+                status, output = output[0], output[1]
+            GitStats.record(
+                command_name(command) if isinstance(command, list) else "git",
+                time.monotonic() - start,
+                status,
+                len(output) if isinstance(output, (str, bytes)) else 0,
+            )
+
+    recorded_execute.records_git_stats = True
+    git.cmd.Git.execute = recorded_execute
@@ -0,0 +1,345 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+"""
+Commits the patches applied by packitpatch during %prep, instead of
+'git add -f . && git commit' run for each of them.
+
+rpmbuild is run with PACKIT_PATCH_ENGINE set to a directory with two FIFOs:
+packitpatch applies the patch, writes the request for the commit
+to 'request' and reads the result from 'reply'. The engine streams the commits
+to a 'git fast-import' process, one for each repository, kept running
+for the whole %prep. With PACKIT_PATCH_STAGING=patched, the request lists
+the files the patch touched and only those are read, otherwise the engine
+looks for the changes in the whole tree.
+
+The refs and the index of the repositories are updated when the engine
+is closed, %prep must not rely on HEAD moving after each patch
+(e.g. by mixing %patch with 'git am').
+"""
+
+import errno
+import hashlib
+import os
+import re
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = getLogger(__name__)
+
+# the patch ID is not set by %__patch, rpm leaves the macro unexpanded
+NO_PATCH_ID = "%{2}"
+NO_PREFIX = re.compile(r"[-]p0|[-]p 0")
+
+# mode and hash of the content of a file, None if it does not exist
+FileState = Optional[Tuple[str, str]]
+
+
+def commit_message(patch_name: str, patch_id: str, patch_args: List[str]) -> str:
+    """ the message packitpatch gives the commit of a patch """
+    lines = [
+        f"Apply patch {patch_name}",
+        "",
+        f"patch_name: {patch_name}",
+        "present_in_specfile: true",
+    ]
+    # when patches are applied with -p0, we need to strip the prefix
+    # in packit when creating the patch files
+    if NO_PREFIX.search(" ".join(patch_args)):
+        lines.append("no_prefix: true")
+    if patch_id != NO_PATCH_ID:
+        lines.append(f"location_in_specfile: {patch_id}")
+    return "\n".join(lines) + "\n"
+
+
+def _quote(path: str) -> str:
+    # fast-import wants paths with special characters C-style quoted
+    if not re.search(r'[\\"\n]', path) and not path.startswith('"'):
+        return path
+    escaped = path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _read(path: Path) -> Tuple[FileState, bytes]:
+    """ the state of the file and its content """
+    try:
+        info = path.lstat()
+    except FileNotFoundError:
+        return None, b""
+    if stat.S_ISLNK(info.st_mode):
+        mode, content = "120000", os.fsencode(os.readlink(path))
+    elif stat.S_ISREG(info.st_mode):
+        mode = "100755" if info.st_mode & stat.S_IXUSR else "100644"
+        content = path.read_bytes()
+    else:
+        # e.g. a directory which replaced a file, its files are listed
+        return None, b""
+    return (mode, hashlib.sha1(content).hexdigest()), content
+
+
+class FastImport:
+    """ the commits of one repository, streamed to 'git fast-import' """
+
+    def __init__(self, repo_path: Path, env: Dict[str, str]):
+        self.repo_path = repo_path
+        self.env = env
+        self.branch = self._git("symbolic-ref", "HEAD").strip()
+        self.parent: Optional[str] = self._git("rev-parse", "HEAD").strip()
+        # 'Name <email> 1600000000 +0000', as git commit would use
+        self.idents = {
+            who: self._git("var", f"GIT_{who.upper()}_IDENT").strip()
+            for who in ("author", "committer")
+        }
+        # what the engine committed, the other files are as in the parent
+        self.committed: Dict[str, FileState] = {}
+        self.marks = 0
+        self.process = subprocess.Popen(
+            ["git", "fast-import", "--quiet", "--done"],
+            cwd=repo_path,
+            env=env,
+            stdin=subprocess.PIPE,
+        )
+
+    def _git(self, *args: str) -> str:
+        return subprocess.run(
+            ["git", *args],
+            cwd=self.repo_path,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.decode(errors="surrogateescape")
+
+    def ident(self, who: str) -> str:
+        """ e.g. 'author Name <email> 1600000000 +0000', at the current time """
+        name_email, timestamp, timezone = self.idents[who].rsplit(" ", 2)
+        if f"GIT_{who.upper()}_DATE" not in self.env:
+            timestamp = str(int(time.time()))
+        return f"{who} {name_email} {timestamp} {timezone}"
+
+    def changes(
+        self, paths: Optional[List[str]] = None
+    ) -> Dict[str, Tuple[FileState, bytes]]:
+        """
+        files which are not as the engine committed them the last time
+
+        @param paths: the files the patch touched, relative to the repo,
+            the whole tree is checked if not known
+        """
+        if paths is not None:
+            # not compared with the parent, committing a file again is a no-op
+            return {path: _read(self.repo_path / path) for path in paths}
+        # the index is not updated by fast-import, these are the files
+        # which are not as they were before the first commit of the engine
+        status = self._git(
+            "status",
+            "--porcelain",
+            "-z",
+            "--untracked-files=all",
+            "--ignored=traditional",
+            "--no-renames",
+        )
+        listed = {
+            entry[3:] for entry in status.split("\0") if entry and entry[-1] != "/"
+        }
+        changes = {}
+        for path in listed | set(self.committed):
+            state, content = _read(self.repo_path / path)
+            if path in self.committed:
+                before = self.committed[path]
+            elif path in listed:
+                before = ("", "")  # something else than in the parent
+            else:
+                continue
+            if state != before:
+                changes[path] = (state, content)
+        return changes
+
+    def commit(self, message: str, paths: Optional[List[str]] = None):
+        self.marks += 1
+        stream = [
+            f"commit {self.branch}".encode(),
+            f"mark :{self.marks}".encode(),
+            self.ident("author").encode(),
+            self.ident("committer").encode(),
+            f"data {len(message.encode())}".encode(),
+            message.encode(),
+        ]
+        if self.parent:
+            stream.append(f"from {self.parent}".encode())
+            self.parent = None
+        # deletions first, a file could replace a directory
+        for path, (state, content) in sorted(
+            self.changes(paths).items(),
+            key=lambda item: (item[1][0] is not None, item[0]),
+        ):
+            quoted = _quote(path).encode(errors="surrogateescape")
+            if state is None:
+                stream.append(b"D " + quoted)
+            else:
+                stream.append(f"M {state[0]} inline ".encode() + quoted)
+                stream.append(f"data {len(content)}".encode())
+                stream.append(content)
+            self.committed[path] = state
+        self.process.stdin.write(b"\n".join(stream) + b"\n\n")
+        self.process.stdin.flush()
+
+    def finish(self):
+        """ write the objects and refs, make the index match the new HEAD """
+        self.process.stdin.write(b"done\n")
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"git fast-import failed in {self.repo_path}")
+        self._git("reset", "-q")
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class PatchEngine:
+    """
+    Serves the commit requests of packitpatch, for one rpmbuild run:
+
+        with PatchEngine(env) as engine:
+            rpmbuild(..., _env={**env, **engine.env()})
+    """
+
+    def __init__(self, env: Optional[Dict[str, str]] = None):
+        """
+        @param env: environment of the git commands, e.g. the one of rpmbuild
+        """
+        self.git_env = env or dict(os.environ)
+        self._dir = tempfile.TemporaryDirectory(prefix="packitpatch-")
+        self.request = Path(self._dir.name) / "request"
+        self.reply = Path(self._dir.name) / "reply"
+        os.mkfifo(self.request)
+        os.mkfifo(self.reply)
+        self.repos: Dict[Path, FastImport] = {}
+        self.commits = 0
+        self.seconds = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self.closed = False
+
+    def env(self) -> Dict[str, str]:
+        """ environment which makes packitpatch use the engine """
+        return {"PACKIT_PATCH_ENGINE": self._dir.name}
+
+    def __enter__(self) -> "PatchEngine":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._serve, name="patch-engine", daemon=True
+        )
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            with open(self.request, "rb") as request:
+                fields = request.read().split(b"\0")
+            if fields == [b"stop"]:
+                return
+            try:
+                # the arguments of patch are followed by 'patched'
+                # and the files the patch touched, or by 'all'
+                repo_path, patch_name, patch_id, count, *rest = (
+                    field.decode(errors="surrogateescape") for field in fields[:-1]
+                )
+                scope, *patched_paths = rest[int(count) :]
+                self.commit(
+                    Path(repo_path),
+                    patch_name,
+                    patch_id,
+                    rest[: int(count)],
+                    patched_paths if scope == "patched" else None,
+                )
+                reply = "ok"
+            except Exception as ex:
+                logger.error(f"Failed to commit a patch: {ex!r}")
+                reply = f"error: {ex!r}"
+            try:
+                # packitpatch opened it before sending the request
+                fd = os.open(self.reply, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as ex:
+                if ex.errno != errno.ENXIO:
+                    raise
+                logger.warning("packitpatch is not waiting for the reply anymore.")
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{reply}\n")
+
+    def commit(
+        self,
+        repo_path: Path,
+        patch_name: str,
+        patch_id: str,
+        patch_args: List[str],
+        patched_paths: Optional[List[str]] = None,
+    ):
+        """
+        commit the changes in the repository, for the patch just applied
+
+        @param patched_paths: files the patch touched, relative to the repo,
+            None if the whole tree has to be checked
+        """
+        start = time.monotonic()
+        if repo_path not in self.repos:
+            self.repos[repo_path] = FastImport(repo_path, self.git_env)
+        if patched_paths and any(
+            os.path.normpath(path).startswith(("..", "/")) for path in patched_paths
+        ):
+            patched_paths = None
+        self.repos[repo_path].commit(
+            commit_message(patch_name, patch_id, patch_args), patched_paths
+        )
+        self.commits += 1
+        self.seconds += time.monotonic() - start
+
+    def _stop(self):
+        if self._thread and self._thread.is_alive():
+            with open(self.request, "wb") as request:
+                request.write(b"stop")
+            self._thread.join()
+        self._thread = None
+
+    def close(self):
+        """ stop serving, create the commits in the repositories """
+        if self.closed:
+            return
+        self._stop()
+        try:
+            for importer in self.repos.values():
+                importer.finish()
+            logger.debug(
+                f"{self.commits} patches committed in {self.seconds:.2f}s "
+                f"to {len(self.repos)} repos."
+            )
+        finally:
+            self._cleanup()
+
+    def abort(self):
+        """ stop serving, the commits are not created; no-op once closed """
+        if self.closed:
+            return
+        self._stop()
+        for importer in self.repos.values():
+            importer.kill()
+        self._cleanup()
+
+    def _cleanup(self):
+        self.repos.clear()
+        self._dir.cleanup()
+        self.closed = True
@@ -0,0 +1,483 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+from logging import getLogger
+from pathlib import Path
+from typing import Iterable, List, Optional, cast
+
+import git
+from git import GitCommandError
+
+from dist2src.base_cache import get_size
+from dist2src.git_stats import run_git
+
+logger = getLogger(__name__)
+
+# How much of a repository is downloaded:
+# full - everything, like 'git clone'
+# blobless - all the commits and trees, file contents are fetched on demand
+# single-branch - blobless, only the branch being converted (and its tags)
+# shallow - single-branch, only the tip of the branch
+CLONE_STRATEGIES = ("full", "blobless", "single-branch", "shallow")
+
+
+def alternates_of(git_dir: Path) -> List[str]:
+    """ object directories the repository borrows objects from """
+    alternates = git_dir / "objects" / "info" / "alternates"
+    if not alternates.exists():
+        return []
+    return alternates.read_text().splitlines()
+
+
+class ObjectPool:
+    """
+    A bare repository with the objects of all the cached repositories,
+    which use it as an alternate, so that objects shared by packages
+    and branches are stored only once.
+
+    Each member repository has its refs copied under
+    'refs/pool/<member>/', which keeps its objects in the pool until
+    the member leaves it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @property
+    def objects_dir(self) -> str:
+        return str(self.path / "objects")
+
+    def _open(self) -> git.Repo:
+        if self.path.is_dir():
+            return git.Repo(self.path)
+        pool = git.Repo.init(self.path, bare=True)
+        # the pool is only cleaned up when a member leaves
+        pool.git.config("gc.auto", "0")
+        return pool
+
+    def join(self, repo_path: Path, member: str):
+        """
+        Move the objects of a repository to the pool.
+
+        @param repo_path: path of the repository
+        @param member: name of the member, unique in the pool
+        """
+        repo = git.Repo(repo_path)
+        try:
+            if repo.git.config("remote.origin.promisor", with_exceptions=False):
+                # a fetch from a partial clone would download the missing objects
+                logger.debug(f"{repo_path} is a partial clone, not using the pool.")
+                return
+            git_dir = Path(repo.git_dir)
+            if self.objects_dir not in alternates_of(git_dir):
+                with (git_dir / "objects" / "info" / "alternates").open("a") as f:
+                    f.write(f"{self.objects_dir}\n")
+            # objects only reachable from reflogs would not be kept by the pool
+            repo.git.config("core.logAllRefUpdates", "false")
+            repo.git.reflog("expire", "--expire=all", "--all")
+
+            pool = self._open()
+            logger.debug(f"Moving objects of {repo_path} to {self.path}...")
+            pool.git.fetch(
+                "--prune", "--no-tags", str(git_dir), f"+refs/*:refs/pool/{member}/*"
+            )
+            pool.close()
+            # keep only the objects which are not in the pool
+            repo.git.repack("-a", "-d", "-l", "-q")
+        finally:
+            repo.close()
+
+    def leave(self, members: Iterable[str], prune: bool = True):
+        """
+        Forget the refs of members and remove the objects no other member uses.
+
+        @param prune: remove the objects now, otherwise the next time
+                      members leave with 'prune'; a repository which did not
+                      join the pool yet can still need them
+        """
+        if not self.path.is_dir():
+            return
+        gc_pending = self.path / "gc-pending"
+        pool = git.Repo(self.path)
+        refs = [
+            ref
+            for member in members
+            for ref in pool.git.for_each_ref(
+                f"refs/pool/{member}/", format="%(refname)"
+            ).split()
+        ]
+        if refs:
+            run_git(
+                ["git", "update-ref", "--stdin"],
+                input="".join(f"delete {ref}\n" for ref in refs).encode(),
+                cwd=self.path,
+                check=True,
+            )
+            gc_pending.touch()
+        if prune and gc_pending.exists():
+            pool.git.gc("--prune=now", "--quiet")
+            gc_pending.unlink()
+        pool.close()
+
+
+class RepoCache:
+    """
+    Repositories kept on the worker volume between tasks.
+
+    The least recently used repositories are removed when the cache grows
+    over 'max_size' bytes.
+    'clone_strategy' is one of CLONE_STRATEGIES.
+    With a 'pool', the size of the pool counts into the size of the cache.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int,
+        clone_strategy: str = "full",
+        pool: Optional[ObjectPool] = None,
+    ):
+        if clone_strategy not in CLONE_STRATEGIES:
+            raise ValueError(f"Unknown clone strategy: {clone_strategy!r}")
+        self.path = path
+        self.max_size = max_size
+        self.clone_strategy = clone_strategy
+        self.pool = pool
+
+    @property
+    def single_branch(self) -> bool:
+        return self.clone_strategy in ("single-branch", "shallow")
+
+    @property
+    def object_filter(self) -> Optional[str]:
+        """ filter of clone which limits the objects downloaded, if any """
+        return None if self.clone_strategy == "full" else "blob:none"
+
+    def repo_path(self, fullname: str) -> Path:
+        return self.path / fullname
+
+    def repos(self) -> List[Path]:
+        """ paths of all the cached repositories """
+        return [p.parent for p in self.path.glob("**/.git")]
+
+    def touch(self, fullname: str):
+        """ mark the repository as used right now """
+        os.utime(self.repo_path(fullname))
+
+    def pool_member(self, path: Path) -> str:
+        """ name of a cached repository in the object pool """
+        member = path.relative_to(self.path.parent).as_posix()
+        return member[: -len(".git")] if member.endswith(".git") else member
+
+    @staticmethod
+    def _unshared_marker(path: Path) -> Path:
+        git_dir = path / ".git"
+        return (git_dir if git_dir.is_dir() else path) / "d2s-unshared"
+
+    def share(self, fullname: str, later: bool = False):
+        """
+        Move the objects of a cached repository to the pool, if any.
+
+        @param later: the repository can't be touched now, e.g. it's being
+                      pushed, it's shared by share_deferred() afterwards
+        """
+        path = self.repo_path(fullname)
+        if self.pool is None or not path.is_dir():
+            return
+        marker = self._unshared_marker(path)
+        if later:
+            marker.touch()
+            return
+        self.pool.join(path, self.pool_member(path))
+        if marker.exists():
+            marker.unlink()
+
+    def share_deferred(self, exclude: Iterable[str] = ()):
+        """
+        Share the repositories share() was asked to share later.
+
+        @param exclude: names of repositories which still can't be touched
+        """
+        if self.pool is None:
+            return
+        exclude_paths = {self.repo_path(fullname) for fullname in exclude}
+        for path in self.repos():
+            if path not in exclude_paths and self._unshared_marker(path).exists():
+                self.share(path.relative_to(self.path).as_posix())
+
+    def evict(self, keep: Iterable[str] = (), prune: bool = True):
+        """
+        Remove the least recently used repositories until the cache fits into
+        'max_size'.
+
+        The most recently used repository is never removed.
+
+        @param keep: names of repositories which should not be removed
+        @param prune: see ObjectPool.leave()
+        """
+        if not self.path.is_dir():
+            return
+        keep_paths = {self.repo_path(fullname) for fullname in keep}
+        repos = sorted(self.repos(), key=lambda p: p.stat().st_mtime)
+        sizes = {p: get_size(p) for p in repos}
+        pool_size = get_size(self.pool.path) if self.pool else 0
+        total = sum(sizes.values()) + pool_size
+        logger.debug(f"{self.path} uses {total} bytes, the limit is {self.max_size}.")
+        for path in repos[:-1]:
+            if total <= self.max_size:
+                break
+            if path in keep_paths:
+                continue
+            logger.info(f"Evicting {path} ({sizes[path]} bytes).")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+            if self.pool:
+                self.pool.leave([self.pool_member(path)], prune=prune)
+                new_pool_size = get_size(self.pool.path)
+                total -= pool_size - new_pool_size
+                pool_size = new_pool_size
+
+
+class MirrorStore(RepoCache):
+    """
+    Bare mirrors of dist-git repositories.
+
+    Mirrors are updated with an incremental fetch and conversions get
+    a worktree of the mirror, so that the history of a repository is only
+    downloaded once.
+
+    With a single-branch strategy, the mirror is a bare repository which has
+    only the branches which were converted.
+    """
+
+    def repo_path(self, fullname: str) -> Path:
+        return self.path / f"{fullname}.git"
+
+    def repos(self) -> List[Path]:
+        return [p for p in self.path.glob("**/*.git") if p.is_dir()]
+
+    def update(self, fullname: str, url: str, branch: str) -> git.Repo:
+        """
+        Create or refresh the mirror of a repository.
+
+        A mirror which cannot be fetched into is considered to be corrupt
+        and is cloned again.
+
+        @param fullname: name of the repository, including the namespace
+        @param url: URL to fetch from
+        @param branch: branch which is going to be checked out
+        @return: the bare mirror
+        """
+        depth = 1 if self.clone_strategy == "shallow" else None
+        path = self.repo_path(fullname)
+        mirror = None
+        if path.is_dir():
+            try:
+                mirror = git.Repo(path)
+                # worktrees of previous conversions are gone, forget about them
+                # so that their branches can be updated by the fetch
+                mirror.git.worktree("prune")
+                logger.debug(f"Fetching {url} into {path}...")
+                if self.single_branch:
+                    mirror.git.fetch(
+                        "origin",
+                        f"+refs/heads/{branch}:refs/heads/{branch}",
+                        depth=depth,
+                    )
+                else:
+                    mirror.git.fetch("origin", prune=True)
+            except (GitCommandError, git.InvalidGitRepositoryError):
+                logger.warning(f"Mirror {path} is not usable, cloning it again.")
+                if mirror is not None:
+                    mirror.close()
+                    mirror = None
+                shutil.rmtree(path, ignore_errors=True)
+        if mirror is None:
+            logger.debug(f"Cloning {url} into {path}...")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if self.single_branch:
+                mirror = git.Repo.clone_from(
+                    url,
+                    path,
+                    bare=True,
+                    single_branch=True,
+                    branch=branch,
+                    filter=self.object_filter,
+                    depth=depth,
+                )
+            else:
+                mirror = git.Repo.clone_from(
+                    url, path, mirror=True, filter=self.object_filter
+                )
+        self.touch(fullname)
+        return mirror
+
+    def checkout(self, fullname: str, url: str, dest: Path, branch: str) -> git.Repo:
+        """
+        Get a working copy of 'branch' in 'dest', which shares the objects
+        with the mirror of the repository.
+
+        @param fullname: name of the repository, including the namespace
+        @param url: URL to fetch from
+        @param dest: path of the working copy
+        @param branch: branch to check out
+        @return: the working copy
+        """
+        mirror = self.update(fullname, url, branch)
+        mirror.git.worktree("add", "--force", str(dest), branch)
+        mirror.close()
+        return git.Repo(dest)
+
+
+class SourceGitCache(RepoCache):
+    """
+    Working copies of source-git repositories.
+
+    Before a working copy is reused, it's checked, fetched and reset to
+    the state of the remote, so that it looks like a fresh clone.
+    A fresh clone is only done when the working copy is missing or corrupt.
+
+    The history is needed to update the repository, so the shallow strategy
+    is the same as single-branch here.
+    """
+
+    def checkout(self, fullname: str, url: str, branch: str) -> git.Repo:
+        """
+        Get a working copy of a source-git repository.
+
+        'branch' is checked out if it exists in the remote, the default
+        branch otherwise.
+
+        @param fullname: name of the repository, including the namespace
+        @param url: URL to clone from and push to
+        @param branch: branch which is going to be converted
+        @return: the working copy
+        """
+        path = self.repo_path(fullname)
+        if path.is_dir():
+            repo = None
+            try:
+                repo = git.Repo(path)
+                self.refresh(repo, url, branch)
+                self.touch(fullname)
+                return repo
+            except (
+                GitCommandError,
+                git.InvalidGitRepositoryError,
+                IndexError,
+                RuntimeError,
+            ):
+                logger.warning(
+                    f"Cached source-git repo {path} is not usable, cloning it again.",
+                    exc_info=True,
+                )
+                if repo is not None:
+                    repo.close()
+                shutil.rmtree(path, ignore_errors=True)
+
+        logger.debug(f"Cloning {url} into {path}...")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.single_branch:
+            try:
+                repo = git.Repo.clone_from(
+                    url,
+                    path,
+                    single_branch=True,
+                    branch=branch,
+                    filter=self.object_filter,
+                )
+            except GitCommandError:
+                logger.debug(f"No {branch!r} in {url}, cloning the default branch.")
+                shutil.rmtree(path, ignore_errors=True)
+                repo = git.Repo.clone_from(
+                    url, path, single_branch=True, filter=self.object_filter
+                )
+        else:
+            repo = git.Repo.clone_from(url, path, filter=self.object_filter)
+            if branch in repo.remotes["origin"].refs:
+                repo.git.checkout(branch)
+        self.touch(fullname)
+        return repo
+
+    def refresh(self, repo: git.Repo, url: str, branch: str):
+        """
+        Fetch the changes from the remote and make the local branches and tags
+        look like in a fresh clone.
+
+        @raise RuntimeError: when the repository doesn't look sane
+        """
+        if repo.remotes["origin"].url != url:
+            raise RuntimeError(f"Remote URL is not {url!r}.")
+        # leftovers from a failed conversion
+        git_dir = Path(repo.git_dir)
+        pool_objects = self.pool.objects_dir if self.pool else None
+        if any(alt != pool_objects for alt in alternates_of(git_dir)):
+            raise RuntimeError("Objects borrowed from another repo were not copied.")
+        if (git_dir / "sequencer").exists() or (git_dir / "CHERRY_PICK_HEAD").exists():
+            repo.git.cherry_pick("--quit")
+        if self.single_branch:
+            start = self.fetch_single_branch(repo, branch)
+        else:
+            repo.git.fetch(
+                "origin",
+                "+refs/heads/*:refs/remotes/origin/*",
+                "+refs/tags/*:refs/tags/*",
+                prune=True,
+                force=True,
+            )
+            if branch in repo.remotes["origin"].refs:
+                start = f"origin/{branch}"
+            else:
+                try:
+                    start = repo.git.symbolic_ref(
+                        "refs/remotes/origin/HEAD", short=True
+                    )
+                except GitCommandError:
+                    # cloning an empty repo is cheap, no need to clean up
+                    raise RuntimeError("The remote repo has no default branch.")
+
+        # every object needed for the checkout has to be present
+        repo.git.cat_file("-e", f"{start}^{{tree}}")
+        local_branch = start.split("/", 1)[1]
+        repo.git.checkout("-B", local_branch, start, force=True)
+        for head in repo.heads:
+            if head.name != local_branch:
+                repo.git.branch("-D", head.name)
+        repo.git.reset("--hard")
+        repo.git.clean("-xdff")
+
+    @staticmethod
+    def fetch_single_branch(repo: git.Repo, branch: str) -> str:
+        """
+        Fetch 'branch' if it exists in the remote, the default branch otherwise.
+
+        Only the tags which point into the history of the fetched branch
+        are kept.
+
+        @return: the remote-tracking branch fetched
+        """
+        remote_refs = cast(
+            str,
+            repo.git.ls_remote("--symref", "origin", "HEAD", f"refs/heads/{branch}"),
+        )
+        if f"\trefs/heads/{branch}" in remote_refs:
+            fetched = branch
+        elif remote_refs.startswith("ref: refs/heads/"):
+            # ref: refs/heads/<default branch><TAB>HEAD
+            fetched = remote_refs.split("\t", 1)[0].split("/", 2)[2]
+        else:
+            raise RuntimeError("The remote repo has no default branch.")
+
+        # tags are auto-followed by the fetch below
+        tags = [tag.name for tag in repo.tags]
+        if tags:
+            repo.git.tag("-d", *tags)
+        repo.git.fetch(
+            "origin",
+            f"+refs/heads/{fetched}:refs/remotes/origin/{fetched}",
+            prune=True,
+            force=True,
+        )
+        return f"origin/{fetched}"
@@ -4,11 +4,16 @@
 import os
 
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 from ogr import PagureService
 from requests.packages.urllib3.util import Retry
 
+from dist2src.worker.connections import SSHMultiplexer
+
 
 class Configuration:
+    _services: Dict[Tuple[str, Optional[str]], PagureService] = {}
+
     def __init__(self):
         self.workdir = Path(os.getenv("D2S_WORKDIR", "/workdir"))
         self.dist_git_host = os.getenv("D2S_DIST_GIT_HOST", "git.centos.org")
@@ -21,6 +26,45 @@ class Configuration:
         self.update_task_expires = os.getenv("D2S_UPDATE_TASK_EXPIRES")
         if self.update_task_expires is not None:
             self.update_task_expires = int(self.update_task_expires)
+        # persistent data (e.g. repository mirrors), not removed between tasks
+        self.cache_dir = Path(os.getenv("D2S_CACHE_DIR", self.workdir / "cache"))
+        self.mirror_max_size = int(os.getenv("D2S_MIRROR_MAX_SIZE", str(4 * 1024 ** 3)))
+        self.src_git_cache_max_size = int(
+            os.getenv("D2S_SRC_GIT_CACHE_MAX_SIZE", str(4 * 1024 ** 3))
+        )
+        # base commits of the %prep repos, reused for the same sources; 0 disables
+        self.base_cache_max_size = int(os.getenv("D2S_BASE_CACHE_MAX_SIZE", "0"))
+        # full, blobless, single-branch or shallow, see worker/cache.py
+        self.clone_strategy = os.getenv("D2S_CLONE_STRATEGY", "full")
+        # seconds the cached repos can be maintained for after each task,
+        # 0 disables the maintenance
+        self.maintenance_budget = float(os.getenv("D2S_MAINTENANCE_BUDGET", "0"))
+        # seconds an unused SSH connection is kept open for the next git command,
+        # 0 disables reusing them
+        self.ssh_control_persist = int(os.getenv("D2S_SSH_CONTROL_PERSIST", "600"))
+        # results pushed in the background at most, 0 pushes them in the task
+        self.push_queue_size = int(os.getenv("D2S_PUSH_QUEUE_SIZE", "0"))
+        self.push_attempts = int(os.getenv("D2S_PUSH_ATTEMPTS", "3"))
+        # seconds before the second attempt, doubled for each next one
+        self.push_backoff = float(os.getenv("D2S_PUSH_BACKOFF", "10"))
+        # seconds a worker process waits for the pushes when shutting down
+        self.push_shutdown_timeout = float(
+            os.getenv("D2S_PUSH_SHUTDOWN_TIMEOUT", "300")
+        )
+        # source-git borrows the objects of the %prep repo during the conversion
+        self.share_objects = os.getenv("D2S_SHARE_OBJECTS", "false").lower() == "true"
+        # cached repos store their objects in a pool shared by all of them
+        self.object_pool = os.getenv("D2S_OBJECT_POOL", "false").lower() == "true"
+        # single-commit repos are committed without moving the %prep tree
+        self.single_commit_in_index = (
+            os.getenv("D2S_SINGLE_COMMIT_IN_INDEX", "false").lower() == "true"
+        )
+        # commits are dated and authored like the converted dist-git commit
+        self.deterministic = os.getenv("D2S_DETERMINISTIC", "false").lower() == "true"
+        # patches applied in %prep are committed by the worker, see patch_engine.py
+        self.patch_engine = os.getenv("D2S_PATCH_ENGINE", "false").lower() == "true"
+        # the repos of the conversion use GIT_REPO_PROFILE, see constants.py
+        self.git_profile = os.getenv("D2S_GIT_PROFILE", "false").lower() == "true"
 
         self._src_git_svc = None
         self._dist_git_svc = None
@@ -31,21 +75,28 @@ class Configuration:
         )
 
     @property
-    def src_git_svc(self) -> PagureService:
-        if self._src_git_svc is None:
-            self._src_git_svc = PagureService(
-                instance_url=f"https://{self.src_git_host}",
-                token=self.src_git_token,
+    def ssh(self) -> SSHMultiplexer:
+        return SSHMultiplexer(self.cache_dir / "ssh", persist=self.ssh_control_persist)
+
+    def _service(self, host: str, token: Optional[str]) -> PagureService:
+        # shared by the tasks of the process, to reuse the HTTP connections
+        key = (host, token)
+        if key not in Configuration._services:
+            Configuration._services[key] = PagureService(
+                instance_url=f"https://{host}",
+                token=token,
                 max_retries=self._retries,
             )
+        return Configuration._services[key]
+
+    @property
+    def src_git_svc(self) -> PagureService:
+        if self._src_git_svc is None:
+            self._src_git_svc = self._service(self.src_git_host, self.src_git_token)
         return self._src_git_svc
 
     @property
     def dist_git_svc(self) -> PagureService:
         if self._dist_git_svc is None:
-            self._dist_git_svc = PagureService(
-                instance_url=f"https://{self.dist_git_host}",
-                token=self.dist_git_token,
-                max_retries=self._retries,
-            )
+            self._dist_git_svc = self._service(self.dist_git_host, self.dist_git_token)
         return self._dist_git_svc
@@ -0,0 +1,132 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import re
+import subprocess
+import tempfile
+import time
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+logger = getLogger(__name__)
+
+# seconds to wait for a master connection to be opened
+CONNECT_TIMEOUT = 60
+
+# ssh://[user@]host[:port]/path or the scp-like [user@]host:path
+SSH_URL = re.compile(
+    r"^(?:ssh://(?P<url_host>[^/:]+)(?::(?P<port>\d+))?/|(?P<scp_host>[^/:]+):(?!//))"
+)
+
+
+def ssh_destination(url: str) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    @return: [user@]host and port of an SSH URL, None for other URLs
+    """
+    match = SSH_URL.match(url)
+    if not match:
+        return None
+    return match["url_host"] or match["scp_host"], match["port"]
+
+
+class SSHMultiplexer:
+    """
+    Reuses SSH connections, across the git commands of a task and across tasks.
+
+    A master connection is kept open for each host, git commands talk
+    to the host through it, without a handshake of their own.
+    The masters are shared by all the worker processes.
+    """
+
+    def __init__(self, control_dir: Path, persist: int):
+        """
+        @param control_dir: where the sockets of the master connections are
+        @param persist: seconds an unused master connection is kept open,
+                        0 disables the reuse
+        """
+        self.control_dir = control_dir
+        self.persist = persist
+
+    @property
+    def enabled(self) -> bool:
+        return self.persist > 0
+
+    def ssh_options(self) -> Tuple[str, ...]:
+        return (
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_dir}/%C",
+            "-o",
+            f"ControlPersist={self.persist}",
+        )
+
+    def env(self) -> Dict[str, str]:
+        """ environment which makes git use the master connections """
+        if not self.enabled:
+            return {}
+        return {"GIT_SSH_COMMAND": " ".join(("ssh",) + self.ssh_options())}
+
+    def open(self, url: str) -> Optional[Tuple[bool, float]]:
+        """
+        Make sure a master connection to the host of the URL is open.
+
+        @return: whether an open master connection was reused and the seconds
+                 of the handshake (saved or spent), None for no master connection
+        """
+        destination = ssh_destination(url)
+        if not self.enabled or not destination:
+            return None
+        host, port = destination
+        options = [*self.ssh_options(), *(["-p", port] if port else []), host]
+        self.control_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # measured by the process which opened the master connection
+        handshake = self.control_dir / f"{host}_{port or 22}.handshake"
+        check = subprocess.run(["ssh", "-O", "check", *options], capture_output=True)
+        if check.returncode == 0:
+            try:
+                return True, float(handshake.read_text())
+            except (OSError, ValueError):
+                return True, 0.0
+
+        # not a pipe, the master in the background would keep it open
+        with tempfile.TemporaryFile() as stderr:
+            start = time.monotonic()
+            try:
+                # -f returns once the connection is authenticated, the master stays
+                returncode = subprocess.run(
+                    ["ssh", "-f", "-N", "-o", "BatchMode=yes", *options],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=stderr,
+                    timeout=CONNECT_TIMEOUT,
+                ).returncode
+            except subprocess.TimeoutExpired:
+                returncode = None
+            duration = time.monotonic() - start
+            if returncode != 0:
+                # git connects on its own then
+                stderr.seek(0)
+                logger.warning(
+                    f"Failed to open a master connection to {host}: "
+                    f"{stderr.read().decode(errors='replace') or 'timeout'}"
+                )
+                return None
+        handshake.write_text(str(duration))
+        logger.debug(f"Opened a master connection to {host} in {duration:.2f}s.")
+        return False, duration
+
+    def close(self):
+        """ close all the master connections """
+        if not self.control_dir.is_dir():
+            return
+        for socket in self.control_dir.iterdir():
+            if socket.suffix == ".handshake":
+                socket.unlink()
+            elif socket.is_socket():
+                # the host is not used, the socket identifies the master
+                subprocess.run(
+                    ["ssh", "-O", "exit", "-S", str(socket), "master"],
+                    capture_output=True,
+                )
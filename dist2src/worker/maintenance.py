@@ -0,0 +1,213 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import time
+from collections import Counter
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import git
+from git import GitCommandError
+
+logger = getLogger(__name__)
+
+
+class RepoHealth(NamedTuple):
+    """ what makes git slower as a cached repository is used over and over """
+
+    loose_objects: int
+    packs: int
+    refs: int
+    commit_graph: bool
+
+    @classmethod
+    def of(cls, repo: git.Repo, timeout: Optional[float] = None) -> "RepoHealth":
+        """
+        @param timeout: seconds the git commands can take, they are killed after
+        """
+        counts = dict(
+            line.split(": ", 1)
+            for line in repo.git.count_objects(
+                "-v", kill_after_timeout=timeout
+            ).splitlines()
+        )
+        refs = repo.git.for_each_ref(
+            format="%(refname)", kill_after_timeout=timeout
+        ).splitlines()
+        commit_graph = Path(repo.git_dir) / "objects" / "info" / "commit-graph"
+        commit_graphs = Path(repo.git_dir) / "objects" / "info" / "commit-graphs"
+        return cls(
+            loose_objects=int(counts["count"]),
+            packs=int(counts["packs"]),
+            refs=len(refs),
+            commit_graph=commit_graph.is_file() or commit_graphs.is_dir(),
+        )
+
+
+class Maintenance:
+    """
+    Keeps the cached repositories fast to work with, between tasks.
+
+    Loose objects are packed and too many packs are repacked into one,
+    a commit-graph is written and branches which are leftovers of previous
+    conversions are deleted.
+
+    The worst repositories are maintained first, no new step is started
+    after the time budget is spent and a step which takes longer is killed,
+    so that the next conversion is not delayed. Finding out how healthy
+    the repositories are counts into the budget as well.
+    """
+
+    def __init__(
+        self,
+        budget: float,
+        max_loose_objects: int = 1000,
+        max_packs: int = 20,
+        max_refs: int = 1000,
+    ):
+        """
+        @param budget: seconds maintenance may take each time it's run
+        @param max_loose_objects: loose objects are packed above this
+        @param max_packs: all the packs are repacked into one above this
+        @param max_refs: refs are packed above this
+        """
+        self.budget = budget
+        self.max_loose_objects = max_loose_objects
+        self.max_packs = max_packs
+        self.max_refs = max_refs
+
+    def badness(self, health: RepoHealth) -> float:
+        """ how much the repository needs maintenance, 0 if it doesn't """
+        score = sum(
+            value / limit
+            for value, limit in (
+                (health.loose_objects, self.max_loose_objects),
+                (health.packs, self.max_packs),
+                (health.refs, self.max_refs),
+            )
+            if value > limit
+        )
+        return score if health.commit_graph else score + 0.5
+
+    def run(self, paths: Iterable[Path]) -> Dict[str, int]:
+        """
+        Maintain the repositories, as long as the budget allows.
+
+        @param paths: paths of the repositories
+        @return: how many times each step was done
+        """
+        deadline = time.monotonic() + self.budget
+        done: Dict[str, int] = Counter()
+        queue = []
+        for path in paths:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.info("Maintenance budget spent on checking the repositories.")
+                break
+            try:
+                with git.Repo(path) as repo:
+                    health = RepoHealth.of(repo, timeout=remaining)
+            except (
+                git.InvalidGitRepositoryError,
+                git.NoSuchPathError,
+                GitCommandError,
+            ) as ex:
+                logger.debug(f"Skipping maintenance of {path}: {ex}")
+                continue
+            queue.append((self.badness(health), path, health))
+        # the worst first, stale branches are looked for in all of them
+        queue.sort(key=lambda item: item[0], reverse=True)
+
+        for _, path, health in queue:
+            with git.Repo(path) as repo:
+                for step in self.steps(repo, health):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        logger.info("Maintenance budget spent.")
+                        return done
+                    try:
+                        if step(repo, timeout=remaining):
+                            done[step.__name__] += 1
+                    except GitCommandError as ex:
+                        # also when killed after the timeout
+                        logger.warning(f"{step.__name__} of {path} failed: {ex}")
+                        break
+        return done
+
+    def steps(self, repo: git.Repo, health: RepoHealth) -> List[Callable[..., bool]]:
+        """ what the repository needs, in the order it's done """
+        steps = [self.prune_branches]
+        if health.refs > self.max_refs:
+            steps.append(self.pack_refs)
+        if health.packs > self.max_packs:
+            steps.append(self.repack_all)
+        elif health.loose_objects > self.max_loose_objects:
+            steps.append(self.repack_loose)
+        if len(steps) > 1 or not health.commit_graph:
+            steps.append(self.write_commit_graph)
+        return steps
+
+    @staticmethod
+    def prune_branches(repo: git.Repo, timeout: Optional[float] = None) -> bool:
+        """
+        Delete local branches which are not checked out and not in the remote,
+        e.g. 'updates' or the per-update branches of the update path.
+
+        Branches of bare mirrors are what the remote has, they are kept.
+        """
+        if repo.bare:
+            return False
+        worktrees = repo.git.worktree("list", "--porcelain").splitlines()
+        checked_out = {
+            line.split(" ", 1)[1] for line in worktrees if line.startswith("branch ")
+        }
+        refs = repo.git.for_each_ref(
+            "refs/heads/", "refs/remotes/origin/", format="%(refname)"
+        ).splitlines()
+        remote = {
+            ref.split("/", 3)[3] for ref in refs if ref.startswith("refs/remotes/")
+        }
+        stale = [
+            ref
+            for ref in refs
+            if ref.startswith("refs/heads/")
+            and ref not in checked_out
+            and ref.split("/", 2)[2] not in remote
+        ]
+        if not stale:
+            return False
+        logger.info(f"Deleting stale branches of {repo.working_dir}: {stale}")
+        for ref in stale:
+            repo.git.update_ref("-d", ref, kill_after_timeout=timeout)
+        return True
+
+    @staticmethod
+    def pack_refs(repo: git.Repo, timeout: Optional[float] = None) -> bool:
+        repo.git.pack_refs("--all", "--prune", kill_after_timeout=timeout)
+        return True
+
+    @staticmethod
+    def repack_loose(repo: git.Repo, timeout: Optional[float] = None) -> bool:
+        """ pack the loose objects into a new pack, the old packs are kept """
+        repo.git.repack("-d", "-l", "-q", kill_after_timeout=timeout)
+        repo.git.prune_packed(kill_after_timeout=timeout)
+        return True
+
+    @staticmethod
+    def repack_all(repo: git.Repo, timeout: Optional[float] = None) -> bool:
+        """
+        Repack everything into a single pack, with a bitmap if the repo
+        has all its objects (it's not a partial clone and doesn't borrow
+        them from the object pool).
+        """
+        alternates = Path(repo.git_dir) / "objects" / "info" / "alternates"
+        partial = repo.git.config("remote.origin.promisor", with_exceptions=False)
+        bitmap = [] if alternates.exists() or partial else ["--write-bitmap-index"]
+        repo.git.repack("-a", "-d", "-l", "-q", *bitmap, kill_after_timeout=timeout)
+        return True
+
+    @staticmethod
+    def write_commit_graph(repo: git.Repo, timeout: Optional[float] = None) -> bool:
+        repo.git.commit_graph("write", "--reachable", kill_after_timeout=timeout)
+        return True
@@ -1,7 +1,10 @@
 import logging
 import os
+from typing import Dict
 
-from prometheus_client import CollectorRegistry, Counter, push_to_gateway
+from prometheus_client import CollectorRegistry, Counter, Gauge, push_to_gateway
+
+from dist2src.git_stats import CommandStats
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +34,51 @@ class Pushgateway:
             registry=self.registry,
         )
 
+        self.skipped_pushes = Counter(
+            "skipped_pushes",
+            "Number of updates not pushed, as source-git was up to date",
+            registry=self.registry,
+        )
+
+        self.pushed_refs = Counter(
+            "pushed_refs",
+            "Number of refs updated in source-git",
+            registry=self.registry,
+        )
+
+        self.pushed_bytes = Counter(
+            "pushed_bytes",
+            "Bytes of objects pushed to source-git",
+            registry=self.registry,
+        )
+
+        self.ssh_connections = Counter(
+            "ssh_connections",
+            "Number of SSH master connections opened or reused by tasks",
+            ["result"],
+            registry=self.registry,
+        )
+
+        self.ssh_handshake_seconds = Counter(
+            "ssh_handshake_seconds",
+            "Seconds of SSH handshakes spent opening or saved reusing connections",
+            ["result"],
+            registry=self.registry,
+        )
+
+        self.failed_pushes = Counter(
+            "failed_pushes",
+            "Number of updates which failed to be pushed to source-git",
+            registry=self.registry,
+        )
+
+        self.patch_cache_lookups = Counter(
+            "patch_cache_lookups",
+            "Number of patches applied by %prep found in the cache, or not",
+            ["result"],
+            registry=self.registry,
+        )
+
         self.found_missing_dist_git_repo = Counter(
             "found_missing_dist_git_repo",
             "Number of dist-git repositories found missing by the scheduled updater.",
@@ -43,6 +91,54 @@ class Pushgateway:
             registry=self.registry,
         )
 
+        self.conversion_duration = Gauge(
+            "conversion_duration_seconds",
+            "Time spent updating a source-git repo, "
+            "'warm' if the repos were cached already.",
+            ["cache"],
+            registry=self.registry,
+        )
+
+        self.maintenance_steps = Counter(
+            "maintenance_steps",
+            "Number of maintenance steps done on the cached repositories.",
+            ["step"],
+            registry=self.registry,
+        )
+
+        self.maintenance_duration = Gauge(
+            "maintenance_duration_seconds",
+            "Time spent maintaining the cached repositories after a task.",
+            registry=self.registry,
+        )
+
+        self.git_commands = Counter(
+            "git_commands",
+            "Number of git commands run by conversions.",
+            ["command", "result"],
+            registry=self.registry,
+        )
+
+        self.git_command_duration = Counter(
+            "git_command_duration_seconds",
+            "Time spent in git commands by conversions.",
+            ["command"],
+            registry=self.registry,
+        )
+
+        self.git_command_output = Counter(
+            "git_command_output_bytes",
+            "Bytes of output of git commands run by conversions.",
+            ["command"],
+            registry=self.registry,
+        )
+
+        self.worker_volume_size = Gauge(
+            "worker_volume_bytes",
+            "Number of bytes used on the worker volume.",
+            registry=self.registry,
+        )
+
     def push(self):
         """
         Push collected metrics to Pushgateway
@@ -64,6 +160,45 @@ class Pushgateway:
         self.created_updates.inc()
         self.push()
 
+    def push_skipped_push(self):
+        """
+        Push info about an update which was the same as source-git to Pushgateway
+        :return:
+        """
+        self.skipped_pushes.inc()
+        self.push()
+
+    def push_pushed_refs(self, refs: int, size: int):
+        """
+        Push info about a push to source-git to Pushgateway
+        :param refs: number of refs updated
+        :param size: bytes of objects sent
+        :return:
+        """
+        self.pushed_refs.inc(refs)
+        self.pushed_bytes.inc(size)
+        self.push()
+
+    def push_ssh_connection(self, reused: bool, seconds: float):
+        """
+        Push info about the SSH master connection used by a task to Pushgateway
+        :param reused: whether an open connection was reused
+        :param seconds: of the handshake, saved if reused, spent otherwise
+        :return:
+        """
+        result = "reused" if reused else "opened"
+        self.ssh_connections.labels(result=result).inc()
+        self.ssh_handshake_seconds.labels(result=result).inc(seconds)
+        self.push()
+
+    def push_failed_push(self):
+        """
+        Push info about an update which failed to be pushed to Pushgateway
+        :return:
+        """
+        self.failed_pushes.inc()
+        self.push()
+
     def push_received_message(self, ignored: bool):
         """
         Push info about received message to Pushgateway
@@ -75,6 +210,17 @@ class Pushgateway:
         ).inc()
         self.push()
 
+    def push_patch_cache(self, hits: int, misses: int):
+        """
+        Push info about the patches looked up in the cache by a conversion to Pushgateway
+        :param hits: patches whose result was reused
+        :param misses: patches which were applied
+        :return:
+        """
+        self.patch_cache_lookups.labels(result="hit").inc(hits)
+        self.patch_cache_lookups.labels(result="miss").inc(misses)
+        self.push()
+
     def push_found_missing_dist_git_repo(self):
         """
         Push info about finding a dist-git repo missing to Pushgateway
@@ -100,3 +246,51 @@ class Pushgateway:
         """
         self.abandoned_updates.inc()
         self.push()
+
+    def push_conversion_duration(self, seconds: float, warm: bool):
+        """
+        Push the time it took to update a source-git repo to Pushgateway
+        :param seconds: duration of the update
+        :param warm: whether the repos were already cached
+        :return:
+        """
+        self.conversion_duration.labels(cache="warm" if warm else "cold").set(seconds)
+        self.push()
+
+    def push_worker_volume_size(self, size: int):
+        """
+        Push the number of bytes used on the worker volume to Pushgateway
+        :param size: bytes used
+        :return:
+        """
+        self.worker_volume_size.set(size)
+        self.push()
+
+    def push_maintenance(self, steps: Dict[str, int], seconds: float):
+        """
+        Push what was done to maintain the cached repositories to Pushgateway
+        :param steps: how many times each maintenance step was done
+        :param seconds: duration of the maintenance
+        :return:
+        """
+        for step, count in steps.items():
+            self.maintenance_steps.labels(step=step).inc(count)
+        self.maintenance_duration.set(seconds)
+        self.push()
+
+    def push_git_commands(self, commands: Dict[str, CommandStats]):
+        """
+        Push the git commands run by a conversion to Pushgateway
+        :param commands: statistics of each git command
+        :return:
+        """
+        for command, stats in commands.items():
+            self.git_commands.labels(command=command, result="failed").inc(
+                stats.failures
+            )
+            self.git_commands.labels(command=command, result="succeeded").inc(
+                stats.calls - stats.failures
+            )
+            self.git_command_duration.labels(command=command).inc(stats.seconds)
+            self.git_command_output.labels(command=command).inc(stats.output_bytes)
+        self.push()
@@ -2,16 +2,22 @@
 # SPDX-License-Identifier: MIT
 
 import shutil
+import time
 from logging import getLogger
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, cast
 
 import git
 from ogr.services.pagure import PagureProject
 
-from dist2src.constants import IGNORED_PACKAGES
-from dist2src.core import Dist2Src
+from dist2src.base_cache import BaseCache, get_size
+from dist2src.constants import IGNORED_PACKAGES, START_TAG_TEMPLATE
+from dist2src.core import Dist2Src, environment
+from dist2src.git_stats import GitStats
+from dist2src.worker.cache import MirrorStore, ObjectPool, SourceGitCache
+from dist2src.worker.maintenance import Maintenance
 from dist2src.worker.monitoring import Pushgateway
+from dist2src.worker.pusher import Pusher, PushJob, create_tag_object
 from dist2src.worker.config import Configuration
 from dist2src.worker import logging as worker_logging
 from dist2src.worker import singular_fork
@@ -20,8 +26,38 @@ logger = getLogger(__name__)
 
 
 class Processor:
-    def __init__(self):
+    def __init__(self, pusher: Optional[Pusher] = None):
+        """
+        @param pusher: pushes the results, outliving the processor,
+                       they are pushed synchronously if not set
+        """
         self.cfg = Configuration()
+        self.pusher = pusher or Pusher(max_pending=0)
+        pool = (
+            ObjectPool(self.cfg.cache_dir / "pool.git")
+            if self.cfg.object_pool
+            else None
+        )
+        self.mirrors = MirrorStore(
+            self.cfg.cache_dir / "mirrors",
+            max_size=self.cfg.mirror_max_size,
+            clone_strategy=self.cfg.clone_strategy,
+            pool=pool,
+        )
+        self.ssh = self.cfg.ssh
+        self.src_git_cache = SourceGitCache(
+            self.cfg.cache_dir / "repos",
+            max_size=self.cfg.src_git_cache_max_size,
+            clone_strategy=self.cfg.clone_strategy,
+            pool=pool,
+        )
+        self.base_cache = (
+            BaseCache(
+                self.cfg.cache_dir / "bases.git", max_size=self.cfg.base_cache_max_size
+            )
+            if self.cfg.base_cache_max_size
+            else None
+        )
 
         self.fullname: Optional[str] = None
         self.name: Optional[str] = None
@@ -29,6 +65,21 @@ class Processor:
         self.end_commit: Optional[str] = None
         self.dist_git_dir: Optional[Path] = None
         self.src_git_dir: Optional[Path] = None
+        self.src_git_fullname: Optional[str] = None
+        # repos opened while processing a message, closed at its end
+        self.repos: List[git.Repo] = []
+
+    def __enter__(self) -> "Processor":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stop the git processes and drop the caches of the repos used. """
+        for repo in self.repos:
+            repo.close()
+        self.repos.clear()
 
     def process_message(self, event: dict, **kwargs):
         self.fullname = event["repo"]["fullname"]
@@ -36,7 +87,8 @@ class Processor:
         self.branch = event["branch"]
         self.end_commit = event["end_commit"]
         self.dist_git_dir = self.cfg.workdir / self.cfg.dist_git_namespace / self.name
-        self.src_git_dir = self.cfg.workdir / self.cfg.src_git_namespace / self.name
+        self.src_git_fullname = f"{self.cfg.src_git_namespace}/{self.name}"
+        self.src_git_dir = self.src_git_cache.repo_path(self.src_git_fullname)
 
         logger.info(f"Processing message with {event}")
         # Should this package and branch be ignored?
@@ -79,7 +131,9 @@ class Processor:
             Pushgateway().push_received_message(ignored=True)
             return
 
-        # check if the repository is up to date
+        # check if the repository is up to date,
+        # a push of the previous conversion of the repo can add the tag
+        self.pusher.wait(self.src_git_fullname)
         conversion_tag = f"convert/{self.branch}/{self.end_commit}"
         if conversion_tag in src_git_project.get_tags():
             logger.info(
@@ -94,19 +148,70 @@ class Processor:
             repo_name=self.name, commit_sha=self.end_commit
         )
 
+        warm = (
+            self.mirrors.repo_path(self.fullname).is_dir() and self.src_git_dir.is_dir()
+        )
+        start = time.monotonic()
+        stats = GitStats()
         try:
-            self.update_project(src_git_project, conversion_tag)
+            with stats, environment(self.ssh.env()):
+                self.update_project(src_git_project, conversion_tag)
+            Pushgateway().push_conversion_duration(time.monotonic() - start, warm)
         finally:
+            logger.info(
+                f"{stats.total_seconds():.2f}s spent in git commands:\n"
+                f"{stats.summary()}"
+            )
+            Pushgateway().push_git_commands(stats.commands)
             getLogger("dist2src").removeHandler(file_handler)
             self.cleanup()
+            self.mirrors.share(self.fullname)
+            # repos being pushed are left alone, they are shared once pushed;
+            # until then, the pool keeps the objects they could borrow from it
+            pushing = self.pusher.pending()
+            self.src_git_cache.share(
+                self.src_git_fullname, later=self.src_git_fullname in pushing
+            )
+            self.src_git_cache.share_deferred(exclude=pushing)
+            self.mirrors.evict(keep=[self.fullname], prune=not pushing)
+            self.src_git_cache.evict(
+                keep=[self.src_git_fullname, *pushing], prune=not pushing
+            )
+            if self.base_cache:
+                self.base_cache.evict()
+            self.maintain(
+                exclude=[self.src_git_cache.repo_path(name) for name in pushing]
+            )
+            Pushgateway().push_worker_volume_size(get_size(self.cfg.workdir))
+
+    def maintain(self, exclude: List[Path]):
+        """
+        Maintain the cached repositories, if there is time for it.
+
+        @param exclude: paths of repositories which are not maintained
+        """
+        if self.cfg.maintenance_budget <= 0:
+            return
+        start = time.monotonic()
+        steps = Maintenance(self.cfg.maintenance_budget).run(
+            path
+            for path in self.mirrors.repos() + self.src_git_cache.repos()
+            if path not in exclude
+        )
+        duration = time.monotonic() - start
+        logger.info(f"Maintenance took {duration:.2f}s: {dict(steps)}")
+        Pushgateway().push_maintenance(steps, duration)
 
     def update_project(self, project: PagureProject, conversion_tag: str):
         self.cleanup()
-        # Clone repo from rpms/ and checkout the branch.
-        dist_git_repo = git.Repo.clone_from(
-            f"https://{self.cfg.dist_git_host}/{self.fullname}.git", self.dist_git_dir
+        # Update the mirror of the repo from rpms/ and check out the branch.
+        dist_git_repo = self.mirrors.checkout(
+            self.fullname,
+            f"https://{self.cfg.dist_git_host}/{self.fullname}.git",
+            self.dist_git_dir,
+            self.branch,
         )
-        dist_git_repo.git.checkout(self.branch)
+        self.repos.append(dist_git_repo)
 
         # Check if the commit is the one we are expecting.
         if dist_git_repo.branches[self.branch].commit.hexsha != self.end_commit:
@@ -118,12 +223,16 @@ class Processor:
             Pushgateway().push_abandoned_update()
             return
 
-        # Clone repo from source-git/ using ssh, so it can be pushed later on.
+        # Get the repo from source-git/ using ssh, so it can be pushed later on.
+        # A working copy from a previous task is reused, if there is one.
         src_git_ssh_url = project.get_git_urls()["ssh"]
-        src_git_repo = git.Repo.clone_from(
-            src_git_ssh_url,
-            self.src_git_dir,
+        connection = self.ssh.open(src_git_ssh_url)
+        if connection:
+            Pushgateway().push_ssh_connection(*connection)
+        src_git_repo = self.src_git_cache.checkout(
+            self.src_git_fullname, src_git_ssh_url, self.branch
         )
+        self.repos.append(src_git_repo)
 
         # Check-out the source-git branch, if already exists,
         # so that 'convert' knows that this is an update.
@@ -135,33 +244,81 @@ class Processor:
         if self.branch in remote_heads:
             src_git_repo.git.checkout(self.branch)
 
-        d2s = Dist2Src(
+        with Dist2Src(
             dist_git_path=self.dist_git_dir,
             source_git_path=self.src_git_dir,
-        )
-        d2s.convert(self.branch, self.branch)
-
-        src_git_repo.git.tag(
-            "--annotate",
-            "--message",
-            f"Converted from commit {self.end_commit},\nfrom branch {self.branch}.",
-            conversion_tag,
-            src_git_repo.heads[self.branch].commit,
+            share_objects=self.cfg.share_objects,
+            single_commit_in_index=self.cfg.single_commit_in_index,
+            deterministic=self.cfg.deterministic,
+            patch_engine=self.cfg.patch_engine,
+            base_cache=self.base_cache,
+            git_profile=self.cfg.git_profile,
+        ) as d2s:
+            d2s.convert(self.branch, self.branch)
+            if d2s.patch_cache_hits or d2s.patch_cache_misses:
+                Pushgateway().push_patch_cache(
+                    d2s.patch_cache_hits, d2s.patch_cache_misses
+                )
+            identity = (
+                d2s.dist_git.identity_env(self.end_commit)
+                if self.cfg.deterministic
+                else {}
+            )
+
+        # The tag is created once the result is pushed, it says it's in source-git.
+        with environment(identity):
+            tag_object = create_tag_object(
+                src_git_repo,
+                conversion_tag,
+                str(src_git_repo.heads[self.branch].commit),
+                f"Converted from commit {self.end_commit},\nfrom branch {self.branch}.",
+            )
+
+        # Push only the refs the conversion changed.
+        refspecs = []
+        if self.remote_is_up_to_date(src_git_repo):
+            # e.g. converted by another task already, only the tag is new
+            logger.info(f"{self.branch!r} is up to date in source-git.")
+        else:
+            # Update moves the upstream ref tag, it has to be forced in remote.
+            upstream_tag = START_TAG_TEMPLATE.format(branch=self.branch)
+            refspecs = [
+                f"+refs/heads/{self.branch}:refs/heads/{self.branch}",
+                f"+refs/tags/{upstream_tag}:refs/tags/{upstream_tag}",
+            ]
+        self.pusher.submit(
+            PushJob(
+                fullname=self.src_git_fullname,
+                repo_path=self.src_git_dir,
+                refspecs=refspecs,
+                tag=conversion_tag,
+                tag_object=tag_object,
+                env=self.ssh.env(),
+            )
         )
 
-        # Push the result to source-git.
-        # Update moves the upstream ref tag, we need --tags --force to move it in remote.
-        src_git_repo.git.push("origin", self.branch, tags=True, force=True)
-        Pushgateway().push_created_update()
+    def remote_is_up_to_date(self, src_git_repo: git.Repo) -> bool:
+        """
+        Is the converted branch in source-git the same as the local one?
+
+        The remote is asked, as it could have been pushed to since it was fetched.
+        """
+        remote = cast(
+            str, src_git_repo.git.ls_remote("origin", f"refs/heads/{self.branch}")
+        )
+        return remote.split("\t", 1)[0] == str(src_git_repo.heads[self.branch].commit)
 
     def cleanup(self):
         """
         Clean up the working directory.
 
+        The cache directory is kept.
         This is safe, as long as no parallel work is done in this directory.
         """
         logger.debug(f"Cleaning up {self.cfg.workdir}...")
         for item in self.cfg.workdir.glob("*"):
+            if item == self.cfg.cache_dir:
+                continue
             if item.is_dir():
                 logger.debug(f"rm -rf {item}")
                 shutil.rmtree(item, ignore_errors=True)
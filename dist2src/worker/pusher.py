@@ -0,0 +1,203 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import queue
+import re
+import subprocess
+import threading
+import time
+from collections import Counter
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import git
+from git import GitCommandError
+
+from dist2src.git_stats import run_git
+from dist2src.worker.monitoring import Pushgateway
+
+logger = getLogger(__name__)
+
+# the progress of 'git push', e.g. "Writing objects: 100% (3/3), 196 bytes | ..."
+WRITTEN_OBJECTS = re.compile(
+    r"Writing objects: 100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)"
+)
+SIZE_UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3}
+
+
+def push_refs(
+    repo: git.Repo, refspecs: Sequence[str], env: Optional[Dict[str, str]] = None
+) -> Tuple[int, int]:
+    """
+    Push the refs to origin, all or none of them.
+
+    @param refspecs: refspecs to push, e.g. '+refs/heads/c8s:refs/heads/c8s'
+    @param env: environment of the push, e.g. for the SSH connection
+    @return: number of refs updated in the remote, bytes sent
+    """
+    _, stdout, stderr = repo.git.push(
+        "--atomic",
+        "--porcelain",
+        "--progress",
+        "origin",
+        *refspecs,
+        with_extended_output=True,
+        env=env,
+    )
+    # <flag> TAB <from>:<to> TAB <summary>, '=' is for an up-to-date ref
+    refs = sum(
+        1 for line in stdout.splitlines() if line.count("\t") == 2 and line[0] in " +-*"
+    )
+    written = WRITTEN_OBJECTS.search(stderr)
+    size = int(float(written[1]) * SIZE_UNITS[written[2]]) if written else 0
+    return refs, size
+
+
+def create_tag_object(repo: git.Repo, name: str, commit: str, message: str) -> str:
+    """
+    Create an annotated tag object, without a ref pointing to it.
+
+    The tagger is the committer git would use, GIT_COMMITTER_* are respected.
+
+    @return: hexsha of the tag object
+    """
+    tagger = repo.git.var("GIT_COMMITTER_IDENT")
+    return (
+        run_git(
+            ["git", "mktag"],
+            cwd=repo.git_dir,
+            input=f"object {commit}\ntype commit\ntag {name}\n"
+            f"tagger {tagger}\n\n{message}\n".encode(),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        .stdout.decode()
+        .strip()
+    )
+
+
+class PushJob(NamedTuple):
+    """ what a conversion needs to have pushed """
+
+    # name of the source-git repo, pushes of a repo are done in order
+    fullname: str
+    repo_path: Path
+    # refs changed by the conversion, empty if source-git has them already
+    refspecs: List[str]
+    # the conversion tag is pushed with the refs, atomically
+    tag: str
+    tag_object: str
+    env: Dict[str, str]
+
+
+class Pusher:
+    """
+    Pushes the results of conversions to source-git, in the background,
+    so that the next conversion can start meanwhile.
+
+    At most 'max_pending' pushes are waiting, submitting another one waits
+    for a free slot. With 'max_pending' 0, the push is done right away,
+    by the submitter. A failed push is retried with an exponential backoff.
+
+    The repo of a pending push should not be touched, until wait() says
+    the pushes of the repo are done.
+    """
+
+    def __init__(self, max_pending: int, attempts: int = 3, backoff: float = 10):
+        """
+        @param max_pending: pushes waiting at most, 0 to push synchronously
+        @param attempts: how many times a push is tried
+        @param backoff: seconds to wait after the first failed attempt,
+                        doubled after each next one
+        """
+        self.max_pending = max_pending
+        self.attempts = attempts
+        self.backoff = backoff
+        self._queue: "queue.Queue[PushJob]" = queue.Queue(maxsize=max_pending)
+        self._pending: Dict[str, int] = Counter()
+        self._done = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, job: PushJob):
+        """ push the job, in the background if enabled """
+        if not self.max_pending:
+            self.push(job)
+            return
+        with self._done:
+            self._pending[job.fullname] += 1
+        if not self._thread or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="pusher", daemon=True
+            )
+            self._thread.start()
+        self._queue.put(job)
+
+    def pending(self) -> List[str]:
+        """ names of the repos with pushes in progress """
+        with self._done:
+            return [fullname for fullname, count in self._pending.items() if count]
+
+    def wait(
+        self, fullname: Optional[str] = None, timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Wait until the pushes of a repo, or all of them, are done.
+
+        @param fullname: name of the repo, all the repos if not set
+        @return: True if done, False after the timeout
+        """
+        with self._done:
+            return self._done.wait_for(
+                lambda: not (
+                    self._pending[fullname] if fullname else any(self._pending.values())
+                ),
+                timeout=timeout,
+            )
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self.push(job)
+            except Exception as ex:
+                # logged already, the thread has to stay alive
+                logger.debug(f"Push of {job.fullname} failed: {ex}")
+            finally:
+                with self._done:
+                    self._pending[job.fullname] -= 1
+                    self._done.notify_all()
+                self._queue.task_done()
+
+    def push(self, job: PushJob):
+        """
+        Push the refs changed by the conversion together with the conversion tag,
+        atomically, so that the tag says the conversion is in source-git.
+        The local tag ref is created once the push succeeded.
+
+        @raise GitCommandError: when all the attempts failed
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                with git.Repo(job.repo_path) as repo:
+                    # one atomic push: the remote gets the tag only with the refs
+                    tag_ref = f"refs/tags/{job.tag}"
+                    refs, size = push_refs(
+                        repo, [*job.refspecs, f"{job.tag_object}:{tag_ref}"], job.env
+                    )
+                    repo.git.update_ref(tag_ref, job.tag_object)
+                break
+            except GitCommandError as ex:
+                logger.warning(
+                    f"Attempt {attempt}/{self.attempts} to push {job.fullname} failed: {ex}"
+                )
+                if attempt == self.attempts:
+                    Pushgateway().push_failed_push()
+                    raise
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+        logger.info(f"Pushed {refs} refs, {size} bytes.")
+        Pushgateway().push_pushed_refs(refs, size)
+        if job.refspecs:
+            Pushgateway().push_created_update()
+        else:
+            Pushgateway().push_skipped_push()
@@ -1,13 +1,50 @@
 # Copyright Contributors to the Packit project.
 # SPDX-License-Identifier: MIT
 
+from logging import getLogger
 from os import getenv
 from typing import Optional
 
+from celery.signals import worker_process_shutdown, worker_shutdown
+
 from dist2src.worker.celerizer import celery_app
+from dist2src.worker.config import Configuration
 from dist2src.worker.processor import Processor
+from dist2src.worker.pusher import Pusher
+
+logger = getLogger(__name__)
+
+
+# pushes the results of the tasks of this process, in the background
+_pusher: Optional[Pusher] = None
+
+
+def get_pusher() -> Pusher:
+    global _pusher
+    if _pusher is None:
+        cfg = Configuration()
+        _pusher = Pusher(
+            max_pending=cfg.push_queue_size,
+            attempts=cfg.push_attempts,
+            backoff=cfg.push_backoff,
+        )
+    return _pusher
 
 
 @celery_app.task(name=getenv("CELERY_TASK_NAME"))
 def process_message(event: dict, **kwargs) -> Optional[dict]:
-    return Processor().process_message(event=event)
+    # the git processes and caches of the task are released when it's done
+    with Processor(pusher=get_pusher()) as processor:
+        return processor.process_message(event=event)
+
+
+@worker_shutdown.connect
+def close_connections(**kwargs):
+    # the SSH master connections outlive the tasks
+    Configuration().ssh.close()
+
+
+@worker_process_shutdown.connect
+def finish_pushes(**kwargs):
+    if _pusher and not _pusher.wait(timeout=Configuration().push_shutdown_timeout):
+        logger.error(f"Pushes of {_pusher.pending()} were not done.")
@@ -0,0 +1,119 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import os
+import subprocess
+from pathlib import Path
+
+import git
+
+from dist2src.base_cache import BaseCache
+
+
+def unpack_sources(path: Path, version: int = 1) -> Path:
+    """ what %setup leaves in BUILD/ """
+    repo_path = path / "BUILD" / "acl-2.2.53"
+    (repo_path / "src").mkdir(parents=True)
+    for i in range(10):
+        (repo_path / "src" / f"file{i}.c").write_text(f"int x{i};\n" * version)
+    (repo_path / "build.o").write_text("ignored, still committed")
+    (repo_path / ".gitignore").write_text("*.o\n")
+    # tar keeps the mtimes of the archived files
+    for file in (*repo_path.glob("*"), *repo_path.glob("src/*")):
+        if file.is_file():
+            os.utime(file, (1600000000, 1600000000))
+    return repo_path
+
+
+def base_commit(repo_path: Path, env: dict) -> git.Repo:
+    packitpatch = Path(__file__).parent.parent / "packitpatch"
+    subprocess.check_call(
+        [str(packitpatch), "--base", "acl-2.2.53 base"],
+        cwd=repo_path,
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+    )
+    return git.Repo(repo_path)
+
+
+def test_base_cache(tmp_path: Path):
+    cache = BaseCache(tmp_path / "bases.git")
+    # nothing cached yet
+    env = cache.env("sources1")
+    assert env == {"PACKIT_BASE_OBJECTS": cache.objects_dir}
+    first = base_commit(unpack_sources(tmp_path / "first"), env)
+    cache.store("sources1", Path(first.working_dir))
+
+    # the same sources, the tree is reused, no objects are written
+    env = cache.env("sources1")
+    assert env["PACKIT_BASE_TREE"] == first.head.commit.tree.hexsha
+    assert env["PACKIT_BASE_INDEX"] == str(cache.path / "indexes" / "sources1")
+    second = base_commit(unpack_sources(tmp_path / "second"), env)
+    assert second.head.commit.tree == first.head.commit.tree
+    assert second.head.commit.message == "acl-2.2.53 base\n"
+    assert not second.is_dirty(untracked_files=True)
+    # the stat data matches the cached index, nothing is hashed
+    assert second.git.config("core.checkStat") == "minimal"
+    assert second.git.diff_files() == ""
+    # the commit is the only new object, if any
+    assert int(second.git.count_objects().split()[0]) <= 1
+
+    # the same number and size of the files, but a different content
+    changed_path = unpack_sources(tmp_path / "changed")
+    (changed_path / "src" / "file3.c").write_text("int y3;\n")
+    changed = base_commit(changed_path, env)
+    assert changed.head.commit.tree != first.head.commit.tree
+    assert changed.head.commit.tree["src/file3.c"].data_stream.read() == b"int y3;\n"
+    assert not changed.git.config("core.checkStat", with_exceptions=False)
+    assert not changed.is_dirty(untracked_files=True)
+
+    # the unpacked files don't match the cached tree, they are committed
+    third = base_commit(unpack_sources(tmp_path / "third", version=2), env)
+    assert third.head.commit.tree != first.head.commit.tree
+    assert "build.o" in third.git.ls_files()
+    assert not third.is_dirty(untracked_files=True)
+    cache.store("sources2", Path(third.working_dir))
+
+    # the least recently used base is evicted
+    os.utime(cache.path / "used" / "bases" / "sources1", (0, 0))
+    cache.max_size = 0
+    cache.evict()
+    assert not cache.env("sources1").get("PACKIT_BASE_TREE")
+    assert not (cache.path / "indexes" / "sources1").exists()
+    assert cache.env("sources2")["PACKIT_BASE_TREE"] == third.head.commit.tree.hexsha
+    subprocess.check_call(["git", "fsck", "--no-progress"], cwd=third.working_dir)
+
+
+def test_prep_cache(tmp_path: Path):
+    cache = BaseCache(tmp_path / "bases.git")
+    first = base_commit(unpack_sources(tmp_path / "first"), cache.env(None))
+    repo_path = Path(first.working_dir)
+    cache.store("sources1", repo_path)
+    (repo_path / "src" / "file0.c").write_text("patched\n")
+    first.git.commit("-q", "-a", "-m", "Apply patch file0.patch")
+    # what %prep does after applying the patches
+    (repo_path / "src" / "file1.c").unlink()
+    (repo_path / "configure").write_text("#!/bin/sh\n")
+    (repo_path / "configure").chmod(0o755)
+    (repo_path / "generated.o").write_text("ignored")
+    cache.store_prep("prep1", repo_path)
+
+    assert cache.restore_prep("prep2", tmp_path / "second" / "BUILD") is None
+    restored = cache.restore_prep("prep1", tmp_path / "second" / "BUILD")
+    assert restored == tmp_path / "second" / "BUILD" / "acl-2.2.53"
+    second = git.Repo(restored)
+    assert second.head.commit == first.head.commit
+    assert second.active_branch.name == first.active_branch.name
+    assert second.git.status("--porcelain", "--ignored") == first.git.status(
+        "--porcelain", "--ignored"
+    )
+    assert os.access(restored / "configure", os.X_OK)
+    assert (restored / "generated.o").read_text() == "ignored"
+    subprocess.check_call(["git", "fsck", "--no-progress"], cwd=restored)
+
+    # the least recently used entries are evicted, the %prep repo is the newest
+    os.utime(cache.path / "used" / "bases" / "sources1", (0, 0))
+    cache.max_size = 0
+    cache.evict()
+    assert cache.restore_prep("prep1", tmp_path / "third" / "BUILD")
+    assert not cache.env("sources1").get("PACKIT_BASE_TREE")
@@ -0,0 +1,366 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+"""
+Benchmarks, run them with:
+
+    pytest -s -m benchmark tests/test_benchmark.py
+
+The results are printed, the assertions only check the obvious.
+"""
+
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import pytest
+
+from dist2src.base_cache import BaseCache, get_size
+from dist2src.core import Dist2Src, GitRepo
+from dist2src.patch_engine import PatchEngine
+from dist2src.worker.cache import (
+    CLONE_STRATEGIES,
+    MirrorStore,
+    ObjectPool,
+    SourceGitCache,
+)
+
+BENCHMARK_PACKAGE = os.getenv("D2S_BENCHMARK_PACKAGE", "rpm")
+BENCHMARK_BRANCH = os.getenv("D2S_BENCHMARK_BRANCH", "c8s")
+
+
+def assert_same_commits(
+    monkeypatch, names: Iterable[str], run: Callable[[str], Tuple[GitRepo, float]]
+):
+    """
+    Run each of the implementations and print how long it took,
+    all of them have to create the same commits.
+
+    @param run: takes the name, returns the repo and the seconds it took
+    """
+    # the commits don't differ by their dates
+    monkeypatch.setenv("GIT_AUTHOR_DATE", "@1600000000 +0000")
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "@1600000000 +0000")
+    heads = {}
+    for name in names:
+        repo, duration = run(name)
+        print(f"{name:>8}: {duration:8.2f} s")
+        heads[name] = repo.plumbing.resolve("HEAD")
+        assert not repo.repo.is_dirty(untracked_files=True)
+    assert len(set(heads.values())) == 1, heads
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_clone_strategies(tmp_path: Path, monkeypatch):
+    """ bytes transferred and wall time of the clones done by a worker """
+    results = {}
+    for clone_strategy in CLONE_STRATEGIES:
+        cache_dir = tmp_path / clone_strategy
+        # git dumps the packs it receives there, including the objects
+        # a partial clone fetches on demand
+        received = tmp_path / f"{clone_strategy}.pack"
+        received.touch()
+        monkeypatch.setenv("GIT_TRACE_PACKFILE", str(received))
+        start = time.monotonic()
+        MirrorStore(
+            cache_dir / "mirrors", max_size=1024 ** 3, clone_strategy=clone_strategy
+        ).checkout(
+            f"rpms/{BENCHMARK_PACKAGE}",
+            f"https://git.centos.org/rpms/{BENCHMARK_PACKAGE}.git",
+            cache_dir / "work",
+            BENCHMARK_BRANCH,
+        )
+        SourceGitCache(
+            cache_dir / "repos", max_size=1024 ** 3, clone_strategy=clone_strategy
+        ).checkout(
+            f"source-git/{BENCHMARK_PACKAGE}",
+            f"https://git.stg.centos.org/source-git/{BENCHMARK_PACKAGE}.git",
+            BENCHMARK_BRANCH,
+        )
+        results[clone_strategy] = (received.stat().st_size, time.monotonic() - start)
+
+    for clone_strategy, (size, duration) in results.items():
+        print(f"{clone_strategy:>15}: {size:>12} bytes {duration:8.2f} s")
+    assert all(size <= results["full"][0] for size, _ in results.values())
+
+
+def legacy_orphan_checkout(repo: GitRepo, branch: str):
+    """ how GitRepo.checkout(orphan=True) cleared the index before """
+    repo.repo.git.checkout("--orphan", branch)
+    for entry in repo.repo.index.entries:
+        repo.repo.index.remove(entry[0], working_tree=True, r=True, f=True)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_orphan_checkout(tmp_path: Path):
+    """ creating an orphan branch in a repo with 50k files """
+    # the legacy implementation is quadratic, it's measured on a smaller repo
+    for files, checkout in (
+        (50_000, GitRepo.checkout),
+        (2_000, lambda repo, branch, orphan: legacy_orphan_checkout(repo, branch)),
+    ):
+        repo = GitRepo(tmp_path / str(files), create=True)
+        for i in range(files):
+            directory = repo.repo_path / f"dir{i // 1000}"
+            directory.mkdir(exist_ok=True)
+            (directory / f"file{i}").write_text(str(i))
+        repo.stage()
+        repo.commit("Lots of files")
+
+        start = time.monotonic()
+        checkout(repo, "orphan", orphan=True)
+        duration = time.monotonic() - start
+
+        print(f"{files:>6} files: {duration:8.2f} s")
+        assert repo.repo.git.ls_files() == ""
+        assert [p.name for p in repo.repo_path.iterdir()] == [".git"]
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_object_pool(tmp_path: Path):
+    """ bytes on the volume and cold/warm checkout times with and without the pool """
+    packages = os.getenv("D2S_BENCHMARK_POOL_PACKAGES", "mingw-gcc,mingw-binutils")
+    branches = ("c8", "c8s")
+    for use_pool in (False, True):
+        cache_dir = tmp_path / ("pool" if use_pool else "no-pool")
+        pool = ObjectPool(cache_dir / "pool.git") if use_pool else None
+        mirrors = MirrorStore(cache_dir / "mirrors", max_size=1024 ** 4, pool=pool)
+        durations = []
+        for attempt in ("cold", "warm"):
+            start = time.monotonic()
+            for package in packages.split(","):
+                for branch in branches:
+                    work_copy = cache_dir / "work"
+                    mirrors.checkout(
+                        f"rpms/{package}",
+                        f"https://git.centos.org/rpms/{package}.git",
+                        work_copy,
+                        branch,
+                    )
+                    shutil.rmtree(work_copy)
+                    mirrors.share(f"rpms/{package}")
+            durations.append(time.monotonic() - start)
+        print(
+            f"pool={use_pool!s:>5}: {get_size(cache_dir):>12} bytes, "
+            f"cold {durations[0]:8.2f} s, warm {durations[1]:8.2f} s"
+        )
+
+
+def legacy_rebase_patches(d2s: Dist2Src, from_branch: str, to_branch: str):
+    """ how Dist2Src.rebase_patches replayed the patches before """
+    d2s.source_git.checkout(to_branch)
+    commits = d2s.source_git.plumbing.rev_list(from_branch)[-2::-1]
+    d2s.source_git.repo.git.cherry_pick(
+        *commits,
+        keep_redundant_commits=True,
+        allow_empty=True,
+        strategy_option="theirs",
+    )
+    d2s.source_git.repo.git.branch("-D", from_branch)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_rebase_patches(tmp_path: Path, monkeypatch):
+    """ replaying 250 patches onto a tree of 5k files """
+
+    def run(name: str) -> Tuple[GitRepo, float]:
+        d2s = Dist2Src(dist_git_path=None, source_git_path=tmp_path / name)
+        repo = d2s.source_git
+        for i in range(5000):
+            directory = repo.repo_path / f"dir{i // 500}"
+            directory.mkdir(exist_ok=True)
+            (directory / f"file{i}").write_text(str(i))
+        repo.stage()
+        repo.commit("Sources")
+        repo.checkout("c8s", create_branch=True)
+        repo.checkout("patches", create_branch=True)
+        for i in range(250):
+            (repo.repo_path / f"dir{i % 10}" / f"file{i * 7}").write_text(f"patch {i}")
+            repo.stage()
+            repo.commit(f"Apply patch {i}.patch", body=f"patch_name: {i}.patch")
+
+        rebase = legacy_rebase_patches if name == "legacy" else Dist2Src.rebase_patches
+        start = time.monotonic()
+        rebase(d2s, "patches", "c8s")
+        return repo, time.monotonic() - start
+
+    assert_same_commits(monkeypatch, ("legacy", "replay"), run)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_repo_profile(tmp_path: Path):
+    """ GitRepo operations on small and huge trees, with and without GIT_REPO_PROFILE """
+    for files in (1_000, 50_000):
+        for profile in (False, True):
+            path = tmp_path / f"{files}-{profile}"
+            repo = GitRepo(path, create=True, profile=profile)
+            for i in range(files):
+                directory = path / f"dir{i // 1000}"
+                directory.mkdir(exist_ok=True)
+                (directory / f"file{i}").write_text(str(i))
+            repo.stage()
+            repo.commit("Sources")
+            repo.repo.git.tag("sources")
+            branch = repo.repo.active_branch.name
+            durations = {}
+
+            for i in range(0, files, files // 10):
+                (path / f"dir{i // 1000}" / f"file{i}").write_text("patched")
+            start = time.monotonic()
+            repo.commit_all("Patch")
+            durations["commit_all"] = time.monotonic() - start
+
+            start = time.monotonic()
+            repo.revert_to_ref("sources", commit_message="Revert")
+            durations["revert_to_ref"] = time.monotonic() - start
+
+            repo.repo.git.checkout("-q", "-b", "archive", "sources")
+            repo.commit_all("Unused")  # nothing changed
+            start = time.monotonic()
+            repo.cherry_pick_base(from_branch="archive", to_branch=branch, theirs=True)
+            durations["cherry_pick_base"] = time.monotonic() - start
+
+            print(
+                f"{files:>6} files, profile={profile!s:>5}: "
+                + ", ".join(f"{name} {secs:6.2f} s" for name, secs in durations.items())
+            )
+            assert not repo.repo.is_dirty(untracked_files=True)
+
+
+PACKITPATCH = Path(__file__).parent.parent / "packitpatch"
+
+
+def unpack_tree(path: Path, files: int):
+    """ what %setup leaves in BUILD/: 'files' files, 1000 in a directory """
+    for i in range(files):
+        directory = path / f"dir{i // 1000}"
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f"file{i}").write_text(f"{i}\n")
+
+
+def write_patches(path: Path, count: int, step: int) -> List[Path]:
+    """ 'count' patches, each changing every 'step'-th file of unpack_tree() """
+    patches = []
+    for i in range(count):
+        patched = f"dir{i * step // 1000}/file{i * step}"
+        patch = path / f"{i:04}-fix.patch"
+        patch.write_text(
+            f"--- a/{patched}\n+++ b/{patched}\n@@ -1 +1 @@\n-{i * step}\n+patch {i}\n"
+        )
+        patches.append(patch)
+    return patches
+
+
+def apply_patches(
+    path: Path, patches: List[Path], patch_args: List[str], env: Dict[str, str]
+) -> float:
+    """
+    Apply the patches with packitpatch, as %patch does.
+
+    @return: seconds it took
+    """
+    start = time.monotonic()
+    for i, patch in enumerate(patches):
+        with open(patch) as stdin:
+            subprocess.run(
+                [str(PACKITPATCH), "%{1}", str(i), *patch_args],
+                cwd=path,
+                stdin=stdin,
+                stdout=subprocess.DEVNULL,
+                env=env,
+                check=True,
+            )
+    return time.monotonic() - start
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_patch_engine(tmp_path: Path, monkeypatch):
+    """ committing 100 patches applied by packitpatch to a tree of 20k files """
+    patches = write_patches(tmp_path, 100, 199)
+
+    def run(name: str) -> Tuple[GitRepo, float]:
+        env = dict(os.environ)
+        path = tmp_path / name / "BUILD" / "pkg-1.0"
+        repo = GitRepo(path, create=True)
+        unpack_tree(path, 20_000)
+        repo.stage()
+        repo.commit("pkg-1.0 base")
+
+        start = time.monotonic()
+        engine = PatchEngine(env) if name == "engine" else None
+        if engine:
+            engine.start()
+        apply_patches(
+            path, patches, ["-p1"], {**env, **(engine.env() if engine else {})}
+        )
+        if engine:
+            engine.close()
+        return repo, time.monotonic() - start
+
+    assert_same_commits(monkeypatch, ("legacy", "engine"), run)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_patch_staging(tmp_path: Path, monkeypatch):
+    """ packitpatch staging the whole tree or the patched files, 300 patches, 50k files """
+    patches = write_patches(tmp_path, 300, 163)
+
+    def run(staging: str) -> Tuple[GitRepo, float]:
+        path = tmp_path / staging / "BUILD" / "pkg-1.0"
+        repo = GitRepo(path, create=True)
+        unpack_tree(path, 50_000)
+        repo.stage()
+        repo.commit("pkg-1.0 base")
+
+        env = {**os.environ, "PACKIT_PATCH_STAGING": staging}
+        return repo, apply_patches(path, patches, ["-p1", "--fuzz=0", "-s"], env)
+
+    assert_same_commits(monkeypatch, ("all", "patched"), run)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark
+def test_patch_cache(tmp_path: Path, monkeypatch):
+    """ packitpatch applying 300 patches on 50k files, or reusing their results """
+    patches = write_patches(tmp_path, 300, 163)
+    cache = BaseCache(tmp_path / "bases.git")
+
+    def run(name: str) -> Tuple[GitRepo, float]:
+        path = tmp_path / name / "BUILD" / "pkg-1.0"
+        unpack_tree(path, 50_000)
+        results = tmp_path / f"{name}.results"
+        env = {
+            **os.environ,
+            "PACKIT_PATCH_STAGING": "patched",
+            **cache.env("sources"),
+            **cache.patch_env(results),
+        }
+        subprocess.run(
+            [str(PACKITPATCH), "--base", "pkg-1.0 base"],
+            cwd=path,
+            stdout=subprocess.DEVNULL,
+            env=env,
+            check=True,
+        )
+
+        duration = apply_patches(path, patches, ["-p1", "--fuzz=0", "-s"], env)
+
+        cache.store("sources", path)
+        hits, misses = cache.store_patches(results, path)
+        if name == "applied":
+            assert (hits, misses) == (0, len(patches))
+        else:
+            assert (hits, misses) == (len(patches), 0)
+        return GitRepo(path), duration
+
+    assert_same_commits(monkeypatch, ("applied", "reused"), run)
@@ -0,0 +1,256 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import git
+import pytest
+
+from dist2src.base_cache import get_size
+from dist2src.worker.cache import (
+    CLONE_STRATEGIES,
+    MirrorStore,
+    ObjectPool,
+    SourceGitCache,
+    alternates_of,
+)
+
+
+def commit_file(repo_path: Path, name: str, content: str):
+    repo_path.joinpath(name).write_text(content)
+    subprocess.check_call(["git", "add", name], cwd=repo_path)
+    subprocess.check_call(["git", "commit", "-q", "-m", f"Add {name}"], cwd=repo_path)
+
+
+@pytest.fixture()
+def upstream(tmp_path: Path) -> Path:
+    path = tmp_path / "upstream" / "acl"
+    path.mkdir(parents=True)
+    subprocess.check_call(["git", "init", "-q"], cwd=path)
+    subprocess.check_call(["git", "checkout", "-q", "-b", "c8s"], cwd=path)
+    # so that partial clones can be tested with file:// URLs
+    subprocess.check_call(["git", "config", "uploadpack.allowFilter", "true"], cwd=path)
+    commit_file(path, "acl.spec", "Name: acl")
+    return path
+
+
+def test_mirror_checkout(tmp_path: Path, upstream: Path):
+    store = MirrorStore(tmp_path / "mirrors", max_size=1024 ** 3)
+    work_copy = store.checkout("rpms/acl", str(upstream), tmp_path / "w1", "c8s")
+    assert store.repo_path("rpms/acl").is_dir()
+    assert work_copy.active_branch.name == "c8s"
+    assert (tmp_path / "w1" / "acl.spec").read_text() == "Name: acl"
+
+    # the working copy is removed between tasks, the mirror is updated
+    shutil.rmtree(tmp_path / "w1")
+    commit_file(upstream, "acl.patch", "fix")
+    work_copy = store.checkout("rpms/acl", str(upstream), tmp_path / "w2", "c8s")
+    assert (
+        work_copy.branches["c8s"].commit.hexsha
+        == git.Repo(upstream).heads["c8s"].commit.hexsha
+    )
+    assert (tmp_path / "w2" / "acl.patch").is_file()
+
+
+def test_mirror_corrupt(tmp_path: Path, upstream: Path):
+    store = MirrorStore(tmp_path / "mirrors", max_size=1024 ** 3)
+    store.update("rpms/acl", str(upstream), "c8s")
+    shutil.rmtree(store.repo_path("rpms/acl") / "objects")
+
+    work_copy = store.checkout("rpms/acl", str(upstream), tmp_path / "w", "c8s")
+    assert work_copy.head.commit.hexsha == git.Repo(upstream).head.commit.hexsha
+
+
+def test_mirror_evict(tmp_path: Path, upstream: Path):
+    store = MirrorStore(tmp_path / "mirrors", max_size=0)
+    for i, name in enumerate(("rpms/a", "rpms/b", "rpms/c")):
+        store.update(name, str(upstream), "c8s")
+        os.utime(store.repo_path(name), (i, i))
+
+    store.evict(keep=["rpms/a"])
+    # the most recently used mirror and the ones asked for are kept
+    assert store.repo_path("rpms/a").is_dir()
+    assert not store.repo_path("rpms/b").exists()
+    assert store.repo_path("rpms/c").is_dir()
+
+
+def test_source_git_cache_refresh(tmp_path: Path, upstream: Path):
+    cache = SourceGitCache(tmp_path / "repos", max_size=1024 ** 3)
+    repo = cache.checkout("source-git/acl", str(upstream), "c8s")
+    path = cache.repo_path("source-git/acl")
+    assert repo.working_dir == str(path)
+
+    # leftovers of a conversion
+    repo.git.checkout("-b", "updates")
+    commit_file(path, "local", "local change")
+    repo.git.tag("c8s-source-git")
+    path.joinpath("acl.spec").write_text("dirty")
+    path.joinpath("untracked").write_text("untracked")
+    # new changes in the remote
+    commit_file(upstream, "acl.patch", "fix")
+    subprocess.check_call(["git", "tag", "convert/c8s/1234"], cwd=upstream)
+
+    repo = cache.checkout("source-git/acl", str(upstream), "c8s")
+    assert [head.name for head in repo.heads] == ["c8s"]
+    assert [tag.name for tag in repo.tags] == ["convert/c8s/1234"]
+    assert repo.head.commit.hexsha == git.Repo(upstream).head.commit.hexsha
+    assert not repo.is_dirty(untracked_files=True)
+
+
+@pytest.mark.parametrize("break_it", ("objects", "url", "alternates"))
+def test_source_git_cache_reclone(tmp_path: Path, upstream: Path, break_it):
+    cache = SourceGitCache(tmp_path / "repos", max_size=1024 ** 3)
+    repo = cache.checkout("source-git/acl", str(upstream), "c8s")
+    if break_it == "objects":
+        shutil.rmtree(cache.repo_path("source-git/acl") / ".git" / "objects")
+    elif break_it == "url":
+        repo.git.remote("set-url", "origin", "https://example.com/acl.git")
+    else:
+        alternates = Path(repo.git_dir) / "objects" / "info" / "alternates"
+        alternates.write_text("/removed/BUILD/.git/objects\n")
+
+    repo = cache.checkout("source-git/acl", str(upstream), "c8s")
+    assert repo.remotes["origin"].url == str(upstream)
+    assert repo.head.commit.hexsha == git.Repo(upstream).head.commit.hexsha
+
+
+@pytest.mark.parametrize("clone_strategy", CLONE_STRATEGIES)
+def test_mirror_clone_strategy(tmp_path: Path, upstream: Path, clone_strategy):
+    subprocess.check_call(["git", "branch", "c8"], cwd=upstream)
+    url = f"file://{upstream}"
+    store = MirrorStore(
+        tmp_path / "mirrors", max_size=1024 ** 3, clone_strategy=clone_strategy
+    )
+    store.checkout("rpms/acl", url, tmp_path / "w1", "c8s")
+    shutil.rmtree(tmp_path / "w1")
+    commit_file(upstream, "acl.patch", "fix")
+
+    work_copy = store.checkout("rpms/acl", url, tmp_path / "w2", "c8s")
+    assert (tmp_path / "w2" / "acl.patch").read_text() == "fix"
+    assert work_copy.head.commit.hexsha == git.Repo(upstream).head.commit.hexsha
+
+    mirror = git.Repo(store.repo_path("rpms/acl"))
+    assert ("c8" in mirror.heads) == (clone_strategy in ("full", "blobless"))
+    assert (Path(mirror.git_dir) / "shallow").is_file() == (clone_strategy == "shallow")
+    if clone_strategy != "full":
+        assert mirror.git.config("remote.origin.partialclonefilter") == "blob:none"
+
+
+@pytest.mark.parametrize("clone_strategy", CLONE_STRATEGIES)
+def test_source_git_cache_clone_strategy(
+    tmp_path: Path, upstream: Path, clone_strategy
+):
+    subprocess.check_call(["git", "tag", "convert/c8s/1"], cwd=upstream)
+    subprocess.check_call(["git", "checkout", "-q", "-b", "c8"], cwd=upstream)
+    commit_file(upstream, "c8.patch", "c8")
+    subprocess.check_call(["git", "tag", "convert/c8/1"], cwd=upstream)
+    subprocess.check_call(["git", "checkout", "-q", "c8s"], cwd=upstream)
+    url = f"file://{upstream}"
+    cache = SourceGitCache(
+        tmp_path / "repos", max_size=1024 ** 3, clone_strategy=clone_strategy
+    )
+
+    repo = cache.checkout("source-git/acl", url, "c8s")
+    assert repo.active_branch.name == "c8s"
+    expected_tags = {"convert/c8s/1"}
+    if clone_strategy in ("full", "blobless"):
+        expected_tags.add("convert/c8/1")
+    assert {tag.name for tag in repo.tags} == expected_tags
+
+    # leftovers of a conversion and new changes in the remote
+    repo.git.tag("c8s-source-git")
+    subprocess.check_call(["git", "checkout", "-q", "c8"], cwd=upstream)
+    commit_file(upstream, "acl.patch", "fix")
+    subprocess.check_call(["git", "checkout", "-q", "c8s"], cwd=upstream)
+
+    repo = cache.checkout("source-git/acl", url, "c8")
+    assert [head.name for head in repo.heads] == ["c8"]
+    assert repo.head.commit.hexsha == git.Repo(upstream).heads["c8"].commit.hexsha
+    assert {tag.name for tag in repo.tags} == {"convert/c8s/1", "convert/c8/1"}
+
+    # a branch which is not in source-git yet
+    repo = cache.checkout("source-git/acl", url, "c9s")
+    assert repo.active_branch.name == "c8s"
+    assert not repo.is_dirty(untracked_files=True)
+
+
+def test_object_pool(tmp_path: Path, upstream: Path):
+    for i in range(20):
+        commit_file(upstream, f"file{i}", f"shared content {i}")
+    pool = ObjectPool(tmp_path / "pool.git")
+    mirrors = MirrorStore(tmp_path / "mirrors", max_size=1024 ** 3, pool=pool)
+    repos = SourceGitCache(tmp_path / "repos", max_size=1024 ** 3, pool=pool)
+    mirrors.update("rpms/acl", str(upstream), "c8s")
+    mirrors.update("rpms/acl-clone", str(upstream), "c8s")
+    repos.checkout("source-git/acl", str(upstream), "c8s")
+
+    sizes_before = get_size(mirrors.path) + get_size(repos.path)
+    for name in ("rpms/acl", "rpms/acl-clone"):
+        mirrors.share(name)
+    repos.share("source-git/acl")
+    # the objects are stored only once
+    assert get_size(mirrors.path) + get_size(repos.path) < sizes_before
+    assert pool.objects_dir in alternates_of(mirrors.repo_path("rpms/acl"))
+    pool_refs = git.Repo(pool.path).git.for_each_ref(format="%(refname)").split()
+    assert "refs/pool/mirrors/rpms/acl/heads/c8s" in pool_refs
+    assert "refs/pool/repos/source-git/acl/remotes/origin/c8s" in pool_refs
+
+    # the cached repos work as before
+    commit_file(upstream, "acl.patch", "fix")
+    work_copy = mirrors.checkout("rpms/acl", str(upstream), tmp_path / "w", "c8s")
+    assert (tmp_path / "w" / "file19").read_text() == "shared content 19"
+    repo = repos.checkout("source-git/acl", str(upstream), "c8s")
+    assert repo.head.commit.hexsha == work_copy.head.commit.hexsha
+    shutil.rmtree(tmp_path / "w")
+
+    # a member leaves, the others still have all their objects
+    os.utime(mirrors.repo_path("rpms/acl"), (0, 0))
+    mirrors.max_size = 0
+    mirrors.evict()
+    assert not mirrors.repo_path("rpms/acl").exists()
+    pool_refs = git.Repo(pool.path).git.for_each_ref(format="%(refname)").split()
+    assert not [
+        ref for ref in pool_refs if ref.startswith("refs/pool/mirrors/rpms/acl/")
+    ]
+    for path in (
+        mirrors.repo_path("rpms/acl-clone"),
+        repos.repo_path("source-git/acl"),
+    ):
+        subprocess.check_call(["git", "fsck", "--no-progress"], cwd=path)
+
+
+def test_object_pool_pending_push(tmp_path: Path, upstream: Path):
+    pool = ObjectPool(tmp_path / "pool.git")
+    mirrors = MirrorStore(tmp_path / "mirrors", max_size=1024 ** 3, pool=pool)
+    repos = SourceGitCache(tmp_path / "repos", max_size=1024 ** 3, pool=pool)
+    repo = repos.checkout("source-git/acl", str(upstream), "c8s")
+    repos.share("source-git/acl")
+    commit_file(upstream, "acl.tar.gz", "sources")
+    mirrors.update("rpms/acl", str(upstream), "c8s")
+    mirrors.share("rpms/acl")
+    # a commit not pushed yet, its blob is only in the pool, kept by the mirror
+    commit_file(repos.repo_path("source-git/acl"), "acl.tar.gz", "sources")
+    git_dir = Path(repo.git_dir)
+    before = sorted(git_dir.rglob("*"))
+
+    # being pushed, the repo is not touched
+    repos.share("source-git/acl", later=True)
+    repos.share_deferred(exclude=["source-git/acl"])
+    assert sorted(git_dir.rglob("*")) == sorted([*before, git_dir / "d2s-unshared"])
+    # and the objects it can borrow are kept in the pool
+    os.utime(mirrors.repo_path("rpms/acl"), (0, 0))
+    mirrors.update("rpms/other", str(upstream), "c8s")
+    mirrors.max_size = 0
+    mirrors.evict(prune=False)
+    assert not mirrors.repo_path("rpms/acl").exists()
+    subprocess.check_call(["git", "fsck", "--no-progress"], cwd=repo.working_dir)
+
+    # pushed, it's shared and the pool is cleaned up
+    repos.share_deferred()
+    assert not (git_dir / "d2s-unshared").exists()
+    pool.leave([], prune=True)
+    assert not (pool.path / "gc-pending").exists()
+    subprocess.check_call(["git", "fsck", "--no-progress"], cwd=repo.working_dir)
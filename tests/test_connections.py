@@ -0,0 +1,67 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import subprocess
+from pathlib import Path
+
+import pytest
+from flexmock import flexmock
+
+from dist2src.worker.connections import SSHMultiplexer, ssh_destination
+
+
+@pytest.mark.parametrize(
+    "url, destination",
+    (
+        (
+            "ssh://git@git.stg.centos.org/source-git/acl.git",
+            ("git@git.stg.centos.org", None),
+        ),
+        ("ssh://git@example.com:2222/acl.git", ("git@example.com", "2222")),
+        ("git@git.stg.centos.org:source-git/acl.git", ("git@git.stg.centos.org", None)),
+        ("https://git.centos.org/rpms/acl.git", None),
+        ("/var/cache/acl.git", None),
+    ),
+)
+def test_ssh_destination(url, destination):
+    assert ssh_destination(url) == destination
+
+
+def test_ssh_multiplexer(tmp_path: Path):
+    ssh = SSHMultiplexer(tmp_path / "ssh", persist=600)
+    url = "ssh://git@example.com/acl.git"
+    assert f"ControlPath={tmp_path}/ssh/%C" in ssh.env()["GIT_SSH_COMMAND"]
+
+    # no master connection yet, one is opened
+    flexmock(subprocess).should_receive("run").with_args(
+        ["ssh", "-O", "check", *ssh.ssh_options(), "git@example.com"],
+        capture_output=True,
+    ).and_return(flexmock(returncode=255)).and_return(
+        flexmock(returncode=0)
+    ).one_by_one()
+    flexmock(subprocess).should_receive("run").with_args(
+        [
+            "ssh",
+            "-f",
+            "-N",
+            "-o",
+            "BatchMode=yes",
+            *ssh.ssh_options(),
+            "git@example.com",
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=object,
+        timeout=60,
+    ).and_return(flexmock(returncode=0)).once()
+    reused, spent = ssh.open(url)
+    assert not reused
+    # the handshake time is known to the next tasks
+    assert ssh.open(url) == (True, spent)
+
+    assert ssh.open("https://git.centos.org/rpms/acl.git") is None
+    assert SSHMultiplexer(tmp_path / "ssh", persist=0).open(url) is None
+    assert SSHMultiplexer(tmp_path / "ssh", persist=0).env() == {}
+
+    ssh.close()
+    assert not list((tmp_path / "ssh").iterdir())
@@ -1,12 +1,18 @@
 # Copyright Contributors to the Packit project.
 # SPDX-License-Identifier: MIT
+import os
 import shutil
 import subprocess
 from pathlib import Path
+from typing import List
 
+import git
 import pytest
+from flexmock import flexmock
+from packit.patches import PatchMetadata
 
-from dist2src.core import Dist2Src
+from dist2src.base_cache import BaseCache
+from dist2src.core import Dist2Src, GitRepo, prep_applies_only_patches
 from tests.conftest import clone_package, run_dist2src
 
 this_dir = Path(__file__).parent
@@ -96,6 +102,85 @@ def test_pkg_name_when_paths_not_set():
     )
 
 
+@pytest.mark.parametrize(
+    "prep_lines, only_patches",
+    (
+        (["%autosetup -p1"], True),
+        (
+            ["%setup -q", "", "# fix the build", "%patch0 -p1", "%patch1 -p1 -b .fix"],
+            True,
+        ),
+        (["%setup -q", "%if 0%{?rhel}", "%patch0 -p1", "%endif", "%autopatch"], True),
+        (["%setup -q", "%patch0 -p1", "sed -i 's/a/b/' Makefile"], True),
+        (["%setup -q", "cp %{SOURCE1} .", "%patch0 -p1"], False),
+        (["%setup -q", "%patch0 -p1", "pushd doc", "%patch1 -p1", "popd"], False),
+        (["%setup -q", "%patch0 -p1", "%setup -T -D -a 1", "%patch1 -p1"], False),
+        ([], True),
+    ),
+)
+def test_prep_applies_only_patches(prep_lines, only_patches):
+    assert prep_applies_only_patches(prep_lines) == only_patches
+
+
+def test_base_key(tmp_path: Path):
+    dist_git = GitRepo(tmp_path / "acl", create=True)
+    (dist_git.repo_path / "SOURCES").mkdir()
+    (dist_git.repo_path / "SOURCES" / "acl.patch").write_text("fix")
+    dist_git.stage()
+    dist_git.commit("Add a patch")
+    d2s = Dist2Src(dist_git_path=dist_git.repo_path, source_git_path=None)
+    prep = ["%setup -q", "sed -i 's/a/b/' Makefile", "%patch0 -p1", "%patch1 -p1"]
+
+    # no checksums of the sources
+    assert d2s.base_key(prep) is None
+
+    metadata = dist_git.repo_path / ".acl.metadata"
+    metadata.write_text("6c9e46602adece1c2dae91ed065899d7f810bf01 SOURCES/acl.tar.gz\n")
+    key = d2s.base_key(prep)
+    assert key
+    # lines after the first patch don't change the base commit
+    assert d2s.base_key(prep[:3]) == key
+    assert d2s.base_key(["%autosetup -p1"]) != key
+    assert d2s.base_key(prep[:1] + ["cd x", "%setup -T -D -a 1"] + prep[2:]) is None
+    metadata.write_text("0a0c8380a0c8380a0c8380a0c8380a0c838aaaa SOURCES/acl.tar.gz\n")
+    assert d2s.base_key(prep) != key
+
+
+def test_prep_cache(tmp_path: Path):
+    """ %prep is not run again with the same inputs """
+    dist_git = GitRepo(tmp_path / "acl", create=True)
+    shutil.copytree(acl_template / "SPECS", dist_git.repo_path / "SPECS")
+    dist_git.stage()
+    dist_git.commit("Add the spec")
+    sources = dist_git.repo_path / "SOURCES"
+    sources.mkdir()
+    (sources / "acl-2.2.53.tar.gz").write_bytes(b"archive")
+    cache = BaseCache(tmp_path / "bases.git")
+    d2s = Dist2Src(
+        dist_git_path=dist_git.repo_path, source_git_path=None, base_cache=cache
+    )
+    key = d2s.prep_key(ensure_autosetup=True)
+    assert d2s.prep_key(ensure_autosetup=True) == key
+    assert d2s.prep_key(ensure_autosetup=False) != key
+
+    # the result of a previous %prep run
+    prep = GitRepo(tmp_path / "prep" / "BUILD" / "acl-2.2.53", create=True)
+    (prep.repo_path / "README").write_text("acl")
+    prep.stage()
+    prep.commit("acl-2.2.53 base")
+    cache.store_prep(key, prep.repo_path)
+
+    # no rpmbuild needed
+    d2s.run_prep()
+    assert d2s.BUILD_repo_path == dist_git.repo_path / "BUILD" / "acl-2.2.53"
+    assert d2s.BUILD_commits[0].message.startswith("acl-2.2.53 base")
+    assert (d2s.BUILD_repo_path / "README").read_text() == "acl"
+    assert not dist_git.repo.is_dirty()
+
+    (sources / "acl-2.2.53.tar.gz").write_bytes(b"another archive")
+    assert d2s.prep_key(ensure_autosetup=True) != key
+
+
 def test_run_prep(acl):
     run_dist2src(["-v", "run-prep", str(acl)], working_dir=acl)
 
@@ -110,6 +195,41 @@ def test_copy_unapplied_patches(acl):
     d2s.copy_conditional_patches()
 
 
+def test_copy_conditional_patches(tmp_path: Path):
+    dist_git = GitRepo(tmp_path / "d" / "acl", create=True).repo_path
+    (dist_git / "SOURCES").mkdir()
+    for name in ("applied.patch", "not-in-spec.patch", "conditional.patch"):
+        (dist_git / "SOURCES" / name).write_text(name)
+    BUILD = GitRepo(dist_git / "BUILD" / "acl-2.2.53", create=True)
+    for message in (
+        "Base commit",
+        "Apply a patch\n\npatch_name: applied.patch\npresent_in_specfile: true",
+        "Apply a patch\n\npatch_name: not-in-spec.patch\npresent_in_specfile: false",
+        "Changes after running %prep\n\nignore: true",
+    ):
+        BUILD.commit(message)
+    source_git = tmp_path / "s" / "acl"
+    (source_git / "SPECS").mkdir(parents=True)
+
+    d2s = Dist2Src(dist_git_path=dist_git, source_git_path=source_git)
+    d2s._dist_git_spec = flexmock(
+        get_patches=lambda: [
+            flexmock(get_patch_name=lambda name=name: name)
+            for name in ("applied.patch", "not-in-spec.patch", "conditional.patch")
+        ]
+    )
+    d2s.copy_conditional_patches()
+
+    assert sorted(p.name for p in (source_git / "SPECS").iterdir()) == [
+        "conditional.patch",
+        "not-in-spec.patch",
+    ]
+    # the commits are listed once and agree with the metadata packit reads
+    assert [c.hexsha for c in d2s.BUILD_commits] == BUILD.plumbing.rev_list()
+    patches = (PatchMetadata.from_commit(c, None) for c in BUILD.repo.iter_commits())
+    assert {p.name for p in patches if p.present_in_specfile} == {"applied.patch"}
+
+
 def test_meanwhile_is_right(meanwhile):
     run_dist2src(["-v", "run-prep", str(meanwhile)], working_dir=meanwhile)
     """
@@ -150,3 +270,111 @@ def test_no_backup(tmp_path: Path):
     assert b.is_dir()
     assert b.joinpath("lsvmbus").is_file()
     assert not b.joinpath("lsvmbus.lsvmbus_python3").exists()
+
+
+@pytest.mark.parametrize("single_commit_in_index", (False, True))
+def test_convert_single_commit(tmp_path: Path, single_commit_in_index):
+    dist_git = GitRepo(tmp_path / "d" / "kernel", create=True)
+    (dist_git.repo_path / "SPECS").mkdir()
+    (dist_git.repo_path / "SPECS" / "kernel.spec").write_text("Name: kernel")
+    (dist_git.repo_path / "SOURCES").mkdir()
+    (dist_git.repo_path / "SOURCES" / "config").write_text("CONFIG_X=y")
+    dist_git.stage()
+    dist_git.commit("Import kernel-4.18")
+    dist_git.checkout("c8", create_branch=True)
+    # an update: the previous conversion is in source-git
+    source_git = GitRepo(tmp_path / "s" / "kernel", create=True)
+    source_git.checkout("c8s", orphan=True)
+    (source_git.repo_path / "removed.c").write_text("removed")
+    (source_git.repo_path / "Makefile").write_text("old")
+    source_git.stage()
+    source_git.commit("Source-git repo for kernel")
+
+    def run_prep(ensure_autosetup):
+        BUILD = dist_git.repo_path / "BUILD" / "kernel-4.18"
+        (BUILD / "kernel").mkdir(parents=True)
+        (BUILD / "Makefile").write_text("new")
+        (BUILD / "kernel" / "fork.c").write_text("fork")
+        (BUILD / ".gitignore").write_text("*.o")
+        (BUILD / "kernel" / "fork.o").write_text("object")
+
+    d2s = Dist2Src(
+        dist_git_path=dist_git.repo_path,
+        source_git_path=source_git.repo_path,
+        single_commit_in_index=single_commit_in_index,
+    )
+    flexmock(d2s).should_receive("fetch_archive")
+    flexmock(d2s).should_receive("run_prep").replace_with(run_prep)
+    d2s._dist_git_spec = flexmock(
+        get_sources=lambda: [str(dist_git.repo_path / "SOURCES" / "config")],
+        get_patches=lambda: [],
+    )
+    d2s.convert_single_commit("c8", "c8s")
+
+    repo = source_git.repo
+    assert repo.head.commit.message == "Source-git repo for kernel\n"
+    assert len(repo.head.commit.parents) == 1
+    assert sorted(repo.git.ls_files().split()) == [
+        ".gitignore",
+        ".packit.yaml",
+        "Makefile",
+        "SPECS/config",
+        "SPECS/kernel.spec",
+        "kernel/fork.c",
+        "kernel/fork.o",
+    ]
+    assert (source_git.repo_path / "Makefile").read_text() == "new"
+    assert not (source_git.repo_path / "removed.c").exists()
+    assert not repo.is_dirty(untracked_files=True)
+    assert repo.tags["c8s-source-git"].commit == repo.head.commit
+
+
+def test_convert_deterministic(tmp_path: Path, monkeypatch):
+    dist_git = GitRepo(tmp_path / "d" / "kernel", create=True)
+    (dist_git.repo_path / "SPECS").mkdir()
+    (dist_git.repo_path / "SPECS" / "kernel.spec").write_text("Name: kernel")
+    dist_git.stage()
+    dist_git.commit("Import kernel-4.18")
+    dist_git.checkout("c8", create_branch=True)
+
+    def run_prep(ensure_autosetup):
+        BUILD = dist_git.repo_path / "BUILD" / "kernel-4.18"
+        BUILD.mkdir(parents=True)
+        (BUILD / "Makefile").write_text("new")
+
+    heads: List[git.Commit] = []
+    for attempt in ("first", "second"):
+        # converted at a different time
+        monkeypatch.setenv("GIT_COMMITTER_DATE", f"@{1600000000 + len(heads)} +0000")
+        shutil.rmtree(dist_git.repo_path / "BUILD", ignore_errors=True)
+        d2s = Dist2Src(
+            dist_git_path=dist_git.repo_path,
+            source_git_path=tmp_path / attempt,
+            deterministic=True,
+        )
+        flexmock(d2s).should_receive("fetch_archive")
+        flexmock(d2s).should_receive("run_prep").replace_with(run_prep)
+        d2s._dist_git_spec = flexmock(get_sources=lambda: [], get_patches=lambda: [])
+        d2s.convert("c8", "c8s")
+        heads.append(d2s.source_git.repo.head.commit)
+
+    assert heads[0].hexsha == heads[1].hexsha
+    assert heads[0].committed_date == dist_git.repo.head.commit.committed_date
+    assert heads[0].author.email == dist_git.repo.head.commit.author.email
+    # the environment is restored
+    assert os.environ["GIT_COMMITTER_DATE"] == "@1600000001 +0000"
+
+
+def test_convert_failure_share_objects(tmp_path: Path):
+    d2s = Dist2Src(
+        dist_git_path=None, source_git_path=tmp_path / "acl", share_objects=True
+    )
+    flexmock(d2s).should_receive("perform_convert").and_raise(
+        RuntimeError("rpmbuild failed")
+    )
+    # the borrowed objects are copied, its failure doesn't hide the real one
+    flexmock(d2s.source_git).should_receive("consolidate_objects").and_raise(
+        subprocess.CalledProcessError(128, ["git", "pack-objects"])
+    ).once()
+    with pytest.raises(RuntimeError, match="rpmbuild failed"):
+        d2s.convert("c8", "c8s")
@@ -0,0 +1,295 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+from git import GitCommandError
+
+from dist2src.constants import GIT_REPO_PROFILE
+from dist2src.core import GitRepo, RefIndex, git_profile_env
+
+
+@pytest.fixture()
+def repo(tmp_path: Path) -> GitRepo:
+    path = tmp_path / "repo"
+    git_repo = GitRepo(path, create=True)
+    (path / "src").mkdir()
+    (path / "src" / "main.c").write_text("int main() {}")
+    (path / "README").write_text("readme")
+    git_repo.stage()
+    git_repo.commit("Initial commit")
+    return git_repo
+
+
+def test_checkout_orphan(repo: GitRepo):
+    (repo.repo_path / "README").write_text("changed")
+    (repo.repo_path / "untracked").write_text("untracked")
+
+    repo.checkout("c8s", orphan=True)
+
+    assert repo.repo.head.ref.name == "c8s"
+    assert not repo.repo.head.is_valid()
+    assert repo.repo.git.ls_files() == ""
+    assert sorted(p.name for p in repo.repo_path.iterdir()) == [".git", "untracked"]
+
+
+def test_has_ref(repo: GitRepo, tmp_path: Path):
+    clone = GitRepo(tmp_path / "clone", create=True)
+    clone.repo.git.remote("add", "origin", str(repo.repo_path))
+    clone.repo.git.fetch("origin")
+    branch = repo.repo.active_branch.name
+
+    assert clone.has_ref(branch)
+    assert not clone.has_ref("c8s")
+    clone.checkout("c8s", orphan=True)
+    clone.commit("Orphan commit")
+    assert clone.has_ref("c8s")
+
+
+def test_get_tags_for_head(repo: GitRepo):
+    repo.repo.git.tag("imports/c8s/acl-1")
+    repo.repo.git.tag("imports/c8s/acl-2", annotate=True, message="annotated")
+    repo.commit("Another commit")
+    assert repo.get_tags_for_head() == []
+
+    repo.repo.git.tag("imports/c8s/acl-3", annotate=True, message="annotated")
+    repo.repo.git.tag("imports/c8s/acl-4")
+    repo.invalidate_refs()
+    assert repo.get_tags_for_head() == ["imports/c8s/acl-3", "imports/c8s/acl-4"]
+
+
+def test_plumbing(repo: GitRepo):
+    repo.commit("Second commit", body="key: value")
+    plumbing = repo.plumbing
+
+    assert plumbing.count_commits() == 2
+    assert plumbing.resolve("HEAD") == repo.repo.head.commit.hexsha
+    assert plumbing.resolve("refs/heads/nope") is None
+    assert plumbing.commit_message("HEAD") == "Second commit\n\nkey: value\n"
+    commits = list(plumbing.log())
+    assert [c.hexsha for c in commits] == plumbing.rev_list("HEAD")
+    assert [c.message for c in commits] == [c.message for c in repo.repo.iter_commits()]
+
+    plumbing.close()
+    # the processes are started again when needed
+    assert plumbing.resolve("HEAD") == repo.repo.head.commit.hexsha
+
+
+def test_cherry_pick_base(repo: GitRepo):
+    base = repo.repo.head.commit
+    branch = repo.repo.active_branch.name
+    (repo.repo_path / "README").write_text("patched")
+    repo.commit_all("Patch")
+    repo.checkout("c8s", orphan=True)
+    repo.commit("Orphan commit")
+
+    repo.cherry_pick_base(from_branch=branch, to_branch="c8s")
+    assert repo.repo.head.commit.message == base.message
+    assert (repo.repo_path / "README").read_text() == "readme"
+
+
+def test_ref_index(repo: GitRepo):
+    head = repo.repo.head.commit.hexsha
+    branch = repo.repo.active_branch.name
+    repo.repo.git.tag("lightweight")
+    repo.repo.git.tag("annotated", annotate=True, message="annotated")
+
+    refs = RefIndex(repo.repo)
+    assert refs.lookup(f"refs/heads/{branch}") == head
+    # annotated tags are peeled
+    assert refs.lookup("refs/tags/annotated") == head
+    assert refs.lookup("refs/heads/nope") is None
+    assert refs.refs_pointing_at(head) == [
+        f"refs/heads/{branch}",
+        "refs/tags/annotated",
+        "refs/tags/lightweight",
+    ]
+    assert refs.refs_pointing_at(head, prefix="refs/tags/") == [
+        "refs/tags/annotated",
+        "refs/tags/lightweight",
+    ]
+
+
+def test_ref_index_invalidation(repo: GitRepo):
+    branch = repo.repo.active_branch.name
+    assert repo.get_tags_for_head() == []
+
+    repo.create_tag("c8s-source-git", branch)
+    assert repo.get_tags_for_head() == ["c8s-source-git"]
+
+    repo.repo.git.tag("outside")
+    assert repo.get_tags_for_head() == ["c8s-source-git"]
+    repo.invalidate_refs()
+    assert repo.get_tags_for_head() == ["c8s-source-git", "outside"]
+
+    repo.checkout("c8s", create_branch=True)
+    assert repo.has_ref("c8s")
+
+
+def test_consolidate_objects(repo: GitRepo, tmp_path: Path):
+    BUILD = GitRepo(tmp_path / "BUILD", create=True)
+    for i in range(10):
+        (BUILD.repo_path / f"file{i}").write_text(str(i))
+    BUILD.stage()
+    BUILD.commit("Unpacked archive")
+    present = repo.refs.hexshas()
+    objects_before = repo.repo.git.count_objects()
+    # e.g. the object pool of the worker
+    pool = GitRepo(tmp_path / "pool", create=True)
+    alternates = repo.repo_path / ".git" / "objects" / "info" / "alternates"
+    alternates.write_text(f"{pool.repo_path / '.git' / 'objects'}\n")
+
+    repo.add_alternate(BUILD.repo_path / ".git" / "objects")
+    repo.fetch(BUILD.repo_path, "+HEAD:updates")
+    # nothing was copied
+    assert repo.repo.git.count_objects() == objects_before
+    repo.checkout("updates")
+    repo.commit("On top of the borrowed objects")
+
+    repo.consolidate_objects(exclude=present)
+    shutil.rmtree(BUILD.repo_path)
+    assert alternates.read_text() == f"{pool.repo_path / '.git' / 'objects'}\n"
+    subprocess.check_call(
+        ["git", "fsck", "--no-progress", "--strict"], cwd=repo.repo_path
+    )
+    assert (repo.repo_path / "file9").read_text() == "9"
+
+
+def legacy_cherry_pick(repo: GitRepo, commit: str, onto: str) -> str:
+    """ what 'git cherry-pick' creates for the commit """
+    repo.repo.git.checkout("--detach", onto)
+    repo.repo.git.cherry_pick(
+        commit, keep_redundant_commits=True, allow_empty=True, strategy_option="theirs"
+    )
+    return repo.repo.head.commit.hexsha
+
+
+@pytest.mark.parametrize(
+    "ours, theirs, same_as_git",
+    (
+        # a series replayed onto the same tree
+        ({}, {"README": "patched"}, True),
+        # changes to different files
+        ({"src/main.c": "int main() { return 0; }"}, {"README": "patched"}, True),
+        ({}, {"src/new.c": "new"}, True),
+        # changes to the same file are merged by git
+        ({"README": "changed"}, {"README": "patched"}, False),
+    ),
+)
+def test_pick_in_index(repo: GitRepo, monkeypatch, ours, theirs, same_as_git):
+    # the commits have to be created at the same time to be the same
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "@1600000000 +0000")
+    base = repo.plumbing.resolve("HEAD")
+    for path, content in theirs.items():
+        (repo.repo_path / path).write_text(content)
+    repo.stage()
+    repo.commit("Patch", body="patch_name: fix.patch")
+    commit = repo.plumbing.resolve("HEAD")
+    repo.repo.git.checkout("--detach", base)
+    for path, content in ours.items():
+        (repo.repo_path / path).write_text(content)
+    repo.commit_all("Ours")
+    onto = repo.plumbing.resolve("HEAD") if ours else base
+    index_before = (repo.repo_path / ".git" / "index").read_bytes()
+
+    picked = repo.pick_in_index(commit, onto=onto)
+
+    # neither the working tree nor the index were touched
+    assert (repo.repo_path / ".git" / "index").read_bytes() == index_before
+    assert not repo.repo.is_dirty(untracked_files=True)
+    if same_as_git:
+        assert picked == legacy_cherry_pick(repo, commit, onto)
+    else:
+        assert picked is None
+
+
+def test_pick_in_index_root_commit(repo: GitRepo, monkeypatch):
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "@1600000000 +0000")
+    onto = repo.plumbing.resolve("HEAD")
+    repo.checkout("c8s", orphan=True)
+    (repo.repo_path / "README").write_text("upstream readme")
+    (repo.repo_path / "acl.spec").write_text("Name: acl")
+    repo.stage()
+    repo.commit("Upstream sources")
+    commit = repo.plumbing.resolve("HEAD")
+
+    # README is added on both sides
+    assert repo.pick_in_index(commit, onto=onto) is None
+    picked = repo.pick_in_index(commit, onto=onto, theirs_if_added=True)
+    assert picked == legacy_cherry_pick(repo, commit, onto)
+    assert repo.pick_in_index(commit, onto=picked, keep_redundant=False) is None
+
+
+@pytest.mark.parametrize("gitattributes", (False, True))
+def test_revert_to_ref(repo: GitRepo, gitattributes):
+    if gitattributes:
+        (repo.repo_path / ".gitattributes").write_text("*.c text eol=crlf\n")
+        repo.stage()
+        repo.commit("Add attributes")
+    repo.repo.git.tag("sources")
+    upstream_tree = repo.plumbing.resolve("sources^{tree}")
+    (repo.repo_path / "README").write_text("patched")
+    (repo.repo_path / "SPECS").mkdir()
+    (repo.repo_path / "SPECS" / "acl.spec").write_text("Name: acl")
+    repo.stage()
+    repo.commit("Patches")
+    head = repo.plumbing.resolve("HEAD")
+    (repo.repo_path / "untracked").write_text("untracked")
+
+    assert repo.may_need_renormalization("sources") == gitattributes
+    repo.revert_to_ref("sources", commit_message="Revert", commit_body="to sources")
+
+    commit = repo.repo.head.commit
+    assert commit.tree.hexsha == upstream_tree
+    assert [parent.hexsha for parent in commit.parents] == [head]
+    assert commit.message == "Revert\n\nto sources\n"
+    assert not repo.repo.is_dirty(untracked_files=True)
+    assert (repo.repo_path / "README").read_text() == "readme"
+    assert not (repo.repo_path / "SPECS").exists()
+
+
+def test_fast_forward(repo: GitRepo):
+    branch = repo.repo.active_branch.name
+    repo.checkout("update", create_branch=True)
+    (repo.repo_path / "README").write_text("updated")
+    repo.commit_all("Update")
+    update = repo.plumbing.resolve("HEAD")
+
+    repo.fast_forward(branch=branch, to_ref="update")
+    assert repo.repo.active_branch.name == branch
+    assert repo.plumbing.resolve(f"refs/heads/{branch}") == update
+    assert not repo.repo.is_dirty(untracked_files=True)
+
+    # diverged branches are not fast-forwarded
+    repo.checkout("diverged", create_branch=True)
+    repo.repo.git.reset("--hard", "HEAD~1")
+    repo.commit("Diverged")
+    with pytest.raises(GitCommandError):
+        repo.fast_forward(branch=branch, to_ref="diverged")
+
+
+def test_repo_profile(repo: GitRepo, tmp_path: Path, monkeypatch):
+    # only when asked for
+    for key in GIT_REPO_PROFILE:
+        assert not repo.repo.git.config("--local", key, with_exceptions=False)
+    profiled = GitRepo(tmp_path / "profiled", create=True, profile=True)
+    for key, value in GIT_REPO_PROFILE.items():
+        assert profiled.repo.git.config("--local", key) == value
+
+    # repos created by other tools get it from the environment
+    monkeypatch.setenv("GIT_CONFIG_PARAMETERS", "'user.name'='Packit'")
+    subprocess.check_call(["git", "init", "-q", str(tmp_path / "BUILD")])
+    env = {**os.environ, **git_profile_env()}
+    for key, value in (*GIT_REPO_PROFILE.items(), ("user.name", "Packit")):
+        assert (
+            subprocess.check_output(
+                ["git", "config", key], cwd=tmp_path / "BUILD", env=env
+            )
+            .decode()
+            .strip()
+            == value
+        )
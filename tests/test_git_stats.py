@@ -0,0 +1,62 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import os
+import subprocess
+from pathlib import Path
+
+import git
+import pytest
+
+from dist2src.git_stats import GitStats, command_name, run_git
+
+
+@pytest.mark.parametrize(
+    "args, name",
+    (
+        (["git", "add", "-f", "."], "add"),
+        (["git", "-c", "user.name=x", "commit", "-m", "msg"], "commit"),
+        (["git", "--no-pager", "-C", "/tmp", "log"], "log"),
+        (["git", "--version"], "git"),
+    ),
+)
+def test_command_name(args, name):
+    assert command_name(args) == name
+
+
+def test_git_stats(tmp_path: Path):
+    repo = git.Repo.init(tmp_path)
+    with GitStats() as outer:
+        repo.git.status()
+        with GitStats() as inner:
+            repo.git.status()
+            with pytest.raises(git.GitCommandError):
+                repo.git.rev_parse("--verify", "nope")
+            run_git(
+                ["git", "rev-parse", "--git-dir"],
+                cwd=tmp_path,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+    repo.git.status()
+
+    assert outer.commands["status"].calls == 2
+    assert inner.commands["status"].calls == 1
+    assert inner.commands["rev-parse"].calls == 2
+    assert inner.commands["rev-parse"].failures == 1
+    assert inner.commands["rev-parse"].output_bytes == len(".git\n")
+    assert not GitStats.active()
+    assert "rev-parse" in inner.summary()
+
+
+def test_record_trace2(tmp_path: Path):
+    trace = tmp_path / "trace2.json"
+    env = {**os.environ, "GIT_TRACE2_EVENT": str(trace)}
+    subprocess.run(["git", "init", "-q", str(tmp_path / "repo")], env=env)
+    subprocess.run(["git", "status"], cwd=tmp_path / "repo", env=env)
+
+    with GitStats() as stats:
+        GitStats.record_trace2(trace)
+    assert stats.commands["init"].calls == 1
+    assert stats.commands["status"].calls == 1
+    assert stats.total_seconds() > 0
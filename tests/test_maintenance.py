@@ -0,0 +1,71 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+from pathlib import Path
+
+import git
+import pytest
+from flexmock import flexmock
+
+from dist2src.worker.maintenance import Maintenance, RepoHealth
+
+
+@pytest.fixture()
+def source_git(tmp_path: Path) -> git.Repo:
+    upstream = git.Repo.init(tmp_path / "upstream")
+    for i in range(5):
+        (tmp_path / "upstream" / f"file{i}").write_text(str(i))
+        upstream.git.add(f"file{i}")
+        upstream.git.commit("-m", f"Commit {i}")
+    upstream.git.branch("c8")
+    repo = git.Repo.clone_from(str(tmp_path / "upstream"), tmp_path / "repo")
+    # leftovers of conversions, loose objects included
+    repo.git.checkout("-b", "c8", "origin/c8")
+    for branch in ("updates", "imports/c8/acl-2.2.53-1.el8"):
+        repo.git.branch(branch)
+    for i in range(10):
+        (tmp_path / "repo" / f"patch{i}").write_text(str(i))
+        repo.git.add(f"patch{i}")
+        repo.git.commit("-m", f"Patch {i}")
+    return repo
+
+
+def test_maintenance(source_git: git.Repo, tmp_path: Path):
+    health = RepoHealth.of(source_git)
+    assert health.loose_objects >= 30
+    assert not health.commit_graph
+
+    maintenance = Maintenance(budget=60, max_loose_objects=10)
+    steps = maintenance.run([Path(source_git.working_dir), tmp_path / "not-a-repo"])
+
+    assert steps == {"prune_branches": 1, "repack_loose": 1, "write_commit_graph": 1}
+    health = RepoHealth.of(source_git)
+    assert health.loose_objects == 0
+    assert health.commit_graph
+    # the checked out branch and the ones in the remote are kept
+    default_branch = source_git.remotes.origin.refs.HEAD.ref.remote_head
+    assert sorted(head.name for head in source_git.heads) == sorted(
+        ["c8", default_branch]
+    )
+
+    # nothing else to do
+    assert maintenance.run([Path(source_git.working_dir)]) == {}
+
+
+def test_maintenance_repack_all(source_git: git.Repo):
+    for _ in range(3):
+        source_git.git.repack("-q")
+        source_git.git.commit("--allow-empty", "-m", "More history")
+    assert RepoHealth.of(source_git).packs > 2
+
+    steps = Maintenance(budget=60, max_packs=2).run([Path(source_git.working_dir)])
+    assert steps["repack_all"] == 1
+    assert RepoHealth.of(source_git).packs == 1
+    assert list((Path(source_git.git_dir) / "objects" / "pack").glob("*.bitmap"))
+
+
+def test_maintenance_budget(source_git: git.Repo):
+    # checking the repositories counts into the budget too
+    flexmock(RepoHealth).should_receive("of").never()
+    assert Maintenance(budget=0).run([Path(source_git.working_dir)]) == {}
+    assert [head.name for head in source_git.heads if head.name == "updates"]
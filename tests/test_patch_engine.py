@@ -0,0 +1,208 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import os
+import subprocess
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from dist2src.base_cache import BaseCache
+from dist2src.patch_engine import FastImport, PatchEngine, commit_message
+
+PACKITPATCH = Path(__file__).parent.parent / "packitpatch"
+
+
+@pytest.mark.parametrize(
+    "patch_id, patch_args, message",
+    (
+        (
+            "0",
+            ["-p1", "--fuzz=0"],
+            "Apply patch fix.patch\n\npatch_name: fix.patch\n"
+            "present_in_specfile: true\nlocation_in_specfile: 0\n",
+        ),
+        (
+            "%{2}",
+            ["-p0", "-b", ".fix"],
+            "Apply patch fix.patch\n\npatch_name: fix.patch\n"
+            "present_in_specfile: true\nno_prefix: true\n",
+        ),
+        (
+            "12",
+            ["-p", "0"],
+            "Apply patch fix.patch\n\npatch_name: fix.patch\n"
+            "present_in_specfile: true\nno_prefix: true\nlocation_in_specfile: 12\n",
+        ),
+    ),
+)
+def test_commit_message(patch_id, patch_args, message):
+    assert commit_message("fix.patch", patch_id, patch_args) == message
+
+
+def git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=repo, stdout=subprocess.PIPE, check=True, text=True
+    ).stdout
+
+
+def make_patches(tmp_path: Path):
+    """ patches between the versions of a scratch repo, with their arguments """
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    git(scratch, "init", "-q")
+    (scratch / "README").write_text("base\n")
+    (scratch / "obsolete.c").write_text("int x;\n")
+    (scratch / ".gitignore").write_text("*.o\n")
+    git(scratch, "add", ".")
+    git(scratch, "commit", "-q", "-m", "base")
+    patches: List[Tuple[Path, str, List[str]]] = []
+
+    def snapshot(patch_id, patch_args, *diff_args):
+        patch = tmp_path / f"{len(patches)}-change.patch"
+        git(scratch, "add", "-f", ".")
+        patch.write_text(git(scratch, "diff", "--cached", *diff_args))
+        git(scratch, "commit", "-q", "--allow-empty", "-m", patch.name)
+        patches.append((patch, patch_id, patch_args))
+
+    (scratch / "README").write_text("base\npatched\n")
+    (scratch / "src").mkdir()
+    (scratch / "src" / "new file.c").write_text("int y;\n")
+    (scratch / "src" / "other.c").write_text("int z;\n")
+    # ignored, still committed by 'git add -f .'
+    (scratch / "src" / "prebuilt.o").write_text("binary\n")
+    snapshot("0", ["-p1", "--fuzz=0"])
+    (scratch / "obsolete.c").unlink()
+    snapshot("1", ["-p1", "-b", "--suffix", ".old"])
+    (scratch / "README").write_text("base\npatched\nagain\n")
+    snapshot("%{2}", ["-p0"], "--no-prefix")
+    (scratch / "run.sh").write_text("#!/bin/sh\n")
+    (scratch / "run.sh").chmod(0o755)
+    snapshot("3", ["-p1"])
+    # nothing to commit, packitpatch allows empty patches
+    snapshot("4", ["-p1"])
+    (scratch / "src" / "other.c").rename(scratch / "src" / "[renamed].c")
+    snapshot("5", ["-p1", "-s"], "-M")
+    return patches
+
+
+def apply_patches(tmp_path: Path, patches, env, mode: str) -> Path:
+    repo = tmp_path / mode / "BUILD" / "pkg-1.0"
+    repo.mkdir(parents=True)
+    git(repo, "init", "-q")
+    (repo / "README").write_text("base\n")
+    (repo / "obsolete.c").write_text("int x;\n")
+    (repo / ".gitignore").write_text("*.o\n")
+    subprocess.run(
+        [str(PACKITPATCH), "--base", "pkg-1.0 base"],
+        cwd=repo,
+        stdout=subprocess.DEVNULL,
+        env=env,
+        check=True,
+    )
+
+    if mode.endswith("patched"):
+        env = {**env, "PACKIT_PATCH_STAGING": "patched"}
+    engine = PatchEngine(env) if mode.startswith("engine") else None
+    if engine:
+        engine.start()
+    for patch, patch_id, patch_args in patches:
+        # this is how rpm runs it, %{1} is not expanded for %__patch
+        with open(patch) as stdin:
+            subprocess.run(
+                [str(PACKITPATCH), "%{1}", patch_id, *patch_args],
+                cwd=repo,
+                stdin=stdin,
+                stdout=subprocess.DEVNULL,
+                env={**env, **(engine.env() if engine else {})},
+                check=True,
+            )
+    if engine:
+        engine.close()
+        assert engine.commits == len(patches)
+    return repo
+
+
+@pytest.mark.parametrize("mode", ("engine", "patched", "engine-patched"))
+def test_patch_engine(tmp_path: Path, monkeypatch, mode):
+    """
+    The engine, and packitpatch staging only the patched files,
+    create the same commits as packitpatch staging the whole tree.
+    """
+    monkeypatch.setenv("GIT_AUTHOR_DATE", "@1600000000 +0000")
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "@1600000000 +0000")
+    env = dict(os.environ)
+    patches = make_patches(tmp_path)
+    legacy = apply_patches(tmp_path, patches, env, mode="legacy")
+    if mode == "engine-patched":
+        # only the patched files are read, the tree is not scanned
+        git_command = FastImport._git
+
+        def no_status(self, *args):
+            assert args[0] != "status"
+            return git_command(self, *args)
+
+        monkeypatch.setattr(FastImport, "_git", no_status)
+    repo = apply_patches(tmp_path, patches, env, mode=mode)
+
+    assert git(repo, "log", "--format=%H") == git(legacy, "log", "--format=%H")
+    assert git(repo, "rev-list", "--count", "HEAD") == f"{len(patches) + 1}\n"
+    assert "no_prefix: true" in git(repo, "log", "-1", "--format=%B", "HEAD~3")
+    assert (
+        git(repo, "show", "--format=", "--name-status", "HEAD~4") == "D\tobsolete.c\n"
+    )
+    assert git(repo, "ls-files", "-s", "run.sh").startswith("100755")
+    assert git(repo, "ls-files", "src/prebuilt.o", "src/[renamed].c").count("\n") == 2
+    assert not git(repo, "status", "--porcelain", "--untracked-files=all")
+
+
+def test_patch_cache(tmp_path: Path, monkeypatch):
+    """ the results of the patches applied before are reused, with the same commits """
+    monkeypatch.setenv("GIT_AUTHOR_DATE", "@1600000000 +0000")
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "@1600000000 +0000")
+    env = dict(os.environ)
+    patches = make_patches(tmp_path)
+    legacy = apply_patches(tmp_path, patches, env, mode="legacy")
+    cache = BaseCache(tmp_path / "bases.git")
+
+    def apply_cached(mode, patches):
+        results = tmp_path / f"{mode}.results"
+        cache_env = {
+            **env,
+            "PACKIT_PATCH_STAGING": "patched",
+            **cache.env(None),
+            **cache.patch_env(results),
+        }
+        repo = apply_patches(tmp_path, patches, cache_env, mode=mode)
+        assert git(repo, "log", "--format=%H") == git(legacy, "log", "--format=%H")
+        assert not git(repo, "status", "--porcelain", "--untracked-files=all")
+        return cache.store_patches(results, repo)
+
+    assert apply_cached("first", patches) == (0, len(patches))
+    assert apply_cached("second", patches) == (len(patches), 0)
+    # other arguments, the same result, the next patches are reused
+    patches[1] = (patches[1][0], patches[1][1], ["-p1"])
+    assert apply_cached("third", patches) == (len(patches) - 1, 1)
+
+
+def test_patch_engine_failure(tmp_path: Path):
+    """ packitpatch fails when the commit can't be created """
+    repo = tmp_path / "BUILD" / "pkg-1.0"
+    repo.mkdir(parents=True)
+    git(repo, "init", "-q")
+    # no base commit to build on
+    patch = tmp_path / "empty.patch"
+    patch.write_text("")
+
+    with PatchEngine() as engine, open(patch) as stdin:
+        result = subprocess.run(
+            [str(PACKITPATCH), "%{1}", "0", "-p1"],
+            cwd=repo,
+            stdin=stdin,
+            stderr=subprocess.PIPE,
+            env={**os.environ, **engine.env()},
+            text=True,
+        )
+    assert result.returncode == 1
+    assert "error:" in result.stderr
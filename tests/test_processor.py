@@ -4,12 +4,15 @@
 import os
 import logging
 import shutil
-import git
-
+import pytest
 from flexmock import flexmock
 from pathlib import Path
 from ogr import PagureService
 from dist2src.worker.processor import Processor
+from dist2src.worker.pusher import Pusher, PushJob
+from dist2src.base_cache import BaseCache
+from dist2src.worker.cache import MirrorStore, SourceGitCache
+from dist2src.worker.connections import SSHMultiplexer
 from dist2src.worker.monitoring import Pushgateway
 from dist2src.worker import processor
 from dist2src.core import Dist2Src
@@ -35,6 +38,76 @@ def test_event_not_for_dist_git_namespace(caplog):
         .and_return(None)
         .ordered()
     )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_MIRROR_MAX_SIZE", str(4 * 1024 ** 3))
+        .and_return("1024")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_SRC_GIT_CACHE_MAX_SIZE", str(4 * 1024 ** 3))
+        .and_return("1024")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_BASE_CACHE_MAX_SIZE", "0")
+        .and_return("1024")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_CLONE_STRATEGY", "full")
+        .and_return("full")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_MAINTENANCE_BUDGET", "0")
+        .and_return("0")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_SSH_CONTROL_PERSIST", "600")
+        .and_return("600")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_PUSH_QUEUE_SIZE", "0")
+        .and_return("0")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_PUSH_ATTEMPTS", "3")
+        .and_return("3")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_PUSH_BACKOFF", "10")
+        .and_return("10")
+        .ordered()
+    )
+    (
+        flexmock(os)
+        .should_receive("getenv")
+        .with_args("D2S_PUSH_SHUTDOWN_TIMEOUT", "300")
+        .and_return("300")
+        .ordered()
+    )
     flexmock(os).should_receive("getenv").and_return("blah")
     flexmock(Dist2Src).should_receive("convert").never()
     flexmock(Pushgateway).should_receive("push_received_message").with_args(
@@ -121,7 +194,11 @@ def test_already_up_to_date(caplog):
         .and_return(src_git_project)
     )
     src_git_project.should_receive("exists").and_return(True)
-    src_git_project.should_receive("get_tags").and_return(["convert/c8s/0a0c838"])
+    # a push of the previous conversion, still queued, can create the tag
+    flexmock(Pusher).should_receive("wait").with_args("source-git/acl").once().ordered()
+    src_git_project.should_receive("get_tags").and_return(
+        ["convert/c8s/0a0c838"]
+    ).once().ordered()
     flexmock(Pushgateway).should_receive("push_received_message").with_args(
         ignored=True
     ).once()
@@ -137,10 +214,13 @@ def test_already_up_to_date(caplog):
         assert "The source-git repo is already up to date" in caplog.text
 
 
-def test_conversion(caplog):
+@pytest.mark.parametrize("up_to_date", (False, True))
+def test_conversion(caplog, monkeypatch, up_to_date):
     """
     When the branch and repository needs to be updated, conversion is triggered.
     """
+    monkeypatch.setenv("D2S_BASE_CACHE_MAX_SIZE", str(2 * 1024 ** 3))
+    monkeypatch.setenv("D2S_MAINTENANCE_BUDGET", "30")
     # Source-git project exists.
     src_git_project = flexmock(
         service=flexmock(api_url="https://url/api/0/"),
@@ -158,33 +238,60 @@ def test_conversion(caplog):
 
     # Previous working directories are cleaned up.
     flexmock(shutil).should_receive("rmtree")
-    # Dist-git repo is cloned and the branch is checked out.
+    # Dist-git mirror is updated and the branch is checked out.
     dist_git_repo = flexmock(
         git=flexmock(), branches={"c8s": flexmock(commit=flexmock(hexsha="0a0c838"))}
     )
     (
-        flexmock(git.Repo)
-        .should_receive("clone_from")
-        .with_args("https://git.centos.org/rpms/acl.git", Path("/workdir/rpms/acl"))
+        flexmock(MirrorStore)
+        .should_receive("checkout")
+        .with_args(
+            "rpms/acl",
+            "https://git.centos.org/rpms/acl.git",
+            Path("/workdir/rpms/acl"),
+            "c8s",
+        )
         .and_return(dist_git_repo)
         .once()
         .ordered()
     )
-    dist_git_repo.git.should_receive("checkout").with_args("c8s").ordered()
+    # Objects are moved to the pool (if enabled).
+    flexmock(MirrorStore).should_receive("share").with_args("rpms/acl").once()
+    flexmock(SourceGitCache).should_receive("share").with_args(
+        "source-git/acl", later=False
+    ).once()
+    flexmock(SourceGitCache).should_receive("share_deferred").with_args(
+        exclude=[]
+    ).once()
+    # Mirrors which are not needed anymore are evicted.
+    flexmock(MirrorStore).should_receive("evict").with_args(
+        keep=["rpms/acl"], prune=True
+    ).once()
+    flexmock(SourceGitCache).should_receive("evict").with_args(
+        keep=["source-git/acl"], prune=True
+    ).once()
+    flexmock(BaseCache).should_receive("evict").once()
 
-    # Source-git repo is cloned and the branch is checked out.
+    # Cached source-git repo is refreshed and the branch is checked out.
     src_git_project.should_receive("get_git_urls").and_return(
         {"ssh": "ssh://git@git.stg.centos.org"}
     )
+    # The SSH connection to source-git is reused.
+    flexmock(SSHMultiplexer).should_receive("open").with_args(
+        "ssh://git@git.stg.centos.org"
+    ).and_return((True, 0.5)).once()
+    flexmock(Pushgateway).should_receive("push_ssh_connection").with_args(
+        True, 0.5
+    ).once()
     src_git_repo = flexmock(
         git=flexmock(),
         references=[flexmock(remote_head="c8s")],
         heads={"c8s": flexmock(commit="newcommithash")},
     )
     (
-        flexmock(git.Repo)
-        .should_receive("clone_from")
-        .with_args("ssh://git@git.stg.centos.org", Path("/workdir/source-git/acl"))
+        flexmock(SourceGitCache)
+        .should_receive("checkout")
+        .with_args("source-git/acl", "ssh://git@git.stg.centos.org", "c8s")
         .and_return(src_git_repo)
         .once()
         .ordered()
@@ -192,41 +299,80 @@ def test_conversion(caplog):
     src_git_repo.git.should_receive("checkout").with_args("c8s").ordered()
 
     # Conversion is run.
-    d2s = flexmock()
+    d2s = flexmock(patch_cache_hits=2, patch_cache_misses=1)
     (
         flexmock(processor)
         .should_receive("Dist2Src")
         .with_args(
             dist_git_path=Path("/workdir/rpms/acl"),
-            source_git_path=Path("/workdir/source-git/acl"),
+            source_git_path=Path("/workdir/cache/repos/source-git/acl"),
+            share_objects=False,
+            single_commit_in_index=False,
+            deterministic=False,
+            patch_engine=False,
+            base_cache=BaseCache,
+            git_profile=False,
         )
         .and_return(d2s)
     )
     d2s.should_receive("convert").with_args("c8s", "c8s")
-    # Result is tagged.
-    src_git_repo.git.should_receive("tag").with_args(
-        "--annotate",
-        "--message",
-        "Converted from commit 0a0c838,\nfrom branch c8s.",
+    # The patches reused from the cache are counted.
+    flexmock(Pushgateway).should_receive("push_patch_cache").with_args(2, 1).once()
+    # The conversion tag is prepared, it's created once the result is pushed.
+    flexmock(processor).should_receive("create_tag_object").with_args(
+        src_git_repo,
         "convert/c8s/0a0c838",
         "newcommithash",
+        "Converted from commit 0a0c838,\nfrom branch c8s.",
+    ).and_return("tagobject")
+    # Result is pushed, unless source-git has it already.
+    src_git_repo.git.should_receive("ls_remote").with_args(
+        "origin", "refs/heads/c8s"
+    ).and_return(
+        f"{'newcommithash' if up_to_date else 'oldcommithash'}\trefs/heads/c8s"
     )
-    # Result is pushed.
-    src_git_repo.git.should_receive("push").with_args(
-        "origin", "c8s", tags=True, force=True
+    refspecs = []
+    if not up_to_date:
+        refspecs = [
+            "+refs/heads/c8s:refs/heads/c8s",
+            "+refs/tags/c8s-source-git:refs/tags/c8s-source-git",
+        ]
+    flexmock(Pusher).should_receive("submit").with_args(
+        PushJob(
+            fullname="source-git/acl",
+            repo_path=Path("/workdir/cache/repos/source-git/acl"),
+            refspecs=refspecs,
+            tag="convert/c8s/0a0c838",
+            tag_object="tagobject",
+            env=SSHMultiplexer(Path("/workdir/cache/ssh"), persist=600).env(),
+        )
     ).once()
 
     flexmock(Pushgateway).should_receive("push_received_message").with_args(
         ignored=False
     ).once()
-    flexmock(Pushgateway).should_receive("push_created_update").once()
+    flexmock(Pushgateway).should_receive("push_conversion_duration").once()
+    flexmock(Pushgateway).should_receive("push_git_commands").once()
+    # The cached repositories are maintained.
+    flexmock(processor.Maintenance).should_receive("run").and_return({}).once()
+    flexmock(Pushgateway).should_receive("push_maintenance").once()
+    flexmock(processor).should_receive("get_size").with_args(
+        Path("/workdir")
+    ).and_return(1024)
+    flexmock(Pushgateway).should_receive("push_worker_volume_size").with_args(
+        1024
+    ).once()
 
     flexmock(worker_logging).should_receive("set_logging_to_file").once()
+    # Git processes and caches are released at the end.
+    dist_git_repo.should_receive("close").once()
+    src_git_repo.should_receive("close").once()
 
-    Processor().process_message(
-        {
-            "repo": {"fullname": "rpms/acl", "name": "acl"},
-            "branch": "c8s",
-            "end_commit": "0a0c838",
-        }
-    )
+    with Processor() as p:
+        p.process_message(
+            {
+                "repo": {"fullname": "rpms/acl", "name": "acl"},
+                "branch": "c8s",
+                "end_commit": "0a0c838",
+            }
+        )
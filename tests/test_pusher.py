@@ -0,0 +1,112 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import threading
+from pathlib import Path
+
+import pytest
+from flexmock import flexmock
+from git import GitCommandError
+
+from dist2src.core import GitRepo
+from dist2src.worker import pusher
+from dist2src.worker.monitoring import Pushgateway
+from dist2src.worker.pusher import Pusher, PushJob, create_tag_object, push_refs
+
+
+@pytest.fixture()
+def repos(tmp_path: Path):
+    remote = GitRepo(tmp_path / "remote", create=True)
+    remote.repo.git.config("receive.denyCurrentBranch", "ignore")
+    repo = GitRepo(tmp_path / "local", create=True)
+    repo.repo.git.remote("add", "origin", str(remote.repo_path))
+    repo.checkout("c8s", orphan=True)
+    repo.commit("Converted")
+    repo.create_tag("c8s-source-git", "c8s")
+    repo.repo.git.tag("unrelated")
+    return repo, remote
+
+
+REFSPECS = [
+    "+refs/heads/c8s:refs/heads/c8s",
+    "+refs/tags/c8s-source-git:refs/tags/c8s-source-git",
+]
+
+
+def remote_refs(remote: GitRepo):
+    return remote.repo.git.for_each_ref(format="%(refname)").split()
+
+
+def test_push_refs(repos):
+    repo, remote = repos
+
+    refs, size = push_refs(repo.repo, REFSPECS)
+    assert refs == 2
+    assert size > 0
+    assert remote_refs(remote) == ["refs/heads/c8s", "refs/tags/c8s-source-git"]
+    # nothing changed
+    assert push_refs(repo.repo, REFSPECS) == (0, 0)
+
+
+def job_for(repo: GitRepo, refspecs=REFSPECS) -> PushJob:
+    tag = "convert/c8s/0a0c838"
+    return PushJob(
+        fullname="source-git/acl",
+        repo_path=repo.repo_path,
+        refspecs=refspecs,
+        tag=tag,
+        tag_object=create_tag_object(
+            repo.repo, tag, repo.plumbing.resolve("HEAD"), "Converted"
+        ),
+        env={},
+    )
+
+
+def test_pusher(repos):
+    repo, remote = repos
+    job = job_for(repo)
+    # not created before the push
+    assert "convert/c8s/0a0c838" not in repo.repo.tags
+    flexmock(Pushgateway).should_receive("push_pushed_refs").with_args(3, object)
+    flexmock(Pushgateway).should_receive("push_created_update").once()
+
+    # the next conversion of the repo waits for the push
+    pushing = threading.Event()
+    push = Pusher.push
+
+    def slow_push(job):
+        pushing.wait()
+        push(p, job)
+
+    flexmock(Pusher).should_receive("push").replace_with(slow_push)
+    p = Pusher(max_pending=2)
+    p.submit(job)
+    assert p.pending() == ["source-git/acl"]
+    assert not p.wait("source-git/acl", timeout=0.1)
+    assert p.wait("source-git/other", timeout=0.1)
+    pushing.set()
+    assert p.wait("source-git/acl", timeout=10)
+
+    assert p.pending() == []
+    assert remote_refs(remote) == [
+        "refs/heads/c8s",
+        "refs/tags/c8s-source-git",
+        "refs/tags/convert/c8s/0a0c838",
+    ]
+    assert repo.repo.tags["convert/c8s/0a0c838"].tag.message == "Converted"
+
+
+def test_pusher_retries(repos):
+    repo, remote = repos
+    job = job_for(repo, refspecs=[])
+    flexmock(pusher.time).should_receive("sleep").with_args(5).once()
+    flexmock(pusher.time).should_receive("sleep").with_args(10).once()
+    flexmock(Pushgateway).should_receive("push_failed_push").once()
+    flexmock(pusher).should_receive("push_refs").and_raise(
+        GitCommandError(["git", "push"], 128)
+    ).times(3)
+
+    with pytest.raises(GitCommandError):
+        Pusher(max_pending=0, attempts=3, backoff=5).submit(job)
+    # the conversion is not marked as done
+    assert "convert/c8s/0a0c838" not in repo.repo.tags
@@ -0,0 +1,70 @@
+# Copyright Contributors to the Packit project.
+# SPDX-License-Identifier: MIT
+
+import gc
+import os
+from pathlib import Path
+from typing import List
+
+from dist2src.core import Dist2Src, GitRepo
+
+
+def child_processes() -> List[int]:
+    pids = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            status = (entry / "status").read_text()
+        except OSError:
+            continue
+        if f"\nPPid:\t{os.getpid()}\n" in status:
+            pids.append(int(entry.name))
+    return pids
+
+
+def rss() -> int:
+    """ resident set size of this process, in kB """
+    status = Path("/proc/self/status").read_text()
+    return int(status.split("VmRSS:", 1)[1].split()[0])
+
+
+def convert(tmp_path: Path, i: int):
+    """ the git work of a conversion, without running rpmbuild """
+    dist_git = GitRepo(tmp_path / f"d{i}" / "acl", create=True)
+    (dist_git.repo_path / "acl.spec").write_text("Name: acl")
+    dist_git.stage()
+    dist_git.commit("Import")
+    BUILD = GitRepo(dist_git.repo_path / "BUILD" / "acl-2.2.53", create=True)
+    (BUILD.repo_path / "README").write_text("readme")
+    BUILD.stage()
+    BUILD.commit("acl-2.2.53 base")
+    for patch in range(5):
+        (BUILD.repo_path / "README").write_text(str(patch))
+        BUILD.stage()
+        BUILD.commit(f"Apply patch {patch}.patch", body=f"patch_name: {patch}.patch")
+    BUILD.close()
+
+    with Dist2Src(
+        dist_git_path=dist_git.repo_path, source_git_path=tmp_path / f"s{i}" / "acl"
+    ) as d2s:
+        d2s.source_git.checkout("c8s", orphan=True)
+        d2s.fetch_branch(source_branch="master", dest_branch="updates")
+        d2s.source_git.cherry_pick_base("updates", "c8s", theirs=True)
+        assert len(d2s.BUILD_commits) == 6
+        d2s.rebase_patches("updates", "c8s")
+        assert d2s.source_git.get_tags_for_head() == []
+    dist_git.close()
+
+
+def test_no_leaks(tmp_path: Path):
+    """ conversions in a long-running process leave no processes or memory behind """
+    for i in range(5):
+        convert(tmp_path, i)
+    gc.collect()
+    baseline = rss()
+    for i in range(5, 40):
+        convert(tmp_path, i)
+        assert child_processes() == []
+    gc.collect()
+    assert rss() - baseline < 10 * 1024